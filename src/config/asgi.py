@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from config.static_files import asgi_with_static_files  # noqa: E402  （設定を読み込んでから）
+from map_app.http_client import keep_clients_on_loop  # noqa: E402
+
+_application = asgi_with_static_files(django_application)
+
+
+async def application(scope, receive, send):
+    # uvicorn のイベントループはプロセスが終わるまで動くので、外部APIの AsyncClient をそこで共有する
+    keep_clients_on_loop()
+    await _application(scope, receive, send)
@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+
+# ---------------------------------------------------------
+# 本番用の gunicorn の設定（Dockerfile の CMD で -c config/gunicorn_conf.py として読み込む）
+#   GUNICORN_WORKER_CLASS=gthread（既定）: WSGI + スレッド。keep-alive の接続はスレッドが持つ。
+#     同期ビューがほとんどなので、bench_http ではこちらの方がスループット・p99 とも良かった
+#   GUNICORN_WORKER_CLASS=uvicorn: ASGI。リアルタイム通知（api/events/ の SSE）を使うならこちら
+#     （WSGI では SSE は 501 を返す。接続を張り続けるとスレッドを塞ぐため。
+#      そのとき地図の枠は MAP_POLL_SECONDS ごとに地図データを確認し直すので、反映が最大でその秒数遅れる）
+#   ワーカー数は WEB_CONCURRENCY、スレッド数は GUNICORN_THREADS で上書きできる
+# ---------------------------------------------------------
+
+
+def _cpu_count():
+    # コンテナに割り当てられた CPU 数（使えない環境ではマシン全体の数）
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+_cpus = _cpu_count()
+_worker = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+# Cloud Run は PORT を渡してくる
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '8080')}")
+
+if _worker == 'gthread':
+    wsgi_app = 'config.wsgi:application'
+    worker_class = 'gthread'
+    # ビューは CPU を使う処理（JSON の組み立てなど）が多く、CPU 数より多いワーカー・スレッドは
+    # 取り合いで p99 を悪くするだけだった。DB を待つ時間が長い環境では GUNICORN_THREADS を増やす
+    workers = int(os.environ.get('WEB_CONCURRENCY', _cpus))
+    threads = int(os.environ.get('GUNICORN_THREADS', 1))
+else:
+    # イベントループ1つで多くの接続を持てるので、ワーカーは CPU 数 + 1 で足りる
+    wsgi_app = 'config.asgi:application'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+    workers = int(os.environ.get('WEB_CONCURRENCY', _cpus + 1))
+
+# マスターでアプリを読み込んでから fork する。読み込んだモジュールと、
+# when_ready で作る駅のインデックス・路線グラフはワーカー間で copy-on-write で共有される
+preload_app = True
+
+# メモリの増え方を抑えるため、一定数のリクエストごとにワーカーを入れ替える（一斉に入れ替わらないよう揺らす）。
+# 入れ替えの間は遅延が跳ねる（1000 では p99 が数倍になった）ので、回数は多めにする
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+# 入れ替え・停止のときに、処理中のリクエストを待つ秒数
+graceful_timeout = 30
+timeout = 60
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# ハートビートのファイルをメモリ上に置く（コンテナのディスクが遅くてもワーカーが止まったと誤判定されない）
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    """fork の前に、ワーカーで共有したいデータをマスターで作っておく"""
+    from django.core.cache import caches
+    from django.db import connections
+
+    try:
+        from map_app.isochrone import get_station_graph
+        from map_app.spatial import get_station_index
+        from map_app.travel_matrix import get_travel_matrix
+
+        index = get_station_index()
+        get_station_graph()
+        get_travel_matrix()
+        server.log.info('駅データを読み込みました（%d 駅）', len(index))
+    except Exception as e:
+        # DB がまだ用意できていなくても起動はする（各ワーカーが最初のリクエストで作る）
+        server.log.warning('駅データの先読みに失敗しました: %s', e)
+    finally:
+        # マスターの接続をワーカーに引き継がない（同じソケットを複数のプロセスで使わない）
+        connections.close_all()
+        for cache in caches.all(initialized_only=True):
+            cache.close()
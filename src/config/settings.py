@@ -10,7 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+from django.core.exceptions import ImproperlyConfigured
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -46,6 +50,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # ビューごとの処理時間・SQL・キャッシュの計測と X-Profile（map_app.metrics）
+    'map_app.metrics.MetricsMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -73,12 +79,93 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# 既定は SQLite。DATABASE_URL（postgres://ユーザー:パスワード@ホスト:ポート/DB名）を設定すると PostgreSQL を使う。
+# PostgreSQL では接続を使い回し（CONN_MAX_AGE 秒）、使う前に切れていないか確認する。
+
+DATABASE_URL = os.environ.get('DATABASE_URL')
+
+if DATABASE_URL:
+    _db = urlsplit(DATABASE_URL)
+    if _db.scheme not in ('postgres', 'postgresql', 'postgis'):
+        raise ImproperlyConfigured(f'DATABASE_URL のスキーム {_db.scheme} には対応していません')
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': unquote(_db.path.lstrip('/')),
+            'USER': unquote(_db.username or ''),
+            'PASSWORD': unquote(_db.password or ''),
+            'HOST': _db.hostname or '',
+            'PORT': str(_db.port or ''),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5))},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {},
+        }
     }
+
+# SQLite を1台のサーバーで使うときの設定（SQLITE_PROFILE=tuned、既定）。
+# 接続のたびに PRAGMA を設定する（map_app.sqlite）。WAL にすると読み込みが書き込みを待たなくなる。
+# 書き込みのトランザクションは最初から書き込みロックを取る（IMMEDIATE）ので、
+# 途中でロックを取り直して "database is locked" になることがない。
+# SQLITE_PROFILE=default で Django の既定の動作に戻る。
+
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'tuned')
+# tuned の中身。ベンチマーク（bench_sqlite）もこの値を使う
+SQLITE_TUNED_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # ミリ秒。ロックが空くまで待つ
+    'busy_timeout': 20000,
+    # 256MB までファイルをメモリマップして読む（ページは全プロセスで共有される）
+    'mmap_size': 268435456,
+    # 負の値は KB 単位（64MB）
+    'cache_size': -65536,
+    'temp_store': 'MEMORY',
 }
+SQLITE_TUNED_OPTIONS = {'timeout': 20, 'transaction_mode': 'IMMEDIATE'}
+SQLITE_PRAGMAS = {}
+
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3' and SQLITE_PROFILE == 'tuned':
+    SQLITE_PRAGMAS = dict(SQLITE_TUNED_PRAGMAS)
+    DATABASES['default']['OPTIONS'].update(SQLITE_TUNED_OPTIONS)
+
+# PostGIS を使う（駅・物件に GiST インデックス付きの geom 列を作る。map_app.spatial_db）。
+# DATABASE_URL のスキームを postgis:// にするか POSTGIS=1 で有効。拡張が無いサーバーでは何もしない
+
+POSTGIS = bool(DATABASE_URL) and (urlsplit(DATABASE_URL).scheme == 'postgis' or os.environ.get('POSTGIS') == '1')
+
+
+# Cache
+# 既定はプロセス内のメモリ（テストもこれを使う）。
+# REDIS_URL を設定すると Redis を使う（redis パッケージが必要。ローカルの互換サーバーでも可）。
+# 駅データのバージョン（最寄り駅のインデックス・路線グラフを作り直す合図）もここに置くので、
+# 複数のワーカーで動かし、別のプロセスで import_stations / load_stations を実行するなら REDIS_URL を設定する
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'dousei-map',
+        }
+    }
+
+# グループごとの地図データ（map_app.caching）をキャッシュに置いておく秒数。
+# データが変われば期限を待たずに新しいバージョンのキーへ切り替わる
+GROUP_PAYLOAD_TIMEOUT = 60 * 60 * 24
 
 
 # Password validation
@@ -116,6 +203,18 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = os.environ.get('STATIC_ROOT', str(BASE_DIR / 'staticfiles'))
+# 静的ファイルは whitenoise で gunicorn / uvicorn から直接返す（MIDDLEWARE ではなく wsgi.py / asgi.py で包む。
+# config/static_files.py）。collectstatic をしていない（開発の）ときは、起動時に STATIC_ROOT を読みに行かない
+WHITENOISE_AUTOREFRESH = DEBUG or not os.path.isdir(STATIC_ROOT)
+
+# collectstatic でファイル名に内容のハッシュを付け（map_shell.3f2a….js）、gzip / brotli で圧縮したものも作る。
+# ファイル名が内容で変わるので、ブラウザには長期間キャッシュさせてよい
+
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -123,3 +222,60 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_URL = '/admin/login/'
+
+
+# Geocoding (住所→座標)
+# 変換は geocode_properties コマンド（ワーカー）がリクエスト外で行う。
+# テストでは 'map_app.geocoding.StubGeocoder' に差し替えるとネットワークに出ない。
+
+GEOCODER_BACKEND = 'map_app.geocoding.NominatimGeocoder'
+GEOCODER_USER_AGENT = 'dousei-map'
+GEOCODER_TIMEOUT = 10
+# Nominatim の利用規約（1秒1リクエストまで）に合わせた呼び出し間隔。
+# 間隔はキャッシュ（CACHES）を通して全プロセスで守るので、複数のワーカーで動かすときは REDIS_URL を設定する
+GEOCODER_MIN_INTERVAL = 1.0
+# 住所検索（api/geocode/）で呼び出し枠が空くのを待つ最大秒数（過ぎたら 503）
+GEOCODER_MAX_WAIT = 5.0
+
+
+# 駅データの取得元（import_stations）
+# テストやベンチマークでは map_app.fixture_api のローカルサーバーに向ける
+
+STATION_API_BASE_URL = 'http://express.heartrails.com/api/json'
+
+# 駅間の所要時間の行列（build_travel_matrix で作る。全ワーカーがメモリマップで共有する）
+
+TRAVEL_MATRIX_PATH = os.environ.get('TRAVEL_MATRIX_PATH', str(BASE_DIR / 'data' / 'travel_matrix.npy'))
+
+# サーバー側で作った地図HTML（map_view?mode=server）の保存先と、作成するワーカースレッド数。
+# 残しておくファイル数（最近使われた順）と、作成に失敗したデータを作り直すまでの秒数
+
+MAP_RENDER_DIR = os.environ.get('MAP_RENDER_DIR', str(BASE_DIR / 'data' / 'maps'))
+MAP_RENDER_WORKERS = 2
+MAP_RENDER_KEEP = 500
+MAP_RENDER_RETRY_SECONDS = 300
+
+# リアルタイム通知（api/events/）のブローカー。
+# ASGI ワーカーが複数ある場合は 'map_app.events.RedisBroker'（EVENT_BROKER_URL か REDIS_URL が必要）にする
+
+EVENT_BROKER = os.environ.get('EVENT_BROKER', 'map_app.events.InProcessBroker')
+EVENT_BROKER_URL = os.environ.get('EVENT_BROKER_URL') or os.environ.get('REDIS_URL')
+EVENT_HEARTBEAT_SECONDS = 15
+# SSE が使えないとき（WSGI の gthread ワーカーでは api/events/ は 501）に、
+# 地図の枠（map_view?mode=shell）が地図データを確認し直す間隔（秒）。304 なら中身は送られない
+MAP_POLL_SECONDS = int(os.environ.get('MAP_POLL_SECONDS', 30))
+
+# 外部APIへの HTTP クライアント（map_app.http_client、ジオコーディング・駅データAPIで共有）
+
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+HTTP_TIMEOUT = 10.0
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_POOL_TIMEOUT = 30.0
+GEOCODER_URL = 'https://nominatim.openstreetmap.org/search'
+
+# 計測（map_app.metrics）。/metrics/ はスタッフユーザーか「Authorization: Bearer METRICS_TOKEN」で見られる。
+# PROFILER_TOKEN を設定すると、スタッフ以外でも X-Profile-Token に付ければ X-Profile が使える
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN', '')
@@ -0,0 +1,58 @@
+import re
+
+from asgiref.wsgi import WsgiToAsgi
+from django.conf import settings
+from whitenoise import WhiteNoise
+
+# ---------------------------------------------------------
+# 静的ファイルの配信（whitenoise）
+#   WhiteNoiseMiddleware は同期専用で、ASGI では全リクエストがスレッドを経由してしまうので
+#   MIDDLEWARE には入れず、アプリの外側で包む。
+#     WSGI（gthread）: wsgi.py で Django のアプリを WhiteNoise で包む
+#     ASGI（uvicorn）: STATIC_URL 以下のリクエストだけを WhiteNoise（別スレッド）に回し、
+#                      それ以外は Django の非同期ハンドラーにそのまま渡す。
+#                      前段にプロキシ・CDN があるなら、そちらで STATIC_ROOT を配信する方が軽い
+#   開発サーバー（runserver）は DEBUG のとき django.contrib.staticfiles が配信する
+# ---------------------------------------------------------
+
+# collectstatic（ManifestStaticFilesStorage）が付ける 12 桁のハッシュ（map_shell.3f2a….js）
+_HASHED_NAME = re.compile(r'^.+\.[0-9a-f]{12}\.[^/]+$')
+
+
+def static_prefix():
+    return '/' + settings.STATIC_URL.strip('/') + '/'
+
+
+def _is_hashed(path, url):
+    # ファイル名が内容で変わるので、ブラウザには1年キャッシュさせてよい
+    return bool(_HASHED_NAME.match(url))
+
+
+def _not_found(environ, start_response):
+    start_response('404 Not Found', [('Content-Type', 'text/plain; charset=utf-8')])
+    return [b'Not Found']
+
+
+def with_static_files(application=_not_found):
+    """WSGI のアプリを包み、STATIC_ROOT のファイル（圧縮済みの .gz / .br を優先）を返す"""
+    return WhiteNoise(
+        application,
+        root=settings.STATIC_ROOT,
+        prefix=static_prefix(),
+        autorefresh=settings.WHITENOISE_AUTOREFRESH,
+        max_age=0 if settings.DEBUG else 60,
+        immutable_file_test=_is_hashed,
+    )
+
+
+def asgi_with_static_files(application):
+    """ASGI のアプリを包み、STATIC_URL 以下だけを whitenoise で返す"""
+    static_app = WsgiToAsgi(with_static_files())
+    prefix = static_prefix()
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'http' and scope['path'].startswith(prefix):
+            return await static_app(scope, receive, send)
+        return await application(scope, receive, send)
+
+    return app
@@ -13,4 +13,6 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_wsgi_application()
+from config.static_files import with_static_files  # noqa: E402  （設定を読み込んでから）
+
+application = with_static_files(get_wsgi_application())
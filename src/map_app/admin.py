@@ -4,13 +4,17 @@ from .models import Property
 # 管理画面に表示する設定
 class PropertyAdmin(admin.ModelAdmin):
     list_display = ('name', 'address', 'rent', 'match_status') # 一覧に出す項目
-    
+    # 保存済みのマッチ状態（インデックス付き）で絞り込める
+    list_filter = ('is_matched',)
+    # rent_yen は保存時に rent から作られる
+    readonly_fields = ('rent_yen', 'like_count', 'is_matched')
+
     # 2人ともいいねしているかを表示するカスタム項目
     def match_status(self, obj):
-        if obj.is_matched():
+        if obj.is_matched:
             return "❤️ マッチング！"
-        return f"いいね数: {obj.likes.count()}"
+        return f"いいね数: {obj.like_count}"
     match_status.short_description = "ステータス"
 
 # 管理画面に登録
-admin.site.register(Property, PropertyAdmin)
\ No newline at end of file
+admin.site.register(Property, PropertyAdmin)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MapAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'map_app'
+
+    def ready(self):
+        # キャッシュを無効化するシグナル、SQLite の接続設定、SQLの計測を登録する
+        from . import metrics, signals, sqlite  # noqa: F401
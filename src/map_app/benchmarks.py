@@ -0,0 +1,112 @@
+import io
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .fixture_api import FixtureStationAPI
+from .matching import rebuild_match_state
+from .models import GEOCODE_DONE, MapGroup, Property, Station, UserProfile, parse_rent
+
+# ---------------------------------------------------------
+# ベンチマーク用の部品（bench_suite コマンドとテストから使う）
+#   make_group: 物件・メンバー・いいねの多いグループを bulk_create でまとめて作る
+#   measure:    関数を何回か呼んで、時間・SQLの回数・メモリのピークを測る
+# ---------------------------------------------------------
+
+TOKYO = (35.681, 139.767)
+
+
+def make_group(size, members, rng, like_ratio=0.3, selected_stations=3, name=None):
+    """物件 size 件・メンバー members 人のグループを作り、(group, users) を返す"""
+    group = MapGroup.objects.create(name=name or f'ベンチ{size}-{rng.getrandbits(32):08x}', password='bench')
+    users = User.objects.bulk_create([
+        User(username=f'bench-{group.pk}-{i}', password='!') for i in range(members)
+    ])
+    UserProfile.objects.bulk_create([UserProfile(user=user, group=group) for user in users])
+
+    station_ids = list(Station.objects.values_list('pk', flat=True))
+    if station_ids:
+        group.selected_stations.add(*rng.sample(station_ids, min(selected_stations, len(station_ids))))
+    # 物件は駅の近く（無ければ東京駅の近く）に散らばらせる
+    anchors = list(Station.objects.values_list('latitude', 'longitude')[:500]) or [TOKYO]
+    properties = []
+    for i in range(size):
+        lat, lon = rng.choice(anchors)
+        rent = f'{rng.randint(60, 250) / 10}万円'
+        properties.append(Property(
+            group=group, name=f'物件{i}', address=f'東京都ベンチ区{group.pk}-{i}', rent=rent, rent_yen=parse_rent(rent),
+            latitude=lat + rng.uniform(-0.01, 0.01), longitude=lon + rng.uniform(-0.01, 0.01),
+            geocode_status=GEOCODE_DONE,
+        ))
+    properties = Property.objects.bulk_create(properties)
+
+    Like = Property.likes.through
+    Like.objects.bulk_create([
+        Like(property_id=prop.pk, user_id=user.pk)
+        for prop in properties for user in users if rng.random() < like_ratio
+    ], batch_size=1000)
+    # bulk_create ではシグナルが飛ばないので、いいね数・メンバー数を数え直す
+    rebuild_match_state([group.pk])
+    return group, users
+
+
+def _summary(values):
+    ordered = sorted(values)
+    return {
+        'mean': round(statistics.fmean(values), 3),
+        'p50': round(ordered[len(ordered) // 2], 3),
+        'p90': round(ordered[min(int(len(ordered) * 0.9), len(ordered) - 1)], 3),
+        'max': round(ordered[-1], 3),
+    }
+
+
+def measure(func, repeat=10, setup=None, memory=True):
+    """func() を repeat 回呼んで測る。setup があれば毎回その前に呼ぶ（計測には含めない）
+
+    メモリのピークは tracemalloc を有効にした別の1回で測る（有効中は遅くなるので時間とは分ける）。
+    """
+    latencies, queries, results = [], [], []
+    for _ in range(max(repeat, 1)):
+        if setup is not None:
+            setup()
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            results.append(func())
+            latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(len(captured))
+
+    report = {'runs': len(latencies), 'latency_ms': _summary(latencies), 'queries': {'min': min(queries), 'max': max(queries)}}
+    if memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            func()
+            report['peak_kb'] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        finally:
+            tracemalloc.stop()
+    return report, results
+
+
+def measure_import_stations(network, repeat=3, workers=4):
+    """ローカルの FixtureStationAPI から import_stations を実行して測る（初回と、変更なしの再取り込み）"""
+    def run():
+        call_command('import_stations', base_url=api.base_url, workers=workers, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def clear():
+        Station.objects.all().delete()
+
+    with FixtureStationAPI(network) as api:
+        initial, _ = measure(run, repeat=1, setup=clear)
+        reimport, _ = measure(run, repeat=repeat)
+    return {
+        'lines': len(network),
+        'stations': Station.objects.count(),
+        'initial': initial,
+        'reimport': reimport,
+    }
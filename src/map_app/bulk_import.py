@@ -0,0 +1,161 @@
+import csv
+import io
+import json
+import time
+
+from django.db import transaction
+
+from . import events
+from .caching import bump_group_version
+from .forms import PropertyForm
+from .geocoding import normalize_address
+from .models import GEOCODE_DONE, GEOCODE_FAILED, GEOCODE_PENDING, GeocodeCache, Property, parse_rent
+
+# ---------------------------------------------------------
+# 物件の一括登録（CSV / JSONL）
+#   ファイルは1行ずつ読み、batch_size 件ごとに bulk_create する（ファイル全体をメモリに載せない）。
+#   各行は PropertyForm で検証し、同じグループに同じ住所（正規化後）がある行は飛ばす。
+#   座標はキャッシュにある住所だけすぐ入れ、残りは pending のまま geocode_properties に任せる。
+#   途中でファイルが読めなくなったら（文字コードの誤りなど）、そこまでの行は登録したまま止め、
+#   レポートの error に理由を入れて返す（登録済みの件数は created）。
+# ---------------------------------------------------------
+
+FORMATS = ('csv', 'jsonl')
+# 列名の別名（ポータルサイトからの貼り付けは日本語の見出しが多い）
+COLUMN_ALIASES = {
+    'name': 'name', '名前': 'name', '物件名': 'name',
+    'address': 'address', '住所': 'address', '所在地': 'address',
+    'rent': 'rent', '家賃': 'rent', '賃料': 'rent',
+}
+# レポートに載せるエラー行の上限（件数自体はすべて数える）
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportFormatError(Exception):
+    """ファイル全体が読めない（形式・見出しの誤り）"""
+
+
+def guess_format(filename):
+    name = (filename or '').lower()
+    if name.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if name.endswith(('.csv', '.txt')):
+        return 'csv'
+    raise ImportFormatError('ファイルの形式が分かりません（.csv / .jsonl）')
+
+
+def iter_rows(stream, fmt):
+    """バイト列のストリームから (行番号, {name, address, rent}) を順に返す"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        if not reader.fieldnames or not {COLUMN_ALIASES.get(f.strip()) for f in reader.fieldnames} >= {'name', 'address', 'rent'}:
+            raise ImportFormatError('CSV の見出しに name / address / rent（名前 / 住所 / 家賃）が必要です')
+        for row in reader:
+            # 見出し行が1行目
+            yield reader.line_num, _normalize_columns(row)
+    elif fmt == 'jsonl':
+        for number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield number, None
+                continue
+            yield number, _normalize_columns(row) if isinstance(row, dict) else None
+    else:
+        raise ImportFormatError(f'形式 {fmt} には対応していません')
+
+
+def _normalize_columns(row):
+    data = {}
+    for key, value in row.items():
+        field = COLUMN_ALIASES.get((key or '').strip())
+        if field and value is not None:
+            data[field] = str(value).strip()
+    return data
+
+
+def import_properties(group, rows, batch_size=500, dry_run=False):
+    """rows（iter_rows の戻り値）をグループに登録し、結果の集計を返す
+
+    valid は登録できる行の数、created は実際に登録した数（dry_run なら 0）。
+    """
+    started = time.perf_counter()
+    report = {
+        'rows': 0, 'valid': 0, 'created': 0, 'duplicates': 0, 'invalid': 0,
+        'geocoded_from_cache': 0, 'queued_for_geocoding': 0, 'errors': [],
+    }
+    seen = {normalize_address(a) for a in Property.objects.filter(group=group).values_list('address', flat=True)}
+    batch = []
+
+    def error(number, messages):
+        report['invalid'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append({'row': number, 'errors': messages})
+
+    try:
+        try:
+            for number, data in rows:
+                report['rows'] += 1
+                if data is None:
+                    error(number, {'__all__': ['JSON のオブジェクトとして読めません']})
+                    continue
+                form = PropertyForm(data)
+                if not form.is_valid():
+                    error(number, {field: list(messages) for field, messages in form.errors.items()})
+                    continue
+                prop = form.save(commit=False)
+                key = normalize_address(prop.address)
+                if key in seen:
+                    report['duplicates'] += 1
+                    continue
+                seen.add(key)
+                prop.group = group
+                batch.append((key, prop))
+                if len(batch) >= batch_size:
+                    _write_batch(batch, report, dry_run)
+                    batch = []
+        except ImportFormatError as e:
+            report['error'] = str(e)
+        except UnicodeDecodeError:
+            report['error'] = f"{report['rows'] + 1} 行目が UTF-8 として読めません"
+        if batch:
+            _write_batch(batch, report, dry_run)
+    finally:
+        if report['created']:
+            # bulk_create ではシグナルが飛ばないので、ここでキャッシュを更新して画面に知らせる
+            # （書き込みの途中で失敗しても、それまでのバッチは登録済み）
+            bump_group_version(group.pk)
+            events.publish(group.pk, 'properties.imported', {'count': report['created']})
+
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    report['rows_per_sec'] = round(report['rows'] / report['seconds'], 1) if report['seconds'] else None
+    return report
+
+
+def _write_batch(batch, report, dry_run):
+    # 座標キャッシュは1バッチ1クエリで引く
+    cached = {
+        entry.address_key: entry
+        for entry in GeocodeCache.objects.filter(address_key__in=[key for key, _ in batch])
+    }
+    properties = []
+    for key, prop in batch:
+        # bulk_create は save() を通らないので、save() と同じ値をここで入れる
+        prop.rent_yen = parse_rent(prop.rent)
+        entry = cached.get(key)
+        if entry is None:
+            prop.geocode_status = GEOCODE_PENDING
+            report['queued_for_geocoding'] += 1
+        else:
+            prop.latitude, prop.longitude = entry.latitude, entry.longitude
+            prop.geocode_status = GEOCODE_DONE if entry.found else GEOCODE_FAILED
+            report['geocoded_from_cache'] += 1
+        properties.append(prop)
+    report['valid'] += len(properties)
+    if not dry_run:
+        with transaction.atomic():
+            Property.objects.bulk_create(properties)
+        report['created'] += len(properties)
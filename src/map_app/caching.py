@@ -0,0 +1,159 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .metrics import record_cache_lookup
+
+# ---------------------------------------------------------
+# グループごとの地図データのキャッシュ
+#   グループのデータが変わるたびに「バージョン番号」を上げ、
+#   キャッシュのキーにバージョンを含める。古いキーは参照されなくなり、期限切れで消える。
+#   バージョンを上げるのは signals.py（物件・いいね・選択駅・メンバーの変更）。
+#   駅データ全体のバージョンも同じ仕組みで持つ（import_stations / load_stations で上がる）。
+# ---------------------------------------------------------
+
+STATION_VERSION_KEY = 'stations:version'
+STATION_MODIFIED_KEY = 'stations:modified'
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def _version_key(group_id):
+    return f'group:{group_id}:version'
+
+
+def _modified_key(group_id):
+    return f'group:{group_id}:modified'
+
+
+def _initial_version():
+    # バージョンのキーだけが追い出された場合でも、以前の番号と重ならないよう時刻から作る
+    return int(time.time() * 1000)
+
+
+def station_data_version():
+    """駅データのバージョン。駅から作ったインデックスやキャッシュのキーに使う"""
+    return cache.get_or_set(STATION_VERSION_KEY, _initial_version, timeout=None)
+
+
+def bump_station_data_version():
+    """import_stations / load_stations で駅データが変わったときに呼ぶ"""
+    try:
+        cache.incr(STATION_VERSION_KEY)
+    except ValueError:
+        cache.set(STATION_VERSION_KEY, _initial_version(), timeout=None)
+    cache.set(STATION_MODIFIED_KEY, time.time(), timeout=None)
+
+
+def group_version(group_id):
+    return cache.get_or_set(_version_key(group_id), _initial_version, timeout=None)
+
+
+def _bump(group_id):
+    try:
+        cache.incr(_version_key(group_id))
+    except ValueError:
+        cache.set(_version_key(group_id), _initial_version(), timeout=None)
+    # Last-Modified 用に、バージョンと一緒に変わった時刻も残す
+    cache.set(_modified_key(group_id), time.time(), timeout=None)
+
+
+def bump_group_version(group_id):
+    """グループの地図データが変わったことを記録する
+
+    すぐに上げるのに加えて、トランザクション確定後にもう一度上げる。
+    確定前に別のリクエストが古いデータで作ったキャッシュを使わせないため。
+    """
+    if group_id is None:
+        return
+    _bump(group_id)
+    transaction.on_commit(lambda: _bump(group_id))
+
+
+def station_last_modified():
+    """駅データが最後に変わった時刻（UNIX 秒）。記録が無ければ今を記録する"""
+    return cache.get_or_set(STATION_MODIFIED_KEY, time.time, timeout=None)
+
+
+def payload_last_modified(group_id):
+    """グループの地図データ（駅データを含む）が最後に変わった時刻。Last-Modified に使う"""
+    return max(cache.get_or_set(_modified_key(group_id), time.time, timeout=None), station_last_modified())
+
+
+def payload_tag(group_id, kind):
+    """キャッシュのキー・ETag に使う文字列（グループと駅データのバージョンを含む）"""
+    digest = hashlib.md5(kind.encode('utf-8')).hexdigest()[:16]
+    return f'g{group_id}-v{group_version(group_id)}-s{station_data_version()}-{digest}'
+
+
+def get_group_payload(group_id, kind, builder, tag=None):
+    """グループの地図データ（シリアライズ済みのバイト列）を返す
+
+    kind はデータの種類（'map' や表示範囲など）。キャッシュに無いときだけ builder() を呼ぶ。
+    """
+    key = f'payload:{tag or payload_tag(group_id, kind)}'
+    payload = cache.get(key)
+    with _stats_lock:
+        _stats['hits' if payload is not None else 'misses'] += 1
+    record_cache_lookup(payload is not None)
+    if payload is None:
+        payload = builder()
+        cache.set(key, payload, timeout=getattr(settings, 'GROUP_PAYLOAD_TIMEOUT', 60 * 60 * 24))
+    return payload
+
+
+# ---------------------------------------------------------
+# 非同期ビュー用（Django のキャッシュの非同期API を使う）
+# ---------------------------------------------------------
+
+async def astation_data_version():
+    return await cache.aget_or_set(STATION_VERSION_KEY, _initial_version, timeout=None)
+
+
+async def agroup_version(group_id):
+    return await cache.aget_or_set(_version_key(group_id), _initial_version, timeout=None)
+
+
+async def apayload_last_modified(group_id):
+    group_modified = await cache.aget_or_set(_modified_key(group_id), time.time, timeout=None)
+    return max(group_modified, await cache.aget_or_set(STATION_MODIFIED_KEY, time.time, timeout=None))
+
+
+async def apayload_tag(group_id, kind):
+    digest = hashlib.md5(kind.encode('utf-8')).hexdigest()[:16]
+    return f'g{group_id}-v{await agroup_version(group_id)}-s{await astation_data_version()}-{digest}'
+
+
+async def aget_group_payload(group_id, kind, builder, tag=None):
+    """get_group_payload の非同期版。builder は非同期関数（キャッシュに無いときだけ呼ぶ）"""
+    key = f'payload:{tag or await apayload_tag(group_id, kind)}'
+    payload = await cache.aget(key)
+    with _stats_lock:
+        _stats['hits' if payload is not None else 'misses'] += 1
+    record_cache_lookup(payload is not None)
+    if payload is None:
+        payload = await builder()
+        await cache.aset(key, payload, timeout=getattr(settings, 'GROUP_PAYLOAD_TIMEOUT', 60 * 60 * 24))
+    return payload
+
+
+def cache_stats():
+    with _stats_lock:
+        hits, misses = _stats['hits'], _stats['misses']
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / total, 4) if total else None,
+    }
+
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats['hits'] = 0
+        _stats['misses'] = 0
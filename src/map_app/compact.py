@@ -0,0 +1,204 @@
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+
+from .models import Property
+
+try:
+    import brotli
+except ImportError:  # brotli は任意（無ければ gzip で返す）
+    brotli = None
+
+# ---------------------------------------------------------
+# 地図データの列指向フォーマット（api/map/compact/）
+#   物件ごとの {"name": ..., "lat": ...} の代わりに、列ごとの配列で返す（キー名を繰り返さない）。
+#   いいねした人は名前ではなく users の番号で持つ。users はいいねと同じクエリから作り、最後に書き出す
+#   （ストリーミング中にいいねが増えても、知らない番号を出さない）。
+#   物件は BLOCK_SIZE 件ずつのブロックに分け、values_list の iterator から1ブロックずつ書き出すので、
+#   物件数が増えてもメモリに載るのは1ブロック分だけ。
+#
+#   {"format": "columnar", "version": 1,
+#    "center": {"lat": .., "lon": ..},
+#    "stations": {"name": [..], "lat": [..], "lon": [..]},
+#    "properties": [{"id": [..], "name": [..], "rent": [..], "address": [..],
+#                    "lat": [..], "lon": [..], "matched": [0, 1, ..], "likes": [[0, 1], [], ..]}, ...],
+#    "users": ["alice", "bob"],
+#    "count": 物件数}
+# ---------------------------------------------------------
+
+FORMAT_VERSION = 1
+BLOCK_SIZE = 1000
+# 座標は小数点以下6桁（約10cm）で十分
+COORD_DIGITS = 6
+# 新宿駅（map_view と同じ、駅が無いときの中心）
+DEFAULT_CENTER = {'lat': 35.690921, 'lon': 139.700258}
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def _coord(value):
+    return round(value, COORD_DIGITS)
+
+
+def iter_columnar_payload(group, block_size=BLOCK_SIZE):
+    """グループの地図データを、列指向の JSON のバイト列として少しずつ返す（3クエリ）"""
+    stations = list(group.selected_stations.order_by('pk').values_list('name', 'latitude', 'longitude'))
+    center = {'lat': stations[0][1], 'lon': stations[0][2]} if stations else DEFAULT_CENTER
+
+    yield (
+        f'{{"format":"columnar","version":{FORMAT_VERSION},"center":{_dumps(center)},'
+        f'"stations":{{"name":{_dumps([s[0] for s in stations])},'
+        f'"lat":{_dumps([s[1] for s in stations])},"lon":{_dumps([s[2] for s in stations])}}},'
+        f'"properties":['
+    ).encode('utf-8')
+
+    properties = (
+        Property.objects.filter(group=group)
+        .exclude(latitude__isnull=True)
+        .exclude(longitude__isnull=True)
+        .order_by('pk')
+        .values_list('pk', 'name', 'rent', 'address', 'latitude', 'longitude', 'is_matched')
+        .iterator(chunk_size=block_size)
+    )
+    # いいねも物件と同じ順に並べて、突き合わせながら読む（物件ごとのクエリにしない）
+    likes = (
+        Property.likes.through.objects.filter(property__group=group)
+        .order_by('property_id', 'user_id')
+        .values_list('property_id', 'user_id', 'user__username')
+        .iterator(chunk_size=block_size)
+    )
+    like = next(likes, None)
+    # ユーザーは出てきた順に番号を振る
+    user_index, usernames = {}, []
+
+    count = 0
+    block = []
+    for row in properties:
+        liked = []
+        while like is not None and like[0] <= row[0]:
+            if like[0] == row[0]:
+                index = user_index.get(like[1])
+                if index is None:
+                    index = user_index[like[1]] = len(usernames)
+                    usernames.append(like[2])
+                liked.append(index)
+            like = next(likes, None)
+        block.append((*row, liked))
+        if len(block) >= block_size:
+            yield _block(block, first=count == 0)
+            count += len(block)
+            block = []
+    if block:
+        yield _block(block, first=count == 0)
+        count += len(block)
+    yield f'],"users":{_dumps(usernames)},"count":{count}}}'.encode('utf-8')
+
+
+def _block(rows, first):
+    ids, names, rents, addresses, lats, lons, matched, likes = zip(*rows)
+    body = (
+        f'{{"id":{_dumps(ids)},"name":{_dumps(names)},"rent":{_dumps(rents)},"address":{_dumps(addresses)},'
+        f'"lat":{_dumps([_coord(v) for v in lats])},"lon":{_dumps([_coord(v) for v in lons])},'
+        f'"matched":{_dumps([int(v) for v in matched])},"likes":{_dumps(likes)}}}'
+    )
+    return (body if first else ',' + body).encode('utf-8')
+
+
+def decode_columnar(data):
+    """列指向のデータを build_map_payload と同じ形に戻す（テスト・デバッグ用）"""
+    users = data['users']
+    properties = []
+    for block in data['properties']:
+        for i, pk in enumerate(block['id']):
+            properties.append({
+                'id': pk,
+                'name': block['name'][i],
+                'rent': block['rent'][i],
+                'address': block['address'][i],
+                'lat': block['lat'][i],
+                'lon': block['lon'][i],
+                'is_matched': bool(block['matched'][i]),
+                'liked_users': [users[u] for u in block['likes'][i]],
+            })
+    stations = data['stations']
+    return {
+        'center': data['center'],
+        'stations': [
+            {'name': name, 'lat': lat, 'lon': lon}
+            for name, lat, lon in zip(stations['name'], stations['lat'], stations['lon'])
+        ],
+        'properties': properties,
+    }
+
+
+# ---------------------------------------------------------
+# 圧縮（Accept-Encoding に合わせて br / gzip / なし）
+# ---------------------------------------------------------
+
+def negotiate_encoding(accept_encoding):
+    """使える圧縮形式を選ぶ（q=0 で拒否されたものは使わない）"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def compress_stream(chunks, encoding):
+    """バイト列のイテレータを、そのまま少しずつ圧縮して返す"""
+    if encoding is None:
+        yield from chunks
+        return
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 で gzip 形式
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    data = finish()
+    if data:
+        yield data
+
+
+class ThreadedStream:
+    """同期のイテレータを、ASGI でバッファせずに流すためのラッパー
+
+    StreamingHttpResponse に同期のイテレータを渡すと、ASGI では全体を読み込んでから送られる。
+    ここでは1チャンクずつ sync_to_async で取り出す（DB の接続を使うので同じスレッドで）。
+    close() はレスポンスが閉じられたとき（切断時も）に Django から呼ばれる。
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    async def __aiter__(self):
+        next_chunk = sync_to_async(next, thread_sensitive=True)
+        while True:
+            chunk = await next_chunk(self._chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self):
+        close = getattr(self._chunks, 'close', None)
+        if close is not None:
+            close()
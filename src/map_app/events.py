@@ -0,0 +1,306 @@
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .models import Property, Station
+
+# ---------------------------------------------------------
+# グループごとのリアルタイム通知（SSE: api/events/）
+#   物件の追加・いいね・選択駅の変更を、小さな差分（イベント）として同じグループの画面に送る。
+#   送り先の管理（ブローカー）は settings.EVENT_BROKER で差し替えられる。
+#     InProcessBroker: 1プロセス内で配る（開発・ASGIワーカー1つの場合）
+#     RedisBroker:     Redis の pub/sub 経由で、全ワーカー・全サーバーに配る
+#   イベントはトランザクション確定後に送る（取り消された変更は送らない）。
+# ---------------------------------------------------------
+
+logger = logging.getLogger(__name__)
+
+# 1つの接続が受け取りきれずに溜められるイベント数。溢れたら 'resync'（全部取り直して）を送る
+SUBSCRIBER_QUEUE_SIZE = 256
+
+_event_ids = itertools.count(1)
+
+
+def make_event(group_id, event_type, data):
+    return {'id': next(_event_ids), 'type': event_type, 'group': group_id, 'data': data}
+
+
+def format_sse(event):
+    """イベントを SSE の1メッセージ（バイト列）にする"""
+    body = json.dumps(event['data'], ensure_ascii=False, separators=(',', ':'))
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {body}\n\n".encode('utf-8')
+
+
+class Subscription:
+    """1つの接続の受信口。get() はイベントループ上で呼ぶ"""
+
+    def __init__(self, broker, group_id):
+        self.broker = broker
+        self.group_id = group_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, event):
+        """イベントループ上で呼ぶ"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 遅い接続のためにメモリを使い続けないよう、溜まった分を捨てて取り直してもらう
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(make_event(self.group_id, 'resync', {}))
+
+    async def get(self, timeout=None):
+        """次のイベント。timeout 秒来なければ None"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+def _fan_out(subscriptions, event):
+    for subscription in subscriptions:
+        subscription.put(event)
+
+
+class InProcessBroker:
+    """同じプロセス内の接続にだけ配るブローカー"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    async def subscribe(self, group_id):
+        subscription = Subscription(self, group_id)
+        with self._lock:
+            self._subscribers.setdefault(group_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            members = self._subscribers.get(subscription.group_id)
+            if members is not None:
+                members.discard(subscription)
+                if not members:
+                    del self._subscribers[subscription.group_id]
+
+    def publish(self, group_id, event):
+        """どのスレッドからでも呼べる"""
+        with self._lock:
+            members = list(self._subscribers.get(group_id, ()))
+        # 接続ごとではなくイベントループごとに1回だけ起こして、まとめて配る
+        by_loop = {}
+        for subscription in members:
+            by_loop.setdefault(subscription.loop, []).append(subscription)
+        for loop, subscriptions in by_loop.items():
+            try:
+                loop.call_soon_threadsafe(_fan_out, subscriptions, event)
+            except RuntimeError:
+                # 接続側のイベントループがもう終わっている
+                pass
+        return len(members)
+
+    def subscriber_count(self, group_id=None):
+        with self._lock:
+            if group_id is not None:
+                return len(self._subscribers.get(group_id, ()))
+            return sum(len(members) for members in self._subscribers.values())
+
+
+class RedisBroker(InProcessBroker):
+    """Redis の pub/sub で全プロセスに配るブローカー（接続先は settings.EVENT_BROKER_URL）
+
+    プロセス内では InProcessBroker と同じように配り、プロセス間は Redis のチャンネル1つを通す。
+    """
+
+    CHANNEL = 'dousei-map:events'
+
+    def __init__(self):
+        super().__init__()
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('RedisBroker には redis パッケージが必要です')
+        url = getattr(settings, 'EVENT_BROKER_URL', None)
+        if not url:
+            raise ImproperlyConfigured('RedisBroker には EVENT_BROKER_URL の設定が必要です')
+        self._redis = redis.Redis.from_url(url)
+        self._listener = None
+
+    # 接続が切れたときに、つなぎ直すまで待つ秒数（失敗が続くたびに倍、最大 RECONNECT_MAX_DELAY）
+    RECONNECT_DELAY = 1.0
+    RECONNECT_MAX_DELAY = 30.0
+
+    def _listen(self):
+        delay = self.RECONNECT_DELAY
+        reconnecting = False
+        try:
+            while True:
+                pubsub = None
+                try:
+                    pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.CHANNEL)
+                    if reconnecting:
+                        # 切れていた間のイベントは届かないので、画面に取り直してもらう
+                        self._resync_all()
+                    delay = self.RECONNECT_DELAY
+                    for message in pubsub.listen():
+                        self._deliver(message)
+                except Exception:
+                    logger.exception('イベントの受信が切れました。%.0f 秒後につなぎ直します', delay)
+                finally:
+                    if pubsub is not None:
+                        try:
+                            pubsub.close()
+                        except Exception:
+                            pass
+                time.sleep(delay)
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+                reconnecting = True
+        finally:
+            # 次の subscribe でスレッドを作り直せるようにする
+            with self._lock:
+                self._listener = None
+
+    def _deliver(self, message):
+        try:
+            event = json.loads(message['data'])
+            group_id = event['group']
+        except (ValueError, KeyError, TypeError):
+            logger.warning('読めないイベントを読み飛ばしました: %r', message.get('data'))
+            return
+        super().publish(group_id, event)
+
+    def _resync_all(self):
+        with self._lock:
+            group_ids = [group_id for group_id, members in self._subscribers.items() if members]
+        for group_id in group_ids:
+            super().publish(group_id, make_event(group_id, 'resync', {}))
+
+    async def subscribe(self, group_id):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='event-broker', daemon=True)
+                self._listener.start()
+        return await super().subscribe(group_id)
+
+    def publish(self, group_id, event):
+        return self._redis.publish(self.CHANNEL, json.dumps(event, ensure_ascii=False))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+class EventStream:
+    """SSE の本文（バイト列）を順に返す。StreamingHttpResponse に渡す
+
+    接続が切れると Django が close() を呼ぶので、そこで購読をやめる。
+    """
+
+    def __init__(self, subscription, heartbeat=15, resync=False):
+        self.subscription = subscription
+        self.heartbeat = heartbeat
+        self.resync = resync
+
+    def __aiter__(self):
+        return self._generate()
+
+    async def _generate(self):
+        group_id = self.subscription.group_id
+        try:
+            # 切れたら3秒後に自動で再接続してもらう
+            yield b'retry: 3000\n\n'
+            yield format_sse(make_event(group_id, 'hello', {'group': group_id}))
+            if self.resync:
+                # 再接続の場合、切れていた間のイベントは持っていないので取り直してもらう
+                yield format_sse(make_event(group_id, 'resync', {}))
+            while True:
+                event = await self.subscription.get(timeout=self.heartbeat)
+                if event is None:
+                    # プロキシに切られないよう、ときどきコメント行を送る
+                    yield b': keep-alive\n\n'
+                else:
+                    yield format_sse(event)
+        finally:
+            self.close()
+
+    def close(self):
+        self.subscription.close()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            backend = getattr(settings, 'EVENT_BROKER', 'map_app.events.InProcessBroker')
+            _broker = import_string(backend)()
+        return _broker
+
+
+def reset_broker():
+    global _broker
+    with _broker_lock:
+        _broker = None
+
+
+def publish(group_id, event_type, data):
+    """グループにイベントを送る（トランザクション確定後）"""
+    if group_id is None:
+        return
+    transaction.on_commit(lambda: get_broker().publish(group_id, make_event(group_id, event_type, data)))
+
+
+# ---------------------------------------------------------
+# 差分イベントの組み立て
+# ---------------------------------------------------------
+
+def property_event_data(prop):
+    return {
+        'id': prop.pk,
+        'name': prop.name,
+        'rent': prop.rent,
+        'address': prop.address,
+        'lat': prop.latitude,
+        'lon': prop.longitude,
+        'is_matched': prop.is_matched,
+        'like_count': prop.like_count,
+    }
+
+
+def station_event_data(station_ids):
+    return [
+        {'id': pk, 'name': name, 'lat': lat, 'lon': lon}
+        for pk, name, lat, lon in Station.objects.filter(pk__in=station_ids).order_by('pk').values_list('pk', 'name', 'latitude', 'longitude')
+    ]
+
+
+def publish_station_change(group_id, added_ids=(), removed_ids=()):
+    """選択駅の追加・削除を送る（追加した駅は座標つき）"""
+    if not added_ids and not removed_ids:
+        return
+    publish(group_id, 'stations.changed', {
+        'added': station_event_data(added_ids) if added_ids else [],
+        'removed': sorted(removed_ids),
+    })
+
+
+def publish_like_state(property_ids, user=None, liked=None):
+    """いいねが変わった物件の、最新のいいね数・マッチ状態を送る"""
+    rows = Property.objects.filter(pk__in=set(property_ids)).values_list('pk', 'group_id', 'like_count', 'is_matched')
+    for pk, group_id, like_count, is_matched in rows:
+        data = {'property_id': pk, 'like_count': like_count, 'is_matched': is_matched}
+        if user is not None:
+            data.update({'user': user.username, 'liked': liked})
+        publish(group_id, 'like.changed', data)
@@ -0,0 +1,94 @@
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ---------------------------------------------------------
+# HeartRails Express API 互換のローカルサーバー
+#   import_stations を本物のAPIに繋がずにテスト・ベンチマークするためのもの
+#   使い方:
+#       with FixtureStationAPI({'路線A': [{'name': '駅1', 'x': 139.7, 'y': 35.6}]}) as api:
+#           call_command('import_stations', base_url=api.base_url)
+# ---------------------------------------------------------
+
+
+def synthetic_network(num_lines=100, stations_per_line=20):
+    """東京の路線網と同程度の規模の、架空の路線・駅データを作る
+
+    隣り合う路線は駅名を1つ共有するので、乗り換えのある路線網になる。
+    """
+    network = {}
+    for i in range(num_lines):
+        stations = []
+        for j in range(stations_per_line):
+            # 路線ごとに少しずつずらしながら東京近辺に並べる
+            name = f'駅{i}-{j}'
+            if j == 0 and i > 0:
+                name = f'駅{i - 1}-{stations_per_line // 2}'
+            stations.append({
+                'name': name,
+                # 本物のAPIと同じく小数点以下6桁にそろえる
+                'x': round(139.55 + (i % 10) * 0.03 + j * 0.004, 6),
+                'y': round(35.55 + (i // 10) * 0.03 + j * 0.002, 6),
+            })
+        network[f'路線{i}'] = stations
+    return network
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        method = query.get('method', [''])[0]
+        network = self.server.network
+        self.server.request_count += 1
+
+        if method == 'getLines':
+            body = {'response': {'line': list(network)}}
+        elif method == 'getStations' and query.get('line', [''])[0] in network:
+            body = {'response': {'station': network[query['line'][0]]}}
+        else:
+            body = {'response': {'error': 'not found'}}
+
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # テスト出力を汚さない
+        pass
+
+
+class FixtureStationAPI:
+    def __init__(self, network=None, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.network = network if network is not None else synthetic_network()
+        self.server.request_count = 0
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/api/json'
+
+    @property
+    def request_count(self):
+        return self.server.request_count
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
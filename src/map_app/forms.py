@@ -1,5 +1,5 @@
 from django import forms
-from .models import Property, MapGroup, Station
+from .models import Property, MapGroup
 
 class PropertyForm(forms.ModelForm):
     class Meta:
@@ -23,12 +23,3 @@ class MapGroupForm(forms.ModelForm):
             'name': forms.TextInput(attrs={'class': 'form-control', 'placeholder': '例：佐藤・鈴木ペア'}),
             'password': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'パートナーと共有する合言葉'}),
         }
-
-class StationSelectionForm(forms.ModelForm):
-    class Meta:
-        model = MapGroup
-        fields = ['selected_stations']
-        # チェックボックスで複数選択できるウィジェットを使います
-        widgets = {
-            'selected_stations': forms.CheckboxSelectMultiple(),
-        }
\ No newline at end of file
@@ -0,0 +1,334 @@
+import asyncio
+import hashlib
+import re
+import time
+import unicodedata
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from geopy.exc import GeocoderRateLimited, GeocoderServiceError, GeocoderTimedOut, GeocoderUnavailable
+from geopy.geocoders import Nominatim
+
+from . import events
+from .caching import bump_group_version
+from .http_client import aget
+from .models import GEOCODE_DONE, GEOCODE_FAILED, GEOCODE_PENDING, GeocodeCache, Property
+
+# ---------------------------------------------------------
+# 住所の正規化
+# ---------------------------------------------------------
+
+# 全角・半角や表記ゆれのあるハイフン類
+_DASHES = re.compile(r'[‐‑‒–—―−ー－﹣]')
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_address(address):
+    """キャッシュのキーにするため、住所の表記ゆれ（全角数字・ハイフン・空白）をそろえる"""
+    text = unicodedata.normalize('NFKC', address or '')
+    # 「1ー2ー3」のように数字の間に挟まった長音記号などをハイフンに統一する
+    text = re.sub(r'(?<=\d)' + _DASHES.pattern + r'(?=\d)', '-', text)
+    text = _SPACES.sub('', text)
+    return text.lower()[:255]
+
+
+# ---------------------------------------------------------
+# ジオコーダー（差し替え可能）
+#   settings.GEOCODER_BACKEND にクラスのパスを書くと切り替わる
+# ---------------------------------------------------------
+
+class TransientGeocodingError(Exception):
+    """時間をおけば成功する可能性がある失敗（タイムアウト・レート制限など）"""
+
+
+class GeocodingError(Exception):
+    """再試行しても成功しない失敗"""
+
+
+class BaseGeocoder:
+    def geocode(self, address):
+        """(緯度, 経度) を返す。見つからなければ None"""
+        raise NotImplementedError
+
+    async def ageocode(self, address):
+        """geocode の非同期版。上書きしなければ geocode を別スレッドで呼ぶ"""
+        return await sync_to_async(self.geocode, thread_sensitive=False)(address)
+
+
+class NominatimGeocoder(BaseGeocoder):
+    def __init__(self):
+        self.client = Nominatim(
+            user_agent=getattr(settings, 'GEOCODER_USER_AGENT', 'dousei-map'),
+            timeout=getattr(settings, 'GEOCODER_TIMEOUT', 10),
+        )
+
+    def geocode(self, address):
+        try:
+            location = self.client.geocode(address, country_codes='jp')
+        except (GeocoderTimedOut, GeocoderUnavailable, GeocoderRateLimited) as e:
+            raise TransientGeocodingError(str(e)) from e
+        except GeocoderServiceError as e:
+            raise GeocodingError(str(e)) from e
+        if location is None:
+            return None
+        return location.latitude, location.longitude
+
+    async def ageocode(self, address):
+        # 非同期ビューからは、共有の HTTP クライアント（http_client.py）で Nominatim の API を直接呼ぶ
+        url = getattr(settings, 'GEOCODER_URL', 'https://nominatim.openstreetmap.org/search')
+        params = {'q': address, 'format': 'json', 'limit': 1, 'countrycodes': 'jp'}
+        try:
+            response = await aget(url, params=params, timeout=getattr(settings, 'GEOCODER_TIMEOUT', 10))
+        except httpx.TransportError as e:
+            raise TransientGeocodingError(str(e)) from e
+        if response.status_code == 429 or response.status_code >= 500:
+            raise TransientGeocodingError(f'HTTP {response.status_code}')
+        if response.status_code >= 400:
+            raise GeocodingError(f'HTTP {response.status_code}')
+        try:
+            results = response.json()
+            if not results:
+                return None
+            return float(results[0]['lat']), float(results[0]['lon'])
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            # 200 で HTML のエラーページが返るなど、想定外の形の応答
+            raise GeocodingError(f'応答を読めません: {e}') from e
+
+
+class StubGeocoder(BaseGeocoder):
+    """テストや開発用。ネットワークに出ず、住所から決まった座標を返す"""
+
+    def __init__(self, results=None):
+        # テストから {正規化済み住所: (緯度, 経度) または None} を差し込める
+        self.results = dict(results or {})
+        self.calls = []
+
+    def geocode(self, address):
+        self.calls.append(address)
+        key = normalize_address(address)
+        if key in self.results:
+            return self.results[key]
+        # 住所のハッシュから東京近辺の座標を作る（同じ住所なら毎回同じ結果）
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        lat = 35.60 + digest[0] / 255 * 0.2
+        lon = 139.60 + digest[1] / 255 * 0.3
+        return lat, lon
+
+
+def get_geocoder():
+    backend = getattr(settings, 'GEOCODER_BACKEND', 'map_app.geocoding.NominatimGeocoder')
+    return import_string(backend)()
+
+
+# ---------------------------------------------------------
+# キャッシュの参照・保存
+# ---------------------------------------------------------
+
+def apply_cached_coordinates(prop):
+    """キャッシュに住所があれば、物件に座標を入れる（外部APIは呼ばない）
+
+    リクエスト処理中に呼んでも、インデックス付きの1クエリで済む。
+    キャッシュにない住所は pending のまま残り、ワーカーが後で変換する。
+    """
+    entry = GeocodeCache.objects.filter(address_key=normalize_address(prop.address)).first()
+    if entry is None:
+        prop.geocode_status = GEOCODE_PENDING
+        return False
+    prop.latitude = entry.latitude
+    prop.longitude = entry.longitude
+    prop.geocode_status = GEOCODE_DONE if entry.found else GEOCODE_FAILED
+    return True
+
+
+def store_result(address_key, coords):
+    lat, lon = coords if coords else (None, None)
+    try:
+        entry, _ = GeocodeCache.objects.update_or_create(
+            address_key=address_key, defaults={'latitude': lat, 'longitude': lon},
+        )
+    except IntegrityError:
+        # 別のワーカーが同時に保存した場合はそちらを使う
+        entry = GeocodeCache.objects.get(address_key=address_key)
+    return entry
+
+
+# ---------------------------------------------------------
+# 外部APIの呼び出し枠（全プロセスで共有）
+#   時刻を min_interval 秒ごとの枠に区切り、共有キャッシュ（本番は Redis）の cache.add で
+#   1つの枠を1回の呼び出しだけが取れるようにする。uvicorn のワーカーが複数あっても、
+#   geocode_properties コマンドと同時に動いても、合わせて min_interval 秒に1回までになる。
+# ---------------------------------------------------------
+
+def _slot(min_interval, now):
+    slot = int(now // min_interval)
+    # 枠が終わるまでキーを残す（少し余裕を持たせる）
+    return f'geocoder:slot:{slot}', (slot + 1) * min_interval - now, min_interval * 2 + 1
+
+
+def reserve_slot(min_interval, clock=time.time):
+    """枠が取れたら 0、取れなければ次の枠までの秒数を返す"""
+    if min_interval <= 0:
+        return 0
+    key, remaining, timeout = _slot(min_interval, clock())
+    return 0 if cache.add(key, 1, timeout=timeout) else remaining
+
+
+async def areserve_slot(min_interval, clock=time.time):
+    if min_interval <= 0:
+        return 0
+    key, remaining, timeout = _slot(min_interval, clock())
+    return 0 if await cache.aadd(key, 1, timeout=timeout) else remaining
+
+
+# ---------------------------------------------------------
+# リクエスト中の住所検索（非同期ビュー api/geocode/ から呼ぶ）
+# ---------------------------------------------------------
+
+async def await_slot(min_interval=None, max_wait=None, clock=time.time):
+    """呼び出し枠が空くまで待つ（イベントループは止めない）。max_wait 秒で取れなければ TransientGeocodingError"""
+    if min_interval is None:
+        min_interval = getattr(settings, 'GEOCODER_MIN_INTERVAL', 1.0)
+    if max_wait is None:
+        max_wait = getattr(settings, 'GEOCODER_MAX_WAIT', 5.0)
+    deadline = clock() + max_wait
+    while True:
+        remaining = await areserve_slot(min_interval, clock)
+        if not remaining:
+            return
+        if clock() + remaining > deadline:
+            raise TransientGeocodingError('住所検索の呼び出し枠が空いていません')
+        await asyncio.sleep(remaining)
+
+
+async def alookup(address, geocoder=None):
+    """住所の座標をキャッシュから、無ければ外部APIから取得する。戻り値は (GeocodeCache, キャッシュにあったか)"""
+    key = normalize_address(address)
+    entry = await GeocodeCache.objects.filter(address_key=key).afirst()
+    if entry is not None:
+        return entry, True
+    if geocoder is None:
+        geocoder = get_geocoder()
+    await await_slot()
+    coords = await geocoder.ageocode(address)
+    entry = await sync_to_async(store_result)(key, coords)
+    return entry, False
+
+
+# ---------------------------------------------------------
+# リクエスト外での一括変換（geocode_properties コマンドから呼ぶ）
+# ---------------------------------------------------------
+
+class RateLimiter:
+    """外部APIの利用規約に合わせ、呼び出し間隔を min_interval 秒以上あける
+
+    このプロセスの中の間隔に加えて、全プロセス共通の呼び出し枠（reserve_slot）も取る。
+    """
+
+    def __init__(self, min_interval, clock=time.monotonic, sleep=time.sleep):
+        self.min_interval = min_interval
+        self.clock = clock
+        self.sleep = sleep
+        self._last = None
+
+    def wait(self):
+        if self._last is not None:
+            remaining = self.min_interval - (self.clock() - self._last)
+            if remaining > 0:
+                self.sleep(remaining)
+        while True:
+            remaining = reserve_slot(self.min_interval)
+            if not remaining:
+                break
+            self.sleep(remaining)
+        self._last = self.clock()
+
+
+def geocode_with_retries(geocoder, address, limiter, max_retries=3, backoff=2.0, sleep=time.sleep):
+    """一時的な失敗は指数バックオフで再試行する。再試行し尽くしたら例外をそのまま投げる"""
+    attempt = 0
+    while True:
+        limiter.wait()
+        try:
+            return geocoder.geocode(address)
+        except TransientGeocodingError:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            sleep(backoff ** attempt)
+
+
+def geocode_pending(limit=100, geocoder=None, min_interval=None, max_retries=3, sleep=time.sleep):
+    """未変換の物件をまとめて座標に変換する
+
+    同じ住所の物件はまとめて1回だけ問い合わせ、結果はキャッシュに保存する。
+    戻り値は件数の集計（cache_hits / geocoded / not_found / errors / updated）。
+    """
+    if geocoder is None:
+        geocoder = get_geocoder()
+    if min_interval is None:
+        min_interval = getattr(settings, 'GEOCODER_MIN_INTERVAL', 1.0)
+    limiter = RateLimiter(min_interval, sleep=sleep)
+    stats = {'cache_hits': 0, 'geocoded': 0, 'not_found': 0, 'errors': 0, 'updated': 0}
+
+    # 住所キーごとに物件をまとめる。
+    # 一時的な失敗で残った物件が毎回 limit を埋めないよう、試みていないもの・試みたのが古いものから取る
+    pending = {}
+    queryset = (
+        Property.objects.filter(geocode_status=GEOCODE_PENDING)
+        .order_by(F('geocode_attempted_at').asc(nulls_first=True), 'pk')
+        .values_list('pk', 'address')
+    )
+    for pk, address in queryset[:limit]:
+        pending.setdefault(normalize_address(address), (address, []))[1].append(pk)
+
+    cached = {e.address_key: e for e in GeocodeCache.objects.filter(address_key__in=list(pending))}
+    changed = []
+
+    for key, (address, pks) in pending.items():
+        entry = cached.get(key)
+        if entry is not None:
+            stats['cache_hits'] += 1
+        else:
+            try:
+                coords = geocode_with_retries(geocoder, address, limiter, max_retries=max_retries, sleep=sleep)
+            except TransientGeocodingError:
+                # 次回の実行で再挑戦するので pending のまま残す（順番は後ろに回る）
+                stats['errors'] += 1
+                Property.objects.filter(pk__in=pks).update(geocode_attempted_at=timezone.now())
+                continue
+            except GeocodingError:
+                stats['errors'] += 1
+                if Property.objects.filter(pk__in=pks).update(geocode_status=GEOCODE_FAILED):
+                    changed.extend(pks)
+                continue
+            entry = store_result(key, coords)
+            stats['geocoded' if entry.found else 'not_found'] += 1
+
+        updated = Property.objects.filter(pk__in=pks, geocode_status=GEOCODE_PENDING).update(
+            latitude=entry.latitude,
+            longitude=entry.longitude,
+            geocode_status=GEOCODE_DONE if entry.found else GEOCODE_FAILED,
+        )
+        if updated:
+            stats['updated'] += updated
+            changed.extend(pks)
+
+    _publish_geocoded(changed)
+    return stats
+
+
+def _publish_geocoded(property_ids):
+    # update() はシグナルを出さないので、座標が入ったグループのキャッシュと画面はここで更新する
+    if not property_ids:
+        return
+    properties = list(Property.objects.filter(pk__in=property_ids))
+    for group_id in {prop.group_id for prop in properties}:
+        bump_group_version(group_id)
+    for prop in properties:
+        events.publish(prop.group_id, 'property.updated', events.property_event_data(prop))
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+import weakref
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+# ---------------------------------------------------------
+# 外部APIへのHTTPクライアント（ジオコーディング・駅データAPIで共有）
+#   接続を使い回す（keep-alive）プールを1つだけ持ち、同時接続数とタイムアウトをここで決める。
+#   同時接続数を超えたリクエストは、プールが空くまで待つ（HTTP_POOL_TIMEOUT 秒まで）。
+#   httpx.AsyncClient はイベントループに結びつくので、ループごとに1つ作る。
+#   ただし WSGI（gthread）の非同期ビューは async_to_sync でリクエストごとに新しいループで動くので、
+#   そこで AsyncClient を作ると接続を使い回せず、閉じられないまま捨てられる。
+#   非同期ビューからは aget を使う。ASGI サーバーのループ（asgi.py で keep_clients_on_loop を呼ぶ）でだけ
+#   AsyncClient を共有し、それ以外は同期の Client を別スレッドで使う。
+# ---------------------------------------------------------
+
+_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+_server_loops = weakref.WeakSet()
+_client = None
+
+
+def _options():
+    return {
+        'limits': httpx.Limits(
+            max_connections=getattr(settings, 'HTTP_MAX_CONNECTIONS', 20),
+            max_keepalive_connections=getattr(settings, 'HTTP_MAX_KEEPALIVE_CONNECTIONS', 10),
+            keepalive_expiry=30.0,
+        ),
+        'timeout': httpx.Timeout(
+            getattr(settings, 'HTTP_TIMEOUT', 10.0),
+            connect=getattr(settings, 'HTTP_CONNECT_TIMEOUT', 5.0),
+            pool=getattr(settings, 'HTTP_POOL_TIMEOUT', 30.0),
+        ),
+        'headers': {'User-Agent': getattr(settings, 'GEOCODER_USER_AGENT', 'dousei-map')},
+        'follow_redirects': True,
+    }
+
+
+def get_async_client():
+    """実行中のイベントループで共有する AsyncClient"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(**_options())
+            _async_clients[loop] = client
+    return client
+
+
+def keep_clients_on_loop():
+    """実行中のループが、プロセスが終わるまで動き続ける（ASGI サーバーの）ループだと記録する"""
+    loop = asyncio.get_running_loop()
+    if loop not in _server_loops:
+        with _lock:
+            _server_loops.add(loop)
+
+
+async def aget(url, **kwargs):
+    """非同期ビューから GET する。リクエストごとのループでは同期の Client（プール共有）を使う"""
+    if asyncio.get_running_loop() in _server_loops:
+        return await get_async_client().get(url, **kwargs)
+    return await sync_to_async(get_client().get, thread_sensitive=False)(url, **kwargs)
+
+
+async def close_async_client():
+    """実行中のイベントループの AsyncClient を閉じる（asyncio.run で使い終わったときなど）"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+
+def get_client():
+    """同期コード（管理コマンド・WSGIのビュー）で共有する Client（スレッドセーフ）"""
+    global _client
+    with _lock:
+        if _client is None or _client.is_closed:
+            _client = httpx.Client(**_options())
+        return _client
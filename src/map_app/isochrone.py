@@ -0,0 +1,224 @@
+import hashlib
+import heapq
+import math
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from .caching import station_data_version
+from .models import Station
+from .spatial import EARTH_RADIUS_M, haversine
+
+# ---------------------------------------------------------
+# 到達圏（アイソクロン）
+#   駅を頂点、路線の隣り合う駅（sort_order 順）と同名駅どうしの乗り換えを辺にしたグラフで、
+#   グループの選んだ駅すべてを出発点とする Dijkstra を1回だけ行い、各駅までの所要時間を出す。
+#   駅から先は徒歩で広がるとして、地図を格子に区切って「何分圏か」を塗り分ける。
+# ---------------------------------------------------------
+
+# 電車の表定速度（停車時間込み、m/分）と、1駅ごとの停車・加減速の上乗せ（分）
+TRAIN_SPEED_M_PER_MIN = 35000 / 60
+STOP_PENALTY_MIN = 0.5
+# 同名駅での乗り換え（ホーム移動・待ち時間、分）
+TRANSFER_MIN = 5.0
+# 徒歩（m/分）
+WALK_SPEED_M_PER_MIN = 80.0
+# 格子1マスの大きさ（m）
+GRID_CELL_M = 250.0
+
+_M_PER_DEG_LAT = math.pi * EARTH_RADIUS_M / 180
+
+
+class StationGraph:
+    """駅のグラフ（隣接リストは CSR 形式の配列で持つ）"""
+
+    def __init__(self, rows):
+        """rows: (id, 路線id, 並び順, 駅名, 緯度, 経度) のリスト"""
+        rows = sorted(rows, key=lambda r: (r[1], r[2], r[0]))
+        self.ids = np.array([r[0] for r in rows], dtype=np.int64)
+        self.names = [r[3] for r in rows]
+        self.lats = np.array([r[4] for r in rows], dtype=np.float64)
+        self.lons = np.array([r[5] for r in rows], dtype=np.float64)
+        self.position = {station_id: i for i, station_id in enumerate(self.ids.tolist())}
+
+        src, dst, weight = [], [], []
+
+        # 1. 同じ路線で隣り合う駅（往復）
+        line_ids = np.array([r[1] for r in rows], dtype=np.int64)
+        if len(rows) > 1:
+            same_line = np.nonzero(line_ids[1:] == line_ids[:-1])[0]
+            a, b = same_line, same_line + 1
+            minutes = haversine(self.lats[a], self.lons[a], self.lats[b], self.lons[b]) / TRAIN_SPEED_M_PER_MIN + STOP_PENALTY_MIN
+            src += a.tolist() + b.tolist()
+            dst += b.tolist() + a.tolist()
+            weight += minutes.tolist() * 2
+
+        # 2. 同名駅どうしの乗り換え
+        by_name = {}
+        for i, name in enumerate(self.names):
+            by_name.setdefault(name, []).append(i)
+        for members in by_name.values():
+            for i in members:
+                for j in members:
+                    if i != j:
+                        src.append(i)
+                        dst.append(j)
+                        weight.append(TRANSFER_MIN)
+
+        order = np.argsort(np.array(src, dtype=np.int64), kind='stable')
+        src = np.array(src, dtype=np.int64)[order]
+        self.indices = np.array(dst, dtype=np.int64)[order]
+        self.weights = np.array(weight, dtype=np.float64)[order]
+        self.indptr = np.searchsorted(src, np.arange(len(rows) + 1))
+
+        # 探索ループでは Python のリストの方が速い
+        self._indptr = self.indptr.tolist()
+        self._indices = self.indices.tolist()
+        self._weights = self.weights.tolist()
+
+    @classmethod
+    def from_db(cls):
+        return cls(list(Station.objects.values_list('id', 'line_id', 'sort_order', 'name', 'latitude', 'longitude')))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def edge_count(self):
+        return len(self.indices)
+
+    def travel_times(self, sources, limit=math.inf):
+        """複数の出発駅（配列上の番号）からの最短所要時間（分）。limit を超える駅は inf"""
+        n = len(self)
+        times = [math.inf] * n
+        heap = []
+        for s in set(sources):
+            times[s] = 0.0
+            heap.append((0.0, s))
+        heapq.heapify(heap)
+
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+        while heap:
+            t, u = heapq.heappop(heap)
+            if t > times[u]:
+                continue
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                nt = t + weights[k]
+                if nt < times[v] and nt <= limit:
+                    times[v] = nt
+                    heapq.heappush(heap, (nt, v))
+        return np.array(times, dtype=np.float64)
+
+
+def reachable_grid(graph, times, budget, bands, cell_m=GRID_CELL_M):
+    """各駅から残り時間ぶん歩いて届く範囲を格子で塗り、マスごとの「何番目の時間帯か」を返す
+
+    戻り値の cells は行ごとの連続区間 [行, 開始列, 長さ, 時間帯の番号]（ランレングス）。
+    """
+    reached = np.nonzero(times <= budget)[0]
+    if len(reached) == 0:
+        return None
+
+    lats, lons = graph.lats[reached], graph.lons[reached]
+    remaining = budget - times[reached]
+    radius_m = remaining * WALK_SPEED_M_PER_MIN
+
+    # 東京程度の範囲なので、中心緯度での正距円筒近似で距離を出す
+    m_per_deg_lon = _M_PER_DEG_LAT * math.cos(math.radians(float(lats.mean())))
+    dlat, dlon = cell_m / _M_PER_DEG_LAT, cell_m / m_per_deg_lon
+    lat0 = float((lats - radius_m / _M_PER_DEG_LAT).min())
+    lon0 = float((lons - radius_m / m_per_deg_lon).min())
+    n_rows = int(math.ceil((float((lats + radius_m / _M_PER_DEG_LAT).max()) - lat0) / dlat)) + 1
+    n_cols = int(math.ceil((float((lons + radius_m / m_per_deg_lon).max()) - lon0) / dlon)) + 1
+
+    grid = np.full((n_rows, n_cols), np.inf)
+    for lat, lon, t, r in zip(lats, lons, times[reached], radius_m):
+        # その駅から歩いて届くマスだけを切り出して更新する
+        r0 = max(int((lat - r / _M_PER_DEG_LAT - lat0) / dlat), 0)
+        r1 = min(int((lat + r / _M_PER_DEG_LAT - lat0) / dlat) + 1, n_rows - 1)
+        c0 = max(int((lon - r / m_per_deg_lon - lon0) / dlon), 0)
+        c1 = min(int((lon + r / m_per_deg_lon - lon0) / dlon) + 1, n_cols - 1)
+        cell_lats = lat0 + (np.arange(r0, r1 + 1) + 0.5) * dlat
+        cell_lons = lon0 + (np.arange(c0, c1 + 1) + 0.5) * dlon
+        dy = (cell_lats[:, None] - lat) * _M_PER_DEG_LAT
+        dx = (cell_lons[None, :] - lon) * m_per_deg_lon
+        walk = np.sqrt(dx * dx + dy * dy) / WALK_SPEED_M_PER_MIN
+        sub = grid[r0:r1 + 1, c0:c1 + 1]
+        np.minimum(sub, t + walk, out=sub)
+
+    band_of = np.searchsorted(np.asarray(bands, dtype=np.float64), grid, side='left')
+    band_of[grid > budget] = -1
+
+    cells = []
+    for row in range(n_rows):
+        values = band_of[row]
+        # 値が変わる位置で区切ってランレングスにする
+        edges = np.flatnonzero(np.diff(values)) + 1
+        starts = np.concatenate(([0], edges))
+        ends = np.concatenate((edges, [n_cols]))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if values[start] >= 0:
+                cells.append([row, start, end - start, int(values[start])])
+
+    return {
+        'origin': {'lat': lat0, 'lon': lon0},
+        'cell': {'lat': dlat, 'lon': dlon},
+        'shape': [n_rows, n_cols],
+        'cells': cells,
+    }
+
+
+_graph_lock = threading.Lock()
+_graph = None
+_graph_version = None
+
+
+def get_station_graph():
+    """プロセス内で共有する StationGraph（駅データのバージョンが変わったら作り直す）"""
+    global _graph, _graph_version
+    version = station_data_version()
+    if _graph is None or _graph_version != version:
+        with _graph_lock:
+            if _graph is None or _graph_version != version:
+                _graph = StationGraph.from_db()
+                _graph_version = version
+    return _graph
+
+
+def reset_station_graph():
+    global _graph, _graph_version
+    with _graph_lock:
+        _graph = None
+        _graph_version = None
+
+
+def compute_isochrone(graph, station_ids, budget, bands):
+    bands = sorted(set(bands) | {budget})
+    positions = [graph.position[i] for i in station_ids if i in graph.position]
+    times = graph.travel_times(positions, limit=budget)
+    reached = np.nonzero(times <= budget)[0]
+    return {
+        'budget': budget,
+        'bands': list(bands),
+        'stations': [
+            {'id': int(graph.ids[i]), 'name': graph.names[i], 'minutes': round(float(times[i]), 1)}
+            for i in reached[np.argsort(times[reached], kind='stable')]
+        ],
+        'grid': reachable_grid(graph, times, budget, bands),
+    }
+
+
+def get_isochrone(station_ids, budget, bands):
+    """(駅の組, 時間, 時間帯) ごとにキャッシュした到達圏を返す"""
+    station_ids = sorted(set(station_ids))
+    version = station_data_version()
+    raw = f"{version}:{budget}:{','.join(map(str, bands))}:{','.join(map(str, station_ids))}"
+    key = f'isochrone:{hashlib.md5(raw.encode()).hexdigest()}'
+    result = cache.get(key)
+    if result is None:
+        result = compute_isochrone(get_station_graph(), station_ids, budget, bands)
+        cache.set(key, result, timeout=getattr(settings, 'ISOCHRONE_CACHE_TIMEOUT', 60 * 60 * 24))
+    return result
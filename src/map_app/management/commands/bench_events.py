@@ -0,0 +1,90 @@
+import asyncio
+import json
+import threading
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand
+from map_app.events import EventStream, get_broker, make_event
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'リアルタイム通知（SSE）の負荷試験。多数の接続を張り、イベントが全員に届くまでの時間をJSONで出力します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', type=int, default=2000, help='同時接続数')
+        parser.add_argument('--groups', type=int, default=100, help='接続を振り分けるグループ数')
+        parser.add_argument('--events', type=int, default=20, help='グループごとに送るイベント数')
+        parser.add_argument('--interval', type=float, default=0.01, help='イベントを送る間隔（秒）')
+
+    def handle(self, *args, **options):
+        result = asyncio.run(self.run(**{k: options[k] for k in ('subscribers', 'groups', 'events', 'interval')}))
+        self.stdout.write(json.dumps(result, ensure_ascii=False, indent=2))
+
+    async def run(self, subscribers, groups, events, interval):
+        broker = get_broker()
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+
+        started = time.perf_counter()
+        subscriptions = [await broker.subscribe(-(i % groups) - 1) for i in range(subscribers)]
+        subscribe_ms = (time.perf_counter() - started) * 1000
+        per_subscriber = (tracemalloc.get_traced_memory()[0] - base) / max(subscribers, 1)
+        # tracemalloc は遅いので、配信の計測の前に止める
+        tracemalloc.stop()
+
+        latencies = []
+
+        async def consume(subscription):
+            # ビューと同じ EventStream で SSE のバイト列まで作って読む
+            received = 0
+            stream = EventStream(subscription, heartbeat=60)
+            async for chunk in stream:
+                if not chunk.startswith(b'id: ') or b'event: bench' not in chunk:
+                    continue
+                data = json.loads(chunk.split(b'data: ', 1)[1])
+                latencies.append((time.perf_counter() - data['sent']) * 1000)
+                received += 1
+                if received == events:
+                    break
+            stream.close()
+
+        def publish():
+            # 同期のビュー（別スレッド）から送るのと同じ経路
+            for seq in range(events):
+                for g in range(groups):
+                    group_id = -g - 1
+                    broker.publish(group_id, make_event(group_id, 'bench', {'seq': seq, 'sent': time.perf_counter()}))
+                time.sleep(interval)
+
+        consumers = [asyncio.create_task(consume(s)) for s in subscriptions]
+        started = time.perf_counter()
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        await asyncio.gather(*consumers)
+        elapsed = time.perf_counter() - started
+        publisher.join()
+
+        ordered = sorted(latencies)
+        return {
+            'benchmark': 'events',
+            'broker': type(broker).__name__,
+            'subscribers': subscribers,
+            'groups': groups,
+            'events_per_group': events,
+            'deliveries': len(latencies),
+            'subscribe_ms': round(subscribe_ms, 3),
+            'deliveries_per_sec': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                'p50': round(percentile(ordered, 0.50), 3),
+                'p95': round(percentile(ordered, 0.95), 3),
+                'p99': round(percentile(ordered, 0.99), 3),
+                'max': round(ordered[-1], 3),
+            },
+            'memory_per_subscriber_bytes': round(per_subscriber),
+        }
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import httpx
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+
+# 比べるサーバー
+#   wsgi: gunicorn の同期ワーカー（--workers の数）
+#   asgi: uvicorn（非同期ビューがイベントループ上でそのまま動く。--workers の数）
+#   bare: 以前の Dockerfile と同じ、設定なしの gunicorn（同期ワーカー1つ）
+#   prod / prod-uvicorn: config/gunicorn_conf.py の本番設定（gthread / uvicorn ワーカー。数は CPU 数から決まり、--workers は使わない）
+SERVERS = {
+    'wsgi': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', 'config.wsgi:application',
+        '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--log-level', 'warning',
+    ],
+    'asgi': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', 'config.asgi:application',
+        '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers), '--log-level', 'warning',
+    ],
+    'bare': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', 'config.wsgi:application', '--bind', f'127.0.0.1:{port}', '--log-level', 'warning',
+    ],
+    'prod': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', '-c', 'config/gunicorn_conf.py',
+        '--bind', f'127.0.0.1:{port}', '--log-level', 'warning',
+    ],
+}
+SERVERS['prod-uvicorn'] = SERVERS['prod']
+SERVER_ENV = {'prod-uvicorn': {'GUNICORN_WORKER_CLASS': 'uvicorn'}}
+
+
+def percentile(ordered, q):
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)] if ordered else None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def session_cookie(username):
+    """ユーザーとしてログイン済みのセッションを作り、Cookie を返す"""
+    try:
+        user = User.objects.get(username=username)
+    except User.DoesNotExist:
+        raise CommandError(f'ユーザー {username} が見つかりません')
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return {settings.SESSION_COOKIE_NAME: session.session_key}
+
+
+async def load(base_url, paths, cookies, concurrency, total):
+    """concurrency 本の接続で、paths を順番に合計 total 回リクエストする"""
+    latencies, statuses = [], Counter()
+    counter = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, cookies=cookies, limits=limits, timeout=30.0) as client:
+        async def worker():
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(paths[i % len(paths)])
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                    continue
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(total / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(ordered, 0.50), 3) if ordered else None,
+            'p90': round(percentile(ordered, 0.90), 3) if ordered else None,
+            'p99': round(percentile(ordered, 0.99), 3) if ordered else None,
+            'max': round(ordered[-1], 3) if ordered else None,
+        },
+        'statuses': {str(k): v for k, v in sorted(statuses.items(), key=str)},
+    }
+
+
+class Command(BaseCommand):
+    help = 'HTTP の負荷をかけてスループットと遅延をJSONで出力します。--compare で gunicorn(WSGI) と uvicorn(ASGI) を比べます'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='負荷をかけるサーバー（例: http://127.0.0.1:8000）。--compare なら不要')
+        parser.add_argument('--compare', nargs='*', choices=sorted(SERVERS), default=None,
+                            help='指定したサーバーをこのコマンドで起動して比べる（省略時は wsgi と asgi）')
+        parser.add_argument('--path', action='append', dest='paths', help='リクエストするパス（複数指定可。既定は /api/map/）')
+        parser.add_argument('--user', help='このユーザーとしてログインした状態で測る')
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='--compare で起動するサーバーのワーカー数')
+        parser.add_argument('--warmup', type=int, default=100, help='計測前に捨てるリクエスト数')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ['/api/map/']
+        cookies = session_cookie(options['user']) if options['user'] else {}
+
+        def run(base_url):
+            if options['warmup']:
+                asyncio.run(load(base_url, paths, cookies, min(options['concurrency'], options['warmup']), options['warmup']))
+            return asyncio.run(load(base_url, paths, cookies, options['concurrency'], options['requests']))
+
+        if options['compare'] is None:
+            if not options['url']:
+                raise CommandError('--url か --compare を指定してください')
+            results = {options['url']: run(options['url'])}
+        else:
+            results = {}
+            for name in options['compare'] or ['asgi', 'wsgi']:
+                port = free_port()
+                self.stderr.write(f"🚀 {name} を起動します（ポート {port}）")
+                env = {**os.environ, **SERVER_ENV.get(name, {})}
+                # アクセスログなどサーバーの標準出力は、結果のJSONに混ざらないよう捨てる
+                process = subprocess.Popen(
+                    SERVERS[name](port, options['workers']), cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL,
+                )
+                try:
+                    base_url = f'http://127.0.0.1:{port}'
+                    self.wait_until_ready(base_url, process)
+                    results[name] = run(base_url)
+                finally:
+                    process.terminate()
+                    process.wait(timeout=30)
+
+        self.stdout.write(json.dumps({
+            'benchmark': 'http',
+            'paths': paths,
+            'workers': options['workers'] if options['compare'] is not None else None,
+            'results': results,
+        }, ensure_ascii=False, indent=2))
+
+    def wait_until_ready(self, base_url, process, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f'サーバーが起動できませんでした（終了コード {process.returncode}）')
+            try:
+                httpx.get(base_url + '/admin/login/', timeout=1.0)
+                return
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        raise CommandError('サーバーの起動を待ちきれませんでした')
@@ -0,0 +1,80 @@
+import json
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from map_app.fixture_api import synthetic_network
+from map_app.isochrone import StationGraph, compute_isochrone
+
+
+def synthetic_rows(num_lines, stations_per_line):
+    """synthetic_network と同じ路線網を StationGraph 用の行にする（DBには書かない）"""
+    rows = []
+    for line_id, stations in enumerate(synthetic_network(num_lines, stations_per_line).values()):
+        for j, st in enumerate(stations):
+            rows.append((len(rows) + 1, line_id, j, st['name'], st['y'], st['x']))
+    return rows
+
+
+class Command(BaseCommand):
+    help = '到達圏エンジンのベンチマーク（グラフ構築・Dijkstra・格子塗り）を行い、結果をJSONで出力します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--synthetic', action='store_true', help='DBの駅ではなく、東京と同規模の架空の路線網で測る')
+        parser.add_argument('--lines', type=int, default=110)
+        parser.add_argument('--stations-per-line', type=int, default=20)
+        parser.add_argument('--sources', type=int, default=3, help='出発駅の数（グループが選ぶ駅の数）')
+        parser.add_argument('--budget', type=int, default=30)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['synthetic']:
+            graph = StationGraph(synthetic_rows(options['lines'], options['stations_per_line']))
+        else:
+            graph = StationGraph.from_db()
+        build_ms = (time.perf_counter() - started) * 1000
+
+        if len(graph) == 0:
+            self.stderr.write("❌ 駅データがありません。import_stations / load_stations を先に実行するか、--synthetic を付けてください")
+            return
+
+        rng = random.Random(options['seed'])
+        budget = options['budget']
+        bands = list(range(10, budget, 10)) + [budget]
+        ids = graph.ids.tolist()
+
+        search_ms, grid_ms, cells = [], [], []
+        for _ in range(options['repeat']):
+            sources = rng.sample(ids, min(options['sources'], len(ids)))
+            t0 = time.perf_counter()
+            times = graph.travel_times([graph.position[i] for i in sources], limit=budget)
+            t1 = time.perf_counter()
+            result = compute_isochrone(graph, sources, budget, bands)
+            t2 = time.perf_counter()
+            search_ms.append((t1 - t0) * 1000)
+            # compute_isochrone は探索も含むので、探索分を差し引いて格子塗りの時間とする
+            grid_ms.append(max((t2 - t1) * 1000 - search_ms[-1], 0.0))
+            cells.append(len(result['grid']['cells']) if result['grid'] else 0)
+
+        def summary(values):
+            ordered = sorted(values)
+            return {
+                'mean': round(statistics.fmean(values), 3),
+                'p50': round(ordered[len(ordered) // 2], 3),
+                'max': round(ordered[-1], 3),
+            }
+
+        self.stdout.write(json.dumps({
+            'benchmark': 'isochrone',
+            'stations': len(graph),
+            'edges': graph.edge_count,
+            'sources': options['sources'],
+            'budget_min': budget,
+            'repeat': options['repeat'],
+            'graph_build_ms': round(build_ms, 3),
+            'dijkstra_ms': summary(search_ms),
+            'grid_ms': summary(grid_ms),
+            'grid_runs': summary(cells),
+        }, ensure_ascii=False, indent=2))
@@ -0,0 +1,140 @@
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from map_app.matching import set_like
+from map_app.models import MapGroup, Property, UserProfile
+from map_app.views import build_map_payload
+
+# 比べる設定。tuned は settings.py の SQLITE_PROFILE=tuned と同じ値を使う
+PROFILES = {
+    'default': {'options': {}, 'pragmas': {}},
+    'tuned': {'options': settings.SQLITE_TUNED_OPTIONS, 'pragmas': settings.SQLITE_TUNED_PRAGMAS},
+}
+
+def use_database(path, profile):
+    """このプロセスの接続先を、ベンチマーク用のDBファイルと設定に切り替える"""
+    connections.close_all()
+    db = connections['default'].settings_dict
+    db['NAME'] = path
+    db['OPTIONS'] = dict(PROFILES[profile]['options'])
+    settings.SQLITE_PRAGMAS = PROFILES[profile]['pragmas']
+
+
+def percentile(ordered, q):
+    return round(ordered[min(int(len(ordered) * q), len(ordered) - 1)], 3) if ordered else None
+
+
+def worker(role, path, profile, group_id, seconds, seed, results):
+    use_database(path, profile)
+    rng = random.Random(seed)
+    group = MapGroup.objects.get(pk=group_id)
+    users = list(User.objects.filter(profile__group=group))
+    property_ids = list(Property.objects.filter(group=group).values_list('pk', flat=True))
+
+    latencies, errors = [], 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            if role == 'reader':
+                # map_view が地図データを作るときと同じ読み込み
+                build_map_payload(group)
+            elif rng.random() < 0.7:
+                # toggle_like と同じ書き込み
+                set_like(Property(pk=rng.choice(property_ids), group_id=group.pk), rng.choice(users))
+            else:
+                # add_property と同じ書き込み
+                Property.objects.create(
+                    group=group, name='ベンチ物件', address=f'東京都新宿区{rng.randint(1, 9999)}',
+                    rent='10万円', latitude=35.6 + rng.random() * 0.2, longitude=139.6 + rng.random() * 0.3,
+                )
+        except OperationalError:
+            # "database is locked"
+            errors += 1
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    connections.close_all()
+    results.put((role, latencies, errors))
+
+
+class Command(BaseCommand):
+    help = 'SQLite の同時書き込み・読み込みのベンチマーク（いいね・物件追加と地図データの読み込みを並列に実行）。結果をJSONで出力します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', choices=[*PROFILES, 'both'], default='both')
+        parser.add_argument('--writers', type=int, default=4, help='書き込みプロセス数')
+        parser.add_argument('--readers', type=int, default=4, help='読み込みプロセス数')
+        parser.add_argument('--seconds', type=float, default=5.0, help='計測時間')
+        parser.add_argument('--properties', type=int, default=200, help='最初に入れておく物件数')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('SQLite の設定で実行してください')
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise CommandError('fork が使える環境（Linux など）で実行してください')
+        original = dict(connections['default'].settings_dict)
+        original_pragmas = getattr(settings, 'SQLITE_PRAGMAS', {})
+        profiles = list(PROFILES) if options['profile'] == 'both' else [options['profile']]
+
+        report = {'benchmark': 'sqlite', 'writers': options['writers'], 'readers': options['readers'],
+                  'seconds': options['seconds'], 'profiles': {}}
+        try:
+            for profile in profiles:
+                with tempfile.TemporaryDirectory() as tmp:
+                    path = os.path.join(tmp, 'bench.sqlite3')
+                    report['profiles'][profile] = self.run_profile(path, profile, options)
+        finally:
+            connections.close_all()
+            connections['default'].settings_dict.update(original)
+            settings.SQLITE_PRAGMAS = original_pragmas
+        self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+
+    def run_profile(self, path, profile, options):
+        use_database(path, profile)
+        call_command('migrate', verbosity=0)
+        group = MapGroup.objects.create(name='ベンチ', password='bench')
+        for i in range(8):
+            UserProfile.objects.create(user=User.objects.create(username=f'bench{i}'), group=group)
+        Property.objects.bulk_create([
+            Property(group=group, name=f'物件{i}', address=f'住所{i}', rent='10万円',
+                     latitude=35.6 + i / 10000, longitude=139.7)
+            for i in range(options['properties'])
+        ])
+        connections.close_all()
+
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        roles = ['writer'] * options['writers'] + ['reader'] * options['readers']
+        processes = [
+            context.Process(target=worker, args=(role, path, profile, group.pk, options['seconds'], i, results))
+            for i, role in enumerate(roles)
+        ]
+        for process in processes:
+            process.start()
+        collected = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        summary = {}
+        for role in ('writer', 'reader'):
+            latencies = sorted(l for r, ls, _ in collected if r == role for l in ls)
+            summary[f'{role}s'] = {
+                'ops': len(latencies),
+                'ops_per_sec': round(len(latencies) / options['seconds'], 1),
+                'locked_errors': sum(e for r, _, e in collected if r == role),
+                'latency_ms': {
+                    'p50': percentile(latencies, 0.50),
+                    'p99': percentile(latencies, 0.99),
+                    'max': round(latencies[-1], 3) if latencies else None,
+                },
+            }
+        return summary
@@ -0,0 +1,148 @@
+import json
+import os
+import random
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client, override_settings
+from django.urls import reverse
+from map_app import events
+from map_app.benchmarks import make_group, measure, measure_import_stations
+from map_app.fixture_api import synthetic_network
+from map_app.models import Property
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        '一時的なDBに架空の路線網と大きなグループを作り、import_stations と主要なビュー'
+        '（地図・駅の選択・いいね）の時間・SQLの回数・メモリのピークをJSONで出力します。'
+        '同時接続での性能は bench_http で測ります'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='グループの物件数（複数指定可）')
+        parser.add_argument('--members', type=int, default=20, help='グループのメンバー数（リクエストは全員で順番に送る）')
+        parser.add_argument('--like-ratio', type=float, default=0.3, help='各メンバーが各物件にいいねする割合')
+        parser.add_argument('--lines', type=int, default=110)
+        parser.add_argument('--stations-per-line', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--workers', type=int, default=4, help='import_stations の同時取得数')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='結果のJSONを書き出すファイル（前回の結果と比べる用）')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('SQLite の設定で実行してください（一時的なDBファイルを作って測ります）')
+        original = dict(connections['default'].settings_dict)
+        # 本番と共有しているキャッシュ・ブローカーに書き込まないよう、プロセス内のものに切り替える
+        overrides = override_settings(
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bench-suite'}},
+            EVENT_BROKER='map_app.events.InProcessBroker',
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+        )
+        try:
+            with tempfile.TemporaryDirectory() as tmp, overrides:
+                events.reset_broker()
+                connections.close_all()
+                connections['default'].settings_dict['NAME'] = os.path.join(tmp, 'bench.sqlite3')
+                call_command('migrate', verbosity=0)
+                report = self.run_suite(options)
+        finally:
+            connections.close_all()
+            connections['default'].settings_dict.update(original)
+            events.reset_broker()
+
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output + '\n')
+            self.stderr.write(f"📝 {options['output']} に書き出しました")
+        self.stdout.write(output)
+
+    def run_suite(self, options):
+        rng = random.Random(options['seed'])
+        network = synthetic_network(options['lines'], options['stations_per_line'])
+        self.stderr.write(f"🚉 import_stations（{options['lines']} 路線）を測ります")
+        report = {
+            'benchmark': 'suite',
+            'revision': git_revision(),
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'options': {k: options[k] for k in ('sizes', 'members', 'like_ratio', 'lines', 'stations_per_line', 'repeat', 'seed')},
+            'import_stations': measure_import_stations(network, repeat=min(options['repeat'], 3), workers=options['workers']),
+            'groups': {},
+        }
+        for size in options['sizes']:
+            self.stderr.write(f"🏠 物件 {size} 件のグループを測ります")
+            report['groups'][str(size)] = self.run_group(size, rng, options)
+        return report
+
+    def run_group(self, size, rng, options):
+        group, users = make_group(size, options['members'], rng, like_ratio=options['like_ratio'])
+        clients = []
+        for user in users:
+            client = Client(raise_request_exception=False)
+            client.force_login(user)
+            clients.append(client)
+        turn = iter(range(10 ** 9))
+
+        def client():
+            # メンバー全員が順番にリクエストする
+            return clients[next(turn) % len(clients)]
+
+        property_id = Property.objects.filter(group=group).values_list('pk', flat=True).first()
+        selected = set(group.selected_stations.values_list('pk', flat=True))
+        station_id = next(iter(selected), None)
+        toggle = iter(range(10 ** 9))
+
+        def get(url):
+            return lambda: client().get(url).status_code
+
+        def post_like():
+            return client().post(reverse('toggle_like', args=[property_id])).status_code
+
+        def post_station():
+            # 同じ駅を外す・選ぶを交互に行う（選択駅の数を保つ）
+            key = 'remove' if next(toggle) % 2 == 0 else 'add'
+            return client().post(reverse('add_station'), {key: [station_id]}, HTTP_ACCEPT='application/json').status_code
+
+        # 地図は枠（?mode=shell）と、画面側が取りに行く列指向のデータ（map_payload_compact）を測る
+        shell_url = reverse('index') + '?mode=shell'
+        endpoints = {
+            'map_view.shell.cold': (get(shell_url), cache.clear),
+            'map_view.shell.warm': (get(shell_url), None),
+            'map_payload_compact.cold': (get(reverse('map_payload_compact')), cache.clear),
+            'map_payload_compact.warm': (get(reverse('map_payload_compact')), None),
+            'map_payload.cold': (get(reverse('map_payload')), cache.clear),
+            'map_payload.warm': (get(reverse('map_payload')), None),
+            'add_station.get': (get(reverse('add_station')), None),
+            'add_station.post': (post_station, None),
+            'toggle_like': (post_like, None),
+        }
+        results = {'properties': size, 'members': len(users), 'likes': Property.likes.through.objects.filter(property__group=group).count()}
+        for name, (func, setup) in endpoints.items():
+            if name == 'add_station.post' and station_id is None:
+                continue
+            measured, statuses = measure(func, repeat=options['repeat'], setup=setup)
+            # エラーの応答の時間を測っても意味がないので、失敗したら結果を出さずに止める
+            failed = sorted({s for s in statuses if s >= 400})
+            if failed:
+                raise CommandError(f"{name} が {', '.join(map(str, failed))} を返しました（物件 {size} 件）")
+            measured['statuses'] = {str(s): statuses.count(s) for s in sorted(set(statuses))}
+            results[name] = measured
+        return results
@@ -0,0 +1,27 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from map_app.travel_matrix import build_matrix_from_db
+
+
+class Command(BaseCommand):
+    help = '全駅間の所要時間の行列を作り、メモリマップ用のファイル（uint16 の .npy、駅の対応も同じファイルに入れる）に書き出します（import_stations の後に実行）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=None, help='書き出し先（省略時は settings.TRAVEL_MATRIX_PATH）')
+        parser.add_argument('--weight', choices=['time', 'hops'], default='time', help='time: 所要時間（秒。物件ランキングの通勤時間に使う） / hops: 駅数')
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.TRAVEL_MATRIX_PATH
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        started = time.perf_counter()
+        size = build_matrix_from_db(path, weight=options['weight'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"🧮 {size} 駅（同名駅をまとめた数）×{size} の行列を {path} に書き出しました"
+            f"（{size * size * 2 / 1024 / 1024:.1f} MB, {elapsed:.1f} 秒）"
+        ))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from map_app.station_data import export_snapshot
+
+
+class Command(BaseCommand):
+    help = '路線・駅データをスナップショットファイル（列指向JSON、.gz なら圧縮）に書き出します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='書き出し先（例: stations.json / stations.json.gz）')
+
+    def handle(self, *args, **options):
+        lines, stations = export_snapshot(options['path'])
+        self.stdout.write(self.style.SUCCESS(f"💾 {lines} 路線・{stations} 駅を {options['path']} に書き出しました"))
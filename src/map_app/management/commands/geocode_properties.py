@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from map_app.geocoding import geocode_pending
+
+
+class Command(BaseCommand):
+    help = '未変換の物件の住所を座標に変換します（キャッシュ済みの住所は外部APIを呼びません）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='1回の実行で処理する物件数')
+        parser.add_argument('--interval', type=float, default=None, help='APIの呼び出し間隔（秒）。省略時は settings.GEOCODER_MIN_INTERVAL')
+        parser.add_argument('--retries', type=int, default=3, help='タイムアウト等の一時的な失敗の再試行回数')
+        parser.add_argument('--loop', action='store_true', help='ワーカーとして常駐し、新しい物件を待ち続ける')
+        parser.add_argument('--poll', type=float, default=5.0, help='--loop 時に pending が無いときの待機秒数')
+
+    def handle(self, *args, **options):
+        while True:
+            stats = geocode_pending(
+                limit=options['limit'],
+                min_interval=options['interval'],
+                max_retries=options['retries'],
+            )
+            if stats['updated'] or stats['errors']:
+                self.stdout.write(
+                    f"📍 {stats['updated']} 件の物件を更新しました "
+                    f"(キャッシュ: {stats['cache_hits']} / 新規取得: {stats['geocoded']} / "
+                    f"見つからず: {stats['not_found']} / エラー: {stats['errors']})"
+                )
+            if not options['loop']:
+                break
+            # 処理しきれなかった分があればすぐ次へ、無ければ少し待つ
+            if stats['updated'] < options['limit']:
+                time.sleep(options['poll'])
+
+        self.stdout.write(self.style.SUCCESS("✨ ジオコーディングが完了しました"))
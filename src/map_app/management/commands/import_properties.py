@@ -0,0 +1,67 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from map_app import bulk_import
+from map_app.geocoding import geocode_pending
+from map_app.models import MapGroup
+
+
+class Command(BaseCommand):
+    help = 'CSV / JSONL の物件リストをグループに一括登録します（列: name, address, rent）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='読み込むファイル（- なら標準入力）')
+        parser.add_argument('--group', required=True, help='登録先のグループ（IDか名前）')
+        parser.add_argument('--format', choices=bulk_import.FORMATS, help='省略時は拡張子から判断')
+        parser.add_argument('--batch-size', type=int, default=500, help='まとめて書き込む件数')
+        parser.add_argument('--dry-run', action='store_true', help='検証だけして書き込まない')
+        parser.add_argument('--geocode', type=int, default=0, metavar='N',
+                            help='登録後、未変換の物件を N 件ずつ座標に変換する（0 なら geocode_properties に任せる）')
+
+    def handle(self, *args, **options):
+        group = self.get_group(options['group'])
+        try:
+            fmt = options['format'] or bulk_import.guess_format(options['path'])
+            if options['path'] == '-':
+                report = bulk_import.import_properties(
+                    group, bulk_import.iter_rows(sys.stdin.buffer, fmt),
+                    batch_size=options['batch_size'], dry_run=options['dry_run'],
+                )
+            else:
+                with open(options['path'], 'rb') as f:
+                    report = bulk_import.import_properties(
+                        group, bulk_import.iter_rows(f, fmt),
+                        batch_size=options['batch_size'], dry_run=options['dry_run'],
+                    )
+        except (bulk_import.ImportFormatError, OSError) as e:
+            raise CommandError(str(e))
+
+        for error in report['errors']:
+            messages = ' / '.join(f'{field}: {" ".join(m)}' for field, m in error['errors'].items())
+            self.stderr.write(f"⚠️ {error['row']} 行目: {messages}")
+        self.stdout.write(
+            f"📥 {report['rows']} 行を {report['seconds']} 秒で処理しました（{report['rows_per_sec']} 行/秒）"
+            f"\n   登録: {report['created']}（登録できる行: {report['valid']}） / 重複: {report['duplicates']} / エラー: {report['invalid']}"
+            f" / 座標キャッシュ: {report['geocoded_from_cache']} / 変換待ち: {report['queued_for_geocoding']}"
+        )
+        if 'error' in report:
+            raise CommandError(f"{report['error']}（それまでの {report['created']} 件は登録済みです）")
+
+        if options['geocode'] and report['queued_for_geocoding'] and not options['dry_run']:
+            while True:
+                stats = geocode_pending(limit=options['geocode'])
+                self.stdout.write(f"📍 {stats['updated']} 件の物件を更新しました（エラー: {stats['errors']}）")
+                if stats['updated'] < options['geocode']:
+                    break
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('🔍 --dry-run のため書き込んでいません'))
+        else:
+            self.stdout.write(self.style.SUCCESS('✨ 一括登録が完了しました'))
+
+    def get_group(self, value):
+        groups = MapGroup.objects.filter(pk=int(value)) if value.isdigit() else MapGroup.objects.filter(name=value)
+        group = groups.first()
+        if group is None:
+            raise CommandError(f'グループ {value} が見つかりません')
+        return group
@@ -1,15 +1,92 @@
-import urllib.request
-import urllib.parse
-import json
+import asyncio
 import time
+
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from map_app.models import Line, Station
+from map_app.caching import bump_station_data_version
+from map_app.http_client import close_async_client, get_async_client, get_client
+from map_app.station_data import upsert_network
+
 
 class Command(BaseCommand):
     help = 'HeartRails Express APIを使って東京都の全駅データをインポートします'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--mode', choices=['upsert', 'reset'], default='upsert',
+            help='upsert: 既存データを残したまま追加・更新（選択済みの駅も保持）/ reset: 全削除してから1路線ずつ取り込む（旧方式）',
+        )
+        parser.add_argument('--base-url', default=None, help='APIのURL（省略時は settings.STATION_API_BASE_URL）')
+        parser.add_argument('--prefecture', default='東京都')
+        parser.add_argument('--workers', type=int, default=4, help='upsert 時に同時に取得する路線数')
+        parser.add_argument('--timeout', type=float, default=10.0, help='1リクエストのタイムアウト（秒）')
+        parser.add_argument('--prune', action='store_true', help='upsert 時、APIから消えた駅を削除する')
+
     def handle(self, *args, **options):
+        self.base_url = options['base_url'] or settings.STATION_API_BASE_URL
+        if options['mode'] == 'reset':
+            self.handle_reset(options)
+        else:
+            self.handle_upsert(options)
+
+    # ---------------------------------------------------------
+    # upsert モード：並列に取得して、bulk_create でまとめて書き込む
+    # ---------------------------------------------------------
+    def handle_upsert(self, options):
+        self.stdout.write("📡 データのダウンロードを開始します...")
+
+        try:
+            line_names, fetched = asyncio.run(self.fetch_network(options))
+        except Exception as e:
+            self.stderr.write(f"❌ 路線データの取得に失敗しました: {e}")
+            return
+
+        # 2. 取得できた分だけを短いトランザクションでまとめて書き込む
+        stations_by_line = {
+            name: [{'name': st['name'], 'lat': st['y'], 'lon': st['x']} for st in fetched[name]]
+            for name in line_names if name in fetched
+        }
+        count, pruned = upsert_network(line_names, stations_by_line, prune=options['prune'])
+
+        message = f"\n✨ 完了！ {len(fetched)}/{len(line_names)} 路線、合計 {count} 個の駅を登録・更新しました！"
+        if pruned:
+            message += f"（APIから消えた {pruned} 駅を削除）"
+        self.stdout.write(self.style.SUCCESS(message))
+
+    async def fetch_network(self, options):
+        """路線一覧と各路線の駅を、共有の HTTP クライアントで並列に取得する（トランザクションの外）"""
+        client = get_async_client()
+        # 同時に取得する路線数（接続プールの上限とは別に、相手のAPIへの負荷を抑える）
+        limit = asyncio.Semaphore(max(options['workers'], 1))
+
+        async def get(params):
+            async with limit:
+                response = await client.get(self.base_url, params=params, timeout=options['timeout'])
+            response.raise_for_status()
+            return response.json()['response']
+
+        async def get_stations(name):
+            try:
+                return name, (await get({'method': 'getStations', 'line': name}))['station']
+            except Exception as e:
+                self.stderr.write(f"  ⚠️ {name} の駅データ取得に失敗: {e}")
+                return name, None
+
+        try:
+            # 重複した路線名は1つにまとめる（upsert のキーになるため）
+            line_names = list(dict.fromkeys((await get({'method': 'getLines', 'prefecture': options['prefecture']}))['line']))
+            self.stdout.write(f"📋 {len(line_names)} 本の路線が見つかりました。{options['workers']} 並列で駅データを取得します...")
+            results = await asyncio.gather(*(get_stations(name) for name in line_names))
+        finally:
+            await close_async_client()
+        return line_names, {name: stations for name, stations in results if stations is not None}
+
+    # ---------------------------------------------------------
+    # reset モード（旧方式）：全削除してから1路線ずつ取り込む
+    # ---------------------------------------------------------
+    def handle_reset(self, options):
         self.stdout.write("📡 データのダウンロードを開始します...")
 
         # 1. まずデータを全削除（重複防止）
@@ -17,17 +94,15 @@ class Command(BaseCommand):
         self.stdout.write("🗑️ 既存のデータをリセットしました")
 
         # 2. 東京都の路線一覧を取得
-        # ★修正: 日本語(東京都)をURLエンコードしてエラーを回避
-        params = urllib.parse.urlencode({
-            'method': 'getLines',
-            'prefecture': '東京都'
-        })
-        lines_url = f"http://express.heartrails.com/api/json?{params}"
-        
+        client = get_client()
+
+        def get(params):
+            response = client.get(self.base_url, params=params, timeout=options['timeout'])
+            response.raise_for_status()
+            return response.json()['response']
+
         try:
-            with urllib.request.urlopen(lines_url) as response:
-                data = json.loads(response.read().decode('utf-8'))
-                line_names = data['response']['line']
+            line_names = list(dict.fromkeys(get({'method': 'getLines', 'prefecture': options['prefecture']})['line']))
         except Exception as e:
             self.stderr.write(f"❌ 路線データの取得に失敗しました: {e}")
             return
@@ -36,36 +111,31 @@ class Command(BaseCommand):
 
         # 3. 各路線の駅データを取得して保存
         total_stations = 0
-        
+
         with transaction.atomic():
             for i, line_name in enumerate(line_names):
                 # 路線を作成
                 line = Line.objects.create(name=line_name, sort_order=i)
-                
-                # その路線の駅一覧を取得
-                # ここも日本語(路線名)をURLエンコード
-                station_params = urllib.parse.urlencode({
-                    'method': 'getStations',
-                    'line': line_name
-                })
-                stations_url = f"http://express.heartrails.com/api/json?{station_params}"
 
+                # その路線の駅一覧を取得
                 try:
-                    with urllib.request.urlopen(stations_url) as response:
-                        station_data = json.loads(response.read().decode('utf-8'))
-                        stations_list = station_data['response']['station']
-
-                        for j, st in enumerate(stations_list):
-                            # 駅を作成
-                            Station.objects.create(
-                                line=line,
-                                name=st['name'],
-                                latitude=st['y'],
-                                longitude=st['x'],
-                                sort_order=j
-                            )
-                            total_stations += 1
-                    
+                    stations_list = get({'method': 'getStations', 'line': line_name})['station']
+                    seen = set()
+                    for j, st in enumerate(stations_list):
+                        # (路線, 駅名) は一意なので、同名の駅が2回出てきたら飛ばす
+                        if st['name'] in seen:
+                            continue
+                        seen.add(st['name'])
+                        # 駅を作成
+                        Station.objects.create(
+                            line=line,
+                            name=st['name'],
+                            latitude=st['y'],
+                            longitude=st['x'],
+                            sort_order=j
+                        )
+                        total_stations += 1
+
                     # サーバー負荷軽減のため待機
                     time.sleep(0.1)
                     self.stdout.write(f"  ✅ ({i+1}/{len(line_names)}) {line_name} を保存しました")
@@ -73,4 +143,6 @@ class Command(BaseCommand):
                 except Exception as e:
                     self.stderr.write(f"  ⚠️ {line_name} の駅データ取得に失敗: {e}")
 
-        self.stdout.write(self.style.SUCCESS(f"\n✨ 完了！ 東京都の全路線と、合計 {total_stations} 個の駅をデータベースに登録しました！"))
\ No newline at end of file
+            transaction.on_commit(bump_station_data_version)
+
+        self.stdout.write(self.style.SUCCESS(f"\n✨ 完了！ 東京都の全路線と、合計 {total_stations} 個の駅をデータベースに登録しました！"))
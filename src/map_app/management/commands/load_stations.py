@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from map_app.station_data import SnapshotError, load_snapshot
+
+
+class Command(BaseCommand):
+    help = 'export_stations で書き出したスナップショットから路線・駅データを取り込みます（ネットワーク不要）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='スナップショットファイル')
+        parser.add_argument('--prune', action='store_true', help='スナップショットに無い駅を削除する')
+
+    def handle(self, *args, **options):
+        try:
+            lines, stations, pruned = load_snapshot(options['path'], prune=options['prune'])
+        except (OSError, SnapshotError) as e:
+            raise CommandError(f"スナップショットを読み込めませんでした: {e}")
+
+        message = f"✨ {lines} 路線・{stations} 駅をスナップショットから登録・更新しました"
+        if pruned:
+            message += f"（{pruned} 駅を削除）"
+        self.stdout.write(self.style.SUCCESS(message))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from map_app.matching import rebuild_match_state
+
+
+class Command(BaseCommand):
+    help = '物件のいいね数・マッチ状態とグループのメンバー数を、実データから数え直します'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, action='append', dest='groups', help='対象のグループID（複数指定可。省略時は全グループ）')
+
+    def handle(self, *args, **options):
+        updated = rebuild_match_state(options['groups'])
+        self.stdout.write(self.style.SUCCESS(f"✨ {updated} 件の物件のマッチ状態を数え直しました"))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from map_app.spatial_db import install_geometry
+
+
+class Command(BaseCommand):
+    help = '駅・物件に PostGIS の geom 列と GiST インデックスを作ります（migrate 後に PostGIS を有効にした場合用。何度実行してもよい）'
+
+    def handle(self, *args, **options):
+        if install_geometry(connection):
+            self.stdout.write(self.style.SUCCESS("🗺️ geom 列と GiST インデックスを作成しました"))
+        else:
+            self.stderr.write("❌ PostgreSQL + PostGIS の環境ではないため、何もしませんでした（緯度・経度のインデックスで検索します）")
@@ -0,0 +1,129 @@
+from django.db import IntegrityError, transaction
+from django.db.models import BooleanField, Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.lookups import GreaterThan, GreaterThanOrEqual
+
+from . import events
+from .caching import bump_group_version
+from .models import MapGroup, Property, UserProfile
+
+# ---------------------------------------------------------
+# 物件の「いいね数」と「マッチ状態」、グループの「メンバー数」の保存値の更新
+#   いいね・参加・脱退のたびに、行を読み込まずに UPDATE 1回（F式）で増減させる。
+#   マッチ = グループのメンバー数が1以上で、いいね数がメンバー数以上
+# ---------------------------------------------------------
+
+
+def _group_member_count():
+    return Subquery(MapGroup.objects.filter(pk=OuterRef('group_id')).values('member_count')[:1])
+
+
+def _matched_when(like_count):
+    """like_count（式）とグループのメンバー数からマッチ状態を出す式"""
+    members = _group_member_count()
+    return Case(
+        When(Q(GreaterThan(members, 0)) & Q(GreaterThanOrEqual(like_count, members)), then=Value(True)),
+        default=Value(False),
+        output_field=BooleanField(),
+    )
+
+
+def apply_like_delta(property_ids, delta):
+    """いいねの増減（delta）を反映する
+
+    UPDATE の右辺は更新前の値を参照するので、マッチ判定には「増減後のいいね数」を式で渡す。
+    """
+    if not property_ids or not delta:
+        return 0
+    new_count = F('like_count') + delta
+    return Property.objects.filter(pk__in=property_ids).update(
+        like_count=Greatest(new_count, Value(0)),
+        is_matched=_matched_when(new_count),
+    )
+
+
+def set_like(prop, user, liked=None):
+    """いいねを付ける・外す。liked=None なら反転する
+
+    中間テーブルへの INSERT（重複なら一意制約で失敗）または DELETE の結果で
+    実際に変わったかを判定するので、同時に押されても数がずれない。
+    liked を明示すれば、同じリクエストを再送しても結果は同じ（冪等）。
+    戻り値は (いいね済みか, 今回変わったか)
+    """
+    Through = Property.likes.through
+    row = {'property_id': prop.pk, 'user_id': user.pk}
+
+    def insert():
+        try:
+            with transaction.atomic():
+                Through.objects.create(**row)
+            return True
+        except IntegrityError:
+            return False
+
+    with transaction.atomic():
+        if liked is None:
+            changed = Through.objects.filter(**row).delete()[0] > 0
+            liked = not changed
+            if liked:
+                changed = insert()
+        elif liked:
+            changed = insert()
+        else:
+            changed = Through.objects.filter(**row).delete()[0] > 0
+
+        if changed:
+            # 中間テーブルを直接書き換えたので、シグナルの代わりにここで保存値とキャッシュを更新する
+            apply_like_delta([prop.pk], 1 if liked else -1)
+            bump_group_version(prop.group_id)
+            events.publish_like_state([prop.pk], user=user, liked=liked)
+    return liked, changed
+
+
+def refresh_group_matches(group_id):
+    """メンバー数が変わったグループの物件のマッチ状態を、まとめて更新する"""
+    if group_id is None:
+        return 0
+    return Property.objects.filter(group_id=group_id).update(is_matched=_matched_when(F('like_count')))
+
+
+def apply_member_delta(group_id, delta):
+    if group_id is None or not delta:
+        return
+    MapGroup.objects.filter(pk=group_id).update(member_count=Greatest(F('member_count') + delta, Value(0)))
+    refresh_group_matches(group_id)
+
+
+def move_member(previous_group_id, new_group_id):
+    """メンバーがグループを移った（参加・脱退を含む）ときに呼ぶ"""
+    if previous_group_id == new_group_id:
+        return
+    apply_member_delta(previous_group_id, -1)
+    apply_member_delta(new_group_id, 1)
+
+
+def rebuild_match_state(group_ids=None):
+    """保存値を実データから数え直し、対象グループのキャッシュのバージョンを上げる（rebuild_match_state コマンドから呼ぶ）"""
+    groups = MapGroup.objects.all()
+    properties = Property.objects.all()
+    if group_ids is not None:
+        groups = groups.filter(pk__in=group_ids)
+        properties = properties.filter(group_id__in=group_ids)
+
+    members = (
+        UserProfile.objects.filter(group=OuterRef('pk'))
+        .order_by().values('group').annotate(total=Count('pk')).values('total')
+    )
+    groups.update(member_count=Coalesce(Subquery(members), 0))
+
+    likes = (
+        Property.likes.through.objects.filter(property_id=OuterRef('pk'))
+        .order_by().values('property_id').annotate(total=Count('pk')).values('total')
+    )
+    properties.update(like_count=Coalesce(Subquery(likes), 0))
+    updated = properties.update(is_matched=_matched_when(F('like_count')))
+
+    # update() はシグナルを出さないので、キャッシュ済みの地図データをここで古くする
+    for group_id in groups.values_list('pk', flat=True):
+        bump_group_version(group_id)
+    return updated
@@ -0,0 +1,304 @@
+import contextvars
+import cProfile
+import hmac
+import io
+import pstats
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+# ---------------------------------------------------------
+# リクエストごとの計測（MetricsMiddleware）と Prometheus 形式での公開（/metrics/）
+#   ビューごとに 処理時間・SQLの回数と時間・キャッシュのヒット/ミス・レスポンスのバイト数 を集計する。
+#   集計はプロセスごと（gunicorn のワーカーごと）なので、Prometheus 側で instance ごとに足し合わせる。
+#   SQL は connection_created で全接続に execute_wrapper を付け、
+#   contextvars で「いま処理中のリクエスト」に加算する（非同期ビューの sync_to_async 内の SQL も数えられる）。
+#
+# リクエスト単位のプロファイラ
+#   X-Profile ヘッダー（cumulative / tottime など pstats の並び順）を付けると、
+#   そのリクエストを cProfile で計測し、レスポンスの代わりに結果をテキストで返す。
+#   使えるのはスタッフユーザーか、settings.PROFILER_TOKEN と同じ値を X-Profile-Token に付けたときだけ。
+# ---------------------------------------------------------
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls')
+PROFILE_LINES = 60
+
+_current = contextvars.ContextVar('map_app_request_metrics', default=None)
+
+
+class RequestStats:
+    """1リクエストの中で数えた値"""
+    __slots__ = ('queries', 'query_seconds', 'cache_hits', 'cache_misses')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name, self.help_text, self.buckets = name, help_text, buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, (list(s[0]), s[1], s[2])) for labels, s in self._series.items())
+        for labels, (counts, total, count) in items:
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{_labels(labels, le=_number(bound))} {n}')
+            lines.append(f'{self.name}_bucket{_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{self.name}_sum{_labels(labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(labels)} {count}')
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name, self.help_text = name, help_text
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def inc(self, labels, value=1):
+        if not value:
+            return
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._series.items())
+        lines.extend(f'{self.name}{_labels(labels)} {_number(value)}' for labels, value in items)
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REQUEST_SECONDS = Histogram('dousei_request_duration_seconds', 'ビューの処理時間（秒）', LATENCY_BUCKETS)
+REQUESTS = Counter('dousei_requests_total', 'リクエスト数（ステータス別）')
+DB_QUERIES = Histogram('dousei_db_queries_per_request', '1リクエストあたりのSQLの回数', QUERY_COUNT_BUCKETS)
+DB_SECONDS = Counter('dousei_db_query_seconds_total', 'SQLにかかった時間の合計（秒）')
+CACHE_LOOKUPS = Counter('dousei_payload_cache_lookups_total', '地図データのキャッシュの参照数（hit / miss）')
+RESPONSE_BYTES = Histogram('dousei_response_bytes', 'レスポンス本文のバイト数（ストリーミングは Content-Length があるときだけ）', BYTES_BUCKETS)
+PROFILED = Counter('dousei_profiled_requests_total', 'X-Profile で計測したリクエスト数')
+
+METRICS = (REQUEST_SECONDS, REQUESTS, DB_QUERIES, DB_SECONDS, CACHE_LOOKUPS, RESPONSE_BYTES, PROFILED)
+
+
+def record_cache_lookup(hit):
+    """caching.get_group_payload から呼ばれる"""
+    stats = _current.get()
+    if stats is None:
+        return
+    if hit:
+        stats.cache_hits += 1
+    else:
+        stats.cache_misses += 1
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.query_seconds += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def install_query_wrapper(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def render_metrics():
+    """Prometheus のテキスト形式"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics():
+    for metric in METRICS:
+        metric.reset()
+
+
+# ---------------------------------------------------------
+# ミドルウェア（同期・非同期のどちらのビューでも、スレッドを挟まずに動く）
+# ---------------------------------------------------------
+
+_profile_lock = threading.Lock()
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats, token, started = self._start()
+        profiler = None
+        if request.headers.get('X-Profile'):
+            profiler = self._profiler(request, getattr(request, 'user', None))
+        try:
+            if profiler is not None:
+                response = profiler.runcall(self.get_response, request)
+            else:
+                response = self.get_response(request)
+        except BaseException:
+            _release(profiler)
+            raise
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, stats, started, profiler)
+
+    async def __acall__(self, request):
+        stats, token, started = self._start()
+        profiler = None
+        if request.headers.get('X-Profile'):
+            # 非同期ビューの計測は、同じイベントループで並行して動く他のリクエストも含む
+            user = await request.auser() if hasattr(request, 'auser') else None
+            profiler = self._profiler(request, user)
+        try:
+            if profiler is not None:
+                profiler.enable()
+                try:
+                    response = await self.get_response(request)
+                finally:
+                    profiler.disable()
+            else:
+                response = await self.get_response(request)
+        except BaseException:
+            _release(profiler)
+            raise
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, stats, started, profiler)
+
+    def _start(self):
+        stats = RequestStats()
+        return stats, _current.set(stats), time.perf_counter()
+
+    def _profiler(self, request, user):
+        if not _may_profile(request, user):
+            return None
+        # cProfile は同時に1つしか動かせないので、計測中なら普通に処理する
+        if not _profile_lock.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        sort = request.headers['X-Profile']
+        profiler.sort = sort if sort in PROFILE_SORT_KEYS else 'cumulative'
+        return profiler
+
+    def _finish(self, request, response, stats, started, profiler):
+        elapsed = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        # URL にマッチしないリクエストは、ラベルが増えすぎないよう1つにまとめる
+        view = match.view_name if match else 'unmatched'
+        method = request.method if request.method in ('GET', 'POST', 'HEAD') else 'other'
+
+        REQUEST_SECONDS.observe((('view', view), ('method', method)), elapsed)
+        REQUESTS.inc((('view', view), ('method', method), ('status', response.status_code)))
+        DB_QUERIES.observe((('view', view),), stats.queries)
+        DB_SECONDS.inc((('view', view),), stats.query_seconds)
+        CACHE_LOOKUPS.inc((('view', view), ('result', 'hit')), stats.cache_hits)
+        CACHE_LOOKUPS.inc((('view', view), ('result', 'miss')), stats.cache_misses)
+        size = _body_size(response)
+        if size is not None:
+            RESPONSE_BYTES.observe((('view', view),), size)
+
+        if profiler is None:
+            return response
+        try:
+            PROFILED.inc((('view', view),))
+            return _profile_response(profiler, response, view, elapsed, stats)
+        finally:
+            _release(profiler)
+
+
+def _release(profiler):
+    if profiler is not None:
+        _profile_lock.release()
+
+
+def _may_profile(request, user):
+    token = getattr(settings, 'PROFILER_TOKEN', '')
+    if token and hmac.compare_digest(request.headers.get('X-Profile-Token', '').encode(), token.encode()):
+        return True
+    return bool(user is not None and user.is_authenticated and user.is_staff)
+
+
+def _body_size(response):
+    if not response.streaming:
+        return len(response.content)
+    length = response.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def _profile_response(profiler, response, view, elapsed, stats):
+    out = io.StringIO()
+    out.write(
+        f'view: {view}\nstatus: {response.status_code}\n'
+        f'elapsed: {elapsed * 1000:.1f} ms\n'
+        f'queries: {stats.queries} ({stats.query_seconds * 1000:.1f} ms)\n'
+        f'payload cache: {stats.cache_hits} hit / {stats.cache_misses} miss\n\n'
+    )
+    pstats.Stats(profiler, stream=out).sort_stats(profiler.sort).print_stats(PROFILE_LINES)
+    # 元のレスポンスは捨てる（ストリーミングなら閉じて後始末させる）
+    response.close()
+    profiled = HttpResponse(out.getvalue(), content_type='text/plain; charset=utf-8')
+    profiled['X-Profiled-Status'] = str(response.status_code)
+    profiled['Cache-Control'] = 'no-store'
+    return profiled
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:22
+
+from django.db import migrations, models
+
+
+def mark_existing_coordinates_done(apps, schema_editor):
+    # すでに座標を持っている物件は変換済みとして扱う
+    Property = apps.get_model('map_app', 'Property')
+    Property.objects.filter(latitude__isnull=False, longitude__isnull=False).update(geocode_status='done')
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address_key', models.CharField(max_length=255, unique=True, verbose_name='正規化した住所')),
+                ('latitude', models.FloatField(blank=True, null=True, verbose_name='緯度')),
+                ('longitude', models.FloatField(blank=True, null=True, verbose_name='経度')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='property',
+            name='geocode_status',
+            field=models.CharField(choices=[('pending', '未変換'), ('done', '変換済み'), ('failed', '変換失敗')], db_index=True, default='pending', max_length=10),
+        ),
+        migrations.RunPython(mark_existing_coordinates_done, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:23
+
+from django.db import migrations, models
+
+
+def merge_duplicates(apps, schema_editor):
+    """一意制約を付ける前に、重複した路線・駅を1つにまとめる
+
+    残すのは id が最小のもの。グループが選んでいた駅の紐付けは残す方に付け替える。
+    """
+    Line = apps.get_model('map_app', 'Line')
+    Station = apps.get_model('map_app', 'Station')
+    Through = apps.get_model('map_app', 'MapGroup').selected_stations.through
+
+    keep_lines = {}
+    for line in Line.objects.order_by('pk'):
+        keep = keep_lines.setdefault(line.name, line)
+        if keep.pk != line.pk:
+            Station.objects.filter(line_id=line.pk).update(line_id=keep.pk)
+            line.delete()
+
+    keep_stations = {}
+    for station in Station.objects.order_by('pk'):
+        keep = keep_stations.setdefault((station.line_id, station.name), station)
+        if keep.pk != station.pk:
+            for link in Through.objects.filter(station_id=station.pk):
+                if not Through.objects.filter(mapgroup_id=link.mapgroup_id, station_id=keep.pk).exists():
+                    Through.objects.create(mapgroup_id=link.mapgroup_id, station_id=keep.pk)
+            station.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0002_geocoding'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='line',
+            name='name',
+            field=models.CharField(max_length=100, unique=True, verbose_name='路線名'),
+        ),
+        migrations.AddConstraint(
+            model_name='station',
+            constraint=models.UniqueConstraint(fields=('line', 'name'), name='unique_station_name_per_line'),
+        ),
+    ]
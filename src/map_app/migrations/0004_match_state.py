@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:29
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_match_state(apps, schema_editor):
+    # 既存データのいいね数・メンバー数・マッチ状態を数えて保存する
+    MapGroup = apps.get_model('map_app', 'MapGroup')
+    Property = apps.get_model('map_app', 'Property')
+    UserProfile = apps.get_model('map_app', 'UserProfile')
+
+    members = (
+        UserProfile.objects.filter(group=OuterRef('pk'))
+        .order_by().values('group').annotate(total=Count('pk')).values('total')
+    )
+    MapGroup.objects.update(member_count=Coalesce(Subquery(members), 0))
+
+    likes = (
+        Property.likes.through.objects.filter(property_id=OuterRef('pk'))
+        .order_by().values('property_id').annotate(total=Count('pk')).values('total')
+    )
+    Property.objects.update(like_count=Coalesce(Subquery(likes), 0))
+
+    for group_id, member_count in MapGroup.objects.filter(member_count__gt=0).values_list('pk', 'member_count'):
+        Property.objects.filter(group_id=group_id, like_count__gte=member_count).update(is_matched=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0003_station_upsert_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mapgroup',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='property',
+            name='is_matched',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='property',
+            name='like_count',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(fill_match_state, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:35
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+# 家賃の読み取り（map_app.models.parse_rent のこの時点の写し。
+# 後で parse_rent を変えても、このマイグレーションの結果は変わらない）
+_MAN_RE = re.compile(r'(\d+(?:\.\d+)?)万(\d+)?')
+_NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+
+
+def parse_rent(text):
+    if not text:
+        return None
+    text = unicodedata.normalize('NFKC', text).replace(',', '').replace(' ', '')
+    match = _MAN_RE.search(text)
+    if match:
+        return int(round(float(match.group(1)) * 10000)) + int(match.group(2) or 0)
+    match = _NUMBER_RE.search(text)
+    if not match:
+        return None
+    value = float(match.group())
+    return int(round(value * 10000 if value < 1000 else value))
+
+
+def fill_rent_yen(apps, schema_editor):
+    # 既存の物件の家賃（文字列）を円に直して保存する
+    Property = apps.get_model('map_app', 'Property')
+    batch = []
+    for prop in Property.objects.only('pk', 'rent').iterator(chunk_size=2000):
+        prop.rent_yen = parse_rent(prop.rent)
+        batch.append(prop)
+        if len(batch) >= 2000:
+            Property.objects.bulk_update(batch, ['rent_yen'])
+            batch = []
+    if batch:
+        Property.objects.bulk_update(batch, ['rent_yen'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0004_match_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='property',
+            name='rent_yen',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(fill_rent_yen, migrations.RunPython.noop),
+    ]
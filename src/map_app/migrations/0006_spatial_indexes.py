@@ -0,0 +1,76 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:46
+
+from django.conf import settings
+from django.db import migrations, models
+
+# このマイグレーションを作った時点の SQL の写し（map_app.spatial_db の install_geometry / uninstall_geometry）。
+# spatial_db を後で変えても、このマイグレーションの結果は変わらない
+GEOM_TABLES = ('map_app_station', 'map_app_property')
+
+FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION map_app_set_geom() RETURNS trigger AS $$
+BEGIN
+    IF NEW.latitude IS NULL OR NEW.longitude IS NULL THEN
+        NEW.geom := NULL;
+    ELSE
+        NEW.geom := ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326);
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+INSTALL_SQL = """
+ALTER TABLE {table} ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326);
+UPDATE {table} SET geom = ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)
+    WHERE latitude IS NOT NULL AND longitude IS NOT NULL;
+CREATE INDEX IF NOT EXISTS {table}_geom_gist ON {table} USING GIST (geom);
+DROP TRIGGER IF EXISTS {table}_set_geom ON {table};
+CREATE TRIGGER {table}_set_geom BEFORE INSERT OR UPDATE OF latitude, longitude ON {table}
+    FOR EACH ROW EXECUTE FUNCTION map_app_set_geom();
+"""
+
+
+def add_geometry(apps, schema_editor):
+    # PostGIS モードのときだけ、緯度・経度から geom 列を作って GiST インデックスを張る
+    connection = schema_editor.connection
+    if not getattr(settings, 'POSTGIS', False) or connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'postgis'")
+        if cursor.fetchone() is None:
+            return
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+        cursor.execute(FUNCTION_SQL)
+        for table in GEOM_TABLES:
+            cursor.execute(INSTALL_SQL.format(table=table))
+
+
+def remove_geometry(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for table in GEOM_TABLES:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {table}_set_geom ON {table}')
+            cursor.execute(f'ALTER TABLE {table} DROP COLUMN IF EXISTS geom')
+        cursor.execute('DROP FUNCTION IF EXISTS map_app_set_geom()')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_app', '0005_rent_yen'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='property',
+            index=models.Index(fields=['latitude', 'longitude'], name='property_lat_lon_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='station',
+            index=models.Index(fields=['latitude', 'longitude'], name='station_lat_lon_idx'),
+        ),
+        migrations.RunPython(add_geometry, remove_geometry),
+    ]
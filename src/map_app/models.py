@@ -1,3 +1,6 @@
+import re
+import unicodedata
+
 from django.db import models
 from django.contrib.auth.models import User
 
@@ -7,7 +10,7 @@ from django.contrib.auth.models import User
 # ---------------------------------------------------------
 
 class Line(models.Model):
-    name = models.CharField("路線名", max_length=100)
+    name = models.CharField("路線名", max_length=100, unique=True)
     sort_order = models.IntegerField("並び順", default=0)
 
     def __str__(self):
@@ -20,6 +23,19 @@ class Station(models.Model):
     longitude = models.FloatField("経度")
     sort_order = models.IntegerField("並び順", default=0)
 
+    class Meta:
+        constraints = [
+            # import_stations の upsert のキー
+            models.UniqueConstraint(fields=['line', 'name'], name='unique_station_name_per_line'),
+        ]
+        indexes = [
+            # 表示範囲・半径での検索用（PostGIS では geom 列の GiST インデックスを使う。spatial_db.py）
+            models.Index(fields=['latitude', 'longitude'], name='station_lat_lon_idx'),
+            # 路線ごとの駅一覧（並び順つき）と、駅名での検索
+            models.Index(fields=['line', 'sort_order'], name='station_line_order_idx'),
+            models.Index(fields=['name'], name='station_name_idx'),
+        ]
+
     def __str__(self):
         return f"{self.name} ({self.line.name})"
 
@@ -34,6 +50,8 @@ class MapGroup(models.Model):
     # ★変更点：グループが「選んだ駅」をここで管理する
     # ManyToManyField = 多対多の関係（1つのグループは複数の駅を選べる）
     selected_stations = models.ManyToManyField(Station, blank=True, related_name='selected_by_groups')
+    # 所属メンバー数（matching.py が参加・脱退のたびに増減させる）
+    member_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.name
@@ -53,23 +71,90 @@ class UserProfile(models.Model):
 # 4. 物件データ（Property）
 # ---------------------------------------------------------
 
+GEOCODE_PENDING = 'pending'
+GEOCODE_DONE = 'done'
+GEOCODE_FAILED = 'failed'
+GEOCODE_STATUS_CHOICES = [
+    (GEOCODE_PENDING, '未変換'),
+    (GEOCODE_DONE, '変換済み'),
+    (GEOCODE_FAILED, '変換失敗'),
+]
+
+_MAN_RE = re.compile(r'(\d+(?:\.\d+)?)万(\d+)?')
+_NUMBER_RE = re.compile(r'\d+(?:\.\d+)?')
+
+
+def parse_rent(text):
+    """家賃の文字列（「12万円」「12.5万」「12万5000円」「120,000円」）を円の整数にする。読めなければ None
+
+    単位のない小さな数（「12」など）は「万円」とみなす。
+    """
+    if not text:
+        return None
+    text = unicodedata.normalize('NFKC', text).replace(',', '').replace(' ', '')
+    match = _MAN_RE.search(text)
+    if match:
+        return int(round(float(match.group(1)) * 10000)) + int(match.group(2) or 0)
+    match = _NUMBER_RE.search(text)
+    if not match:
+        return None
+    value = float(match.group())
+    return int(round(value * 10000 if value < 1000 else value))
+
 class Property(models.Model):
     group = models.ForeignKey(MapGroup, on_delete=models.CASCADE, related_name='properties')
     name = models.CharField(max_length=200)
     address = models.CharField(max_length=200)
     rent = models.CharField(max_length=50)
+    # rent を円に直した値（並べ替え・絞り込み用。save で rent から作る）
+    rent_yen = models.IntegerField(null=True, blank=True, db_index=True)
     latitude = models.FloatField(null=True, blank=True)
     longitude = models.FloatField(null=True, blank=True)
+    # 住所→座標の変換状態（変換はリクエスト外のワーカー geocode_properties が行う）
+    geocode_status = models.CharField(max_length=10, choices=GEOCODE_STATUS_CHOICES, default=GEOCODE_PENDING, db_index=True)
+    # 最後に変換を試みた日時。一時的な失敗が続く物件を後回しにするのに使う（未挑戦は NULL）
+    geocode_attempted_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     likes = models.ManyToManyField(User, related_name='liked_properties', blank=True)
+    # いいね数と「全員がいいねしたか」を毎回数え直さないよう保存しておく
+    # （matching.py がいいね・メンバーの増減に合わせて更新する。rebuild_match_state で作り直せる）
+    like_count = models.PositiveIntegerField(default=0, db_index=True)
+    is_matched = models.BooleanField(default=False, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='property_lat_lon_idx'),
+            # グループの物件を新しい順に出す
+            models.Index(fields=['group', '-created_at'], name='property_group_created_idx'),
+            # 未変換の物件を、試みていない・試みたのが古い順に取り出す（geocode_pending）
+            models.Index(fields=['geocode_status', 'geocode_attempted_at'], name='property_geocode_queue_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.rent_yen = parse_rent(self.rent)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'rent' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'rent_yen'}
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.name
+
+# ---------------------------------------------------------
+# 5. ジオコーディング結果のキャッシュ（GeocodeCache）
+#    ※同じ住所で外部APIを2回叩かないよう、正規化した住所をキーに保存する
+# ---------------------------------------------------------
+
+class GeocodeCache(models.Model):
+    address_key = models.CharField("正規化した住所", max_length=255, unique=True)
+    # 見つからなかった住所も「座標なし」として保存し、再問い合わせを防ぐ
+    latitude = models.FloatField("緯度", null=True, blank=True)
+    longitude = models.FloatField("経度", null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
 
-    def is_matched(self):
-        if self.group:
-            # グループに所属する全ユーザー数を取得
-            member_count = UserProfile.objects.filter(group=self.group).count()
-            # いいねした人数と比較
-            return self.likes.count() >= member_count and member_count > 0
-        return False
+    @property
+    def found(self):
+        return self.latitude is not None and self.longitude is not None
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.address_key
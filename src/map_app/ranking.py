@@ -0,0 +1,175 @@
+import math
+
+import numpy as np
+
+from .isochrone import WALK_SPEED_M_PER_MIN
+from .models import Property
+from .spatial import get_station_index, nearest_of
+from .travel_matrix import get_travel_matrix
+
+# ---------------------------------------------------------
+# 物件のランキング
+#   グループの全物件について「家賃の安さ」「選んだ駅への近さ」「いいね・マッチ」を
+#   0〜1 の点数にし、重み付きの合計で並べる。物件数によらず NumPy の1回の計算で出す。
+#   駅間の所要時間の行列（build_travel_matrix）があれば、「近さ」は直線距離ではなく通勤時間
+#   （物件の最寄り駅まで徒歩 + 選んだ駅のうち一番遠い駅までの乗車時間）で測る。
+# ---------------------------------------------------------
+
+DEFAULT_WEIGHTS = {'rent': 0.4, 'distance': 0.4, 'likes': 0.2}
+# この距離（m）以上離れた物件は「駅への近さ」の点数が0
+DISTANCE_LIMIT_M = 3000.0
+# 通勤時間で測るとき、この時間（分）以上かかる物件は「駅への近さ」の点数が0
+COMMUTE_LIMIT_MIN = 60.0
+
+SORT_KEYS = ('score', 'rent', 'distance', 'likes')
+
+
+def score_arrays(rents, distances, like_counts, matched, member_count, weights=None, commutes=None):
+    """各項目の配列から点数（0〜1）を返す。不明な家賃・距離（nan）はその項目0点
+
+    commutes（通勤時間・分）を渡すと、「駅への近さ」は距離ではなくこちらで測る（不明・到達不能は0点）。
+    """
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    rents = np.asarray(rents, dtype=np.float64)
+    distances = np.asarray(distances, dtype=np.float64)
+    like_counts = np.asarray(like_counts, dtype=np.float64)
+    matched = np.asarray(matched, dtype=bool)
+
+    # 家賃: グループ内で一番安い物件が1、一番高い物件が0
+    known = np.isfinite(rents)
+    rent_score = np.zeros(len(rents))
+    if known.any():
+        low, high = rents[known].min(), rents[known].max()
+        rent_score[known] = 1.0 if high == low else (high - rents[known]) / (high - low)
+
+    distance_score = np.zeros(len(distances))
+    if commutes is None:
+        near = np.isfinite(distances)
+        distance_score[near] = np.clip(1.0 - distances[near] / DISTANCE_LIMIT_M, 0.0, 1.0)
+    else:
+        commutes = np.asarray(commutes, dtype=np.float64)
+        near = np.isfinite(commutes)
+        distance_score[near] = np.clip(1.0 - commutes[near] / COMMUTE_LIMIT_MIN, 0.0, 1.0)
+
+    # いいね: メンバーのうち何人がいいねしたか（マッチなら1）
+    like_score = np.minimum(like_counts / member_count, 1.0) if member_count else np.zeros(len(like_counts))
+    like_score = np.where(matched, 1.0, like_score)
+
+    weights = {k: _weight(weights[k]) for k in DEFAULT_WEIGHTS}
+    total = sum(weights.values()) or 1.0
+    return (
+        weights['rent'] * rent_score
+        + weights['distance'] * distance_score
+        + weights['likes'] * like_score
+    ) / total
+
+
+def _weight(value):
+    # 負の値・nan・inf は 0 とみなす（nan が混ざると全物件の点数が nan になる）
+    value = float(value)
+    return value if math.isfinite(value) and value > 0 else 0.0
+
+
+def commute_minutes(matrix, lats, lons, station_ids):
+    """各物件の通勤時間（分）。最寄り駅まで歩き、選んだ駅のうち一番時間のかかる駅まで乗る
+
+    乗車時間は行列から引く（O(1)）。どれかの駅に行けない物件は inf。
+    行列が駅数（hops）で作られている場合は時間が分からないので None。
+    """
+    if matrix.unit != 'seconds':
+        return None
+    index = get_station_index()
+    if not len(index):
+        return None
+    homes = np.empty(len(lats), dtype=np.int64)
+    walk = np.empty(len(lats), dtype=np.float64)
+    for i, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist())):
+        nearest, distance = index.nearest(lat, lon, k=1)[0]
+        homes[i] = index.ids[nearest]
+        walk[i] = distance / WALK_SPEED_M_PER_MIN
+    # 同じ最寄り駅の物件が多いので、駅ごとに1回だけ引く
+    unique_homes, position = np.unique(homes, return_inverse=True)
+    ride = matrix.table(unique_homes.tolist(), station_ids).max(axis=1) / 60.0
+    return walk + ride[position]
+
+
+def rank_properties(group, weights=None, sort='score', max_rent=None, matched_only=False):
+    """グループの物件を並べたリスト（2クエリ）"""
+    properties = Property.objects.filter(group=group).order_by('pk')
+    if max_rent is not None:
+        properties = properties.filter(rent_yen__lte=max_rent)
+    if matched_only:
+        properties = properties.filter(is_matched=True)
+    rows = list(properties.values_list(
+        'id', 'name', 'address', 'rent', 'rent_yen', 'latitude', 'longitude', 'like_count', 'is_matched',
+    ))
+    if not rows:
+        return []
+    stations = list(group.selected_stations.order_by('pk').values_list('id', 'name', 'latitude', 'longitude'))
+
+    ids = np.array([r[0] for r in rows], dtype=np.int64)
+    rents = np.array([np.nan if r[4] is None else r[4] for r in rows], dtype=np.float64)
+    lats = np.array([np.nan if r[5] is None else r[5] for r in rows], dtype=np.float64)
+    lons = np.array([np.nan if r[6] is None else r[6] for r in rows], dtype=np.float64)
+    like_counts = np.array([r[7] for r in rows], dtype=np.int64)
+    matched = np.array([r[8] for r in rows], dtype=bool)
+
+    # 座標のある物件だけ、選んだ駅の中で一番近い駅を求める
+    distances = np.full(len(rows), np.nan)
+    nearest = np.full(len(rows), -1, dtype=np.int64)
+    located = np.isfinite(lats) & np.isfinite(lons)
+    if stations and located.any():
+        idx, dist = nearest_of(
+            lats[located], lons[located],
+            [s[2] for s in stations], [s[3] for s in stations],
+        )
+        nearest[located] = idx
+        distances[located] = dist
+
+    # 駅間の所要時間の行列があれば、近さを通勤時間で測る
+    commutes = None
+    matrix = get_travel_matrix()
+    if matrix is not None and stations and located.any():
+        located_commutes = commute_minutes(matrix, lats[located], lons[located], [s[0] for s in stations])
+        if located_commutes is not None:
+            commutes = np.full(len(rows), np.nan)
+            commutes[located] = located_commutes
+
+    scores = score_arrays(rents, distances, like_counts, matched, group.member_count, weights, commutes=commutes)
+
+    # np.lexsort は最後のキーが第1キー。同点は id の昇順、不明な値は後ろに回す
+    if sort == 'rent':
+        order = np.lexsort((ids, np.nan_to_num(rents, nan=np.inf)))
+    elif sort == 'distance':
+        nearness = distances if commutes is None else commutes
+        order = np.lexsort((ids, np.nan_to_num(nearness, nan=np.inf)))
+    elif sort == 'likes':
+        order = np.lexsort((ids, -scores, -like_counts))
+    else:
+        order = np.lexsort((ids, -scores))
+
+    results = []
+    for i in order.tolist():
+        row = rows[i]
+        station = stations[nearest[i]] if nearest[i] >= 0 else None
+        results.append({
+            'id': row[0],
+            'name': row[1],
+            'address': row[2],
+            'rent': row[3],
+            'rent_yen': row[4],
+            'lat': row[5],
+            'lon': row[6],
+            'like_count': row[7],
+            'is_matched': row[8],
+            'nearest_station': None if station is None else {
+                'id': station[0],
+                'name': station[1],
+                'distance_m': round(float(distances[i]), 1),
+            },
+            'commute_minutes': (
+                round(float(commutes[i]), 1) if commutes is not None and np.isfinite(commutes[i]) else None
+            ),
+            'score': round(float(scores[i]), 4),
+        })
+    return results
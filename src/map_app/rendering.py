@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import folium
+from folium.plugins import MarkerCluster
+from django.conf import settings
+from django.utils.html import escape
+
+# ---------------------------------------------------------
+# サーバー側での地図HTMLの作成（map_view?mode=server）
+#   古いスマホでは物件の多いグループの地図をブラウザで組み立てるのが遅いので、
+#   folium で HTML を作って渡す。
+#   作った HTML は「地図データ（JSON）の sha256」をファイル名にして保存するので、
+#   同じデータなら何度開いても作り直さない（グループのデータが変われば別のファイルになる）。
+#   作成はワーカースレッドで行い、リクエストのスレッドは待たない。
+#   データが変わるたびにファイルが増えるので、最近使われた MAP_RENDER_KEEP 個だけを残す。
+#   作成に失敗したデータは、MAP_RENDER_RETRY_SECONDS の間は作り直さずにエラーを返す。
+# ---------------------------------------------------------
+
+logger = logging.getLogger(__name__)
+
+# 描画の中身を変えたら上げる（古いファイルを使わないように）
+RENDER_VERSION = 2
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = {}
+# ハッシュ → 作成に失敗した時刻（time.monotonic）
+_failed = {}
+
+
+class RenderError(Exception):
+    """地図HTMLの作成に失敗した（しばらくは作り直さない）"""
+
+
+def _render_dir():
+    return str(getattr(settings, 'MAP_RENDER_DIR', os.path.join(settings.BASE_DIR, 'data', 'maps')))
+
+
+def content_hash(payload_bytes):
+    """地図データ（シリアライズ済み）から保存用のハッシュを作る"""
+    digest = hashlib.sha256(f'v{RENDER_VERSION}:'.encode())
+    digest.update(payload_bytes)
+    return digest.hexdigest()
+
+
+def rendered_path(digest):
+    return os.path.join(_render_dir(), f'{digest}.html')
+
+
+def render_map_html(payload):
+    """build_map_payload の dict から folium の地図HTMLを作る"""
+    center = payload['center']
+    m = folium.Map(location=[center['lat'], center['lon']], zoom_start=13, control_scale=True)
+
+    for station in payload['stations']:
+        folium.CircleMarker(
+            location=[station['lat'], station['lon']],
+            radius=7, color='#1e88e5', fill=True, fill_opacity=0.9,
+            tooltip=escape(station['name']),
+        ).add_to(m)
+
+    # 物件は数が多いのでクラスタにまとめる
+    cluster = MarkerCluster(name='物件').add_to(m)
+    for prop in payload['properties']:
+        # 名前・住所などはユーザーが入力したものなので、HTML に入れる前にエスケープする
+        liked = '、'.join(escape(name) for name in prop['liked_users']) or 'なし'
+        popup = folium.Popup(
+            f"<b>{escape(prop['name'])}</b><br>{escape(prop['rent'])}<br>{escape(prop['address'])}<br>いいね: {liked}",
+            max_width=250,
+        )
+        icon = folium.Icon(color='red', icon='heart') if prop['is_matched'] else folium.Icon(color='gray', icon='home')
+        folium.Marker(location=[prop['lat'], prop['lon']], popup=popup, icon=icon).add_to(cluster)
+
+    return m.get_root().render()
+
+
+def _write(digest, payload_bytes):
+    directory = _render_dir()
+    os.makedirs(directory, exist_ok=True)
+    html = render_map_html(json.loads(payload_bytes))
+    path = rendered_path(digest)
+    # 書きかけのファイルを配らないよう、一時ファイルから置き換える
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    os.replace(tmp_path, path)
+    _prune(directory, getattr(settings, 'MAP_RENDER_KEEP', 500))
+    return path
+
+
+def _prune(directory, keep):
+    """最近使われた（更新時刻の新しい）keep 個を残して、古い地図HTMLを消す"""
+    files = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.html'):
+            try:
+                files.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+    files.sort(reverse=True)
+    for _, path in files[keep:]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # 別のプロセスが先に消した
+            pass
+
+
+def _render(digest, payload_bytes):
+    try:
+        return _write(digest, payload_bytes)
+    except Exception:
+        logger.exception('地図HTMLの作成に失敗しました（%s）', digest)
+        with _executor_lock:
+            _failed[digest] = time.monotonic()
+        raise
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'MAP_RENDER_WORKERS', 2),
+                thread_name_prefix='map-render',
+            )
+        return _executor
+
+
+def _finished(digest):
+    with _executor_lock:
+        _pending.pop(digest, None)
+
+
+def request_render(payload_bytes):
+    """(ハッシュ, 作成済みのファイルのパス) を返す
+
+    まだ作られていなければワーカーに作成を頼み、パスは None を返す。
+    同じデータの作成がすでに進んでいれば、もう一度は頼まない。
+    最近作成に失敗したデータなら RenderError を投げる。
+    """
+    digest = content_hash(payload_bytes)
+    path = rendered_path(digest)
+    try:
+        # 使われたファイルは更新時刻を新しくして、古いファイルの削除（_prune）から外す
+        os.utime(path)
+        return digest, path
+    except FileNotFoundError:
+        pass
+
+    executor = _get_executor()
+    retry_seconds = getattr(settings, 'MAP_RENDER_RETRY_SECONDS', 300)
+    with _executor_lock:
+        failed_at = _failed.get(digest)
+        if failed_at is not None:
+            if time.monotonic() - failed_at < retry_seconds:
+                raise RenderError(digest)
+            del _failed[digest]
+        if digest not in _pending:
+            future = executor.submit(_render, digest, payload_bytes)
+            _pending[digest] = future
+            future.add_done_callback(lambda f: _finished(digest))
+    return digest, None
+
+
+def wait_for_render(digest, timeout=None):
+    """作成中の地図を待つ（テスト・ベンチマーク用）。作成に失敗していたら RenderError"""
+    with _executor_lock:
+        future = _pending.get(digest)
+    if future is not None:
+        wait([future], timeout=timeout)
+    with _executor_lock:
+        if digest in _failed:
+            raise RenderError(digest)
+    path = rendered_path(digest)
+    return path if os.path.exists(path) else None
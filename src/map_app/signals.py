@@ -0,0 +1,152 @@
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import events
+from .caching import bump_group_version
+from .matching import apply_like_delta, apply_member_delta, move_member, rebuild_match_state
+from .models import MapGroup, Property, UserProfile
+
+# ---------------------------------------------------------
+# グループの地図データが変わったら、キャッシュのバージョンを上げる
+# いいね数・メンバー数の保存値もここで増減させる（matching.py）
+# 同じグループの画面には差分をイベントで送る（events.py）
+#   （apps.MapAppConfig.ready で読み込まれる）
+# ---------------------------------------------------------
+
+
+@receiver(post_save, sender=Property)
+@receiver(post_delete, sender=Property)
+def property_changed(sender, instance, **kwargs):
+    bump_group_version(instance.group_id)
+    if kwargs['signal'] is post_delete:
+        events.publish(instance.group_id, 'property.removed', {'id': instance.pk})
+    else:
+        event_type = 'property.added' if kwargs.get('created') else 'property.updated'
+        events.publish(instance.group_id, event_type, events.property_event_data(instance))
+
+
+@receiver(m2m_changed, sender=Property.likes.through)
+def likes_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # reverse=False: prop.likes.add(user) など（instance は物件）
+    # reverse=True:  user.liked_properties.add(prop) など（instance はユーザー）
+    owner = {'user_id': instance.pk} if reverse else {'property_id': instance.pk}
+
+    if action in ('pre_remove', 'pre_clear'):
+        # remove の pk_set には、もともといいねしていない組み合わせも入るので、
+        # 実際に消える行を消す前に調べておく
+        rows = sender.objects.filter(**owner)
+        if action == 'pre_remove':
+            rows = rows.filter(**({'property_id__in': pk_set} if reverse else {'user_id__in': pk_set}))
+        instance._removed_like_property_ids = list(rows.values_list('property_id', flat=True))
+        return
+
+    if action == 'post_add':
+        # post_add の pk_set は、実際に追加された分だけ
+        property_ids = list(pk_set) if reverse else [instance.pk] * len(pk_set)
+        delta = 1
+    elif action in ('post_remove', 'post_clear'):
+        property_ids = getattr(instance, '_removed_like_property_ids', [])
+        delta = -1
+    else:
+        return
+
+    # 物件ごとの増減数でまとめて UPDATE する
+    by_amount = {}
+    for property_id, count in Counter(property_ids).items():
+        by_amount.setdefault(count * delta, []).append(property_id)
+    for amount, ids in by_amount.items():
+        apply_like_delta(ids, amount)
+
+    group_ids = Property.objects.filter(pk__in=set(property_ids)).values_list('group_id', flat=True).distinct()
+    for group_id in group_ids:
+        bump_group_version(group_id)
+    events.publish_like_state(property_ids)
+
+
+@receiver(pre_delete, sender=User)
+def remember_deleted_user_likes(sender, instance, **kwargs):
+    # ユーザーを消すと、いいねの行は m2m_changed を出さずに CASCADE で消える。
+    # どの物件・グループに影響するかを、消える前に調べておく
+    rows = Property.likes.through.objects.filter(user_id=instance.pk)
+    instance._deleted_like_property_ids = list(rows.values_list('property_id', flat=True))
+    instance._deleted_like_group_ids = set(
+        Property.objects.filter(pk__in=instance._deleted_like_property_ids).values_list('group_id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    group_ids = getattr(instance, '_deleted_like_group_ids', set())
+    if not group_ids:
+        return
+    # 影響したグループだけ、いいね数・マッチ状態を数え直す（キャッシュのバージョンも上がる）
+    rebuild_match_state(group_ids)
+    events.publish_like_state(instance._deleted_like_property_ids)
+
+
+@receiver(m2m_changed, sender=MapGroup.selected_stations.through)
+def selected_stations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action == 'pre_clear':
+            instance._cleared_station_ids = list(instance.selected_stations.values_list('pk', flat=True))
+        elif action in ('post_add', 'post_remove', 'post_clear'):
+            bump_group_version(instance.pk)
+            if action == 'post_add':
+                events.publish_station_change(instance.pk, added_ids=pk_set)
+            elif action == 'post_remove':
+                events.publish_station_change(instance.pk, removed_ids=pk_set)
+            else:
+                events.publish_station_change(instance.pk, removed_ids=getattr(instance, '_cleared_station_ids', []))
+        return
+
+    # station.selected_by_groups.add(group) など。instance は駅
+    if action == 'pre_clear':
+        pk_set = set(instance.selected_by_groups.values_list('pk', flat=True))
+    elif action not in ('post_add', 'post_remove'):
+        return
+    for group_id in pk_set or []:
+        bump_group_version(group_id)
+        if action == 'post_add':
+            events.publish_station_change(group_id, added_ids=[instance.pk])
+        else:
+            events.publish_station_change(group_id, removed_ids=[instance.pk])
+
+
+@receiver(pre_save, sender=UserProfile)
+def remember_previous_group(sender, instance, **kwargs):
+    # 所属グループが変わったとき、抜けた側のグループも更新するために覚えておく
+    if instance.pk:
+        instance._previous_group_id = (
+            UserProfile.objects.filter(pk=instance.pk).values_list('group_id', flat=True).first()
+        )
+    else:
+        instance._previous_group_id = None
+
+
+@receiver(post_save, sender=UserProfile)
+def profile_group_changed(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous_group_id', None)
+    if created or previous != instance.group_id:
+        # メンバー数が変わるとマッチ判定も変わる
+        move_member(previous, instance.group_id)
+        for group_id in (previous, instance.group_id):
+            bump_group_version(group_id)
+            _publish_members(group_id)
+
+
+@receiver(post_delete, sender=UserProfile)
+def profile_deleted(sender, instance, **kwargs):
+    apply_member_delta(instance.group_id, -1)
+    bump_group_version(instance.group_id)
+    _publish_members(instance.group_id)
+
+
+def _publish_members(group_id):
+    # メンバー数が変わると全物件のマッチ状態が変わりうるので、画面側で取り直してもらう
+    if group_id is None:
+        return
+    member_count = MapGroup.objects.filter(pk=group_id).values_list('member_count', flat=True).first()
+    events.publish(group_id, 'members.changed', {'member_count': member_count})
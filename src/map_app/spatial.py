@@ -0,0 +1,186 @@
+import math
+import threading
+
+import numpy as np
+
+from .models import Station
+from .caching import station_data_version
+
+# ---------------------------------------------------------
+# 駅の空間インデックス（最寄り駅検索）
+#   駅の座標を緯度順に並べた NumPy 配列をメモリに持ち、
+#   緯度の帯で候補を絞ってから距離を計算する。
+#   import_stations / load_stations で駅データのバージョンが上がると作り直す。
+# ---------------------------------------------------------
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """2点間の距離（メートル）。配列を渡すとブロードキャストしてまとめて計算する"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def distance_matrix(lats1, lons1, lats2, lons2):
+    """(len(lats1), len(lats2)) の距離行列（メートル）"""
+    lats1 = np.asarray(lats1, dtype=np.float64)[:, None]
+    lons1 = np.asarray(lons1, dtype=np.float64)[:, None]
+    return haversine(lats1, lons1, lats2, lons2)
+
+
+def nearest_of(lats, lons, target_lats, target_lons):
+    """各点について、targets の中で最も近いものの番号と距離を返す（1回の行列計算で）"""
+    if len(lats) == 0 or len(target_lats) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    distances = distance_matrix(lats, lons, target_lats, target_lons)
+    nearest = distances.argmin(axis=1)
+    return nearest, distances[np.arange(len(nearest)), nearest]
+
+
+class StationIndex:
+    # 最初に探す半径。足りなければ倍々に広げる
+    INITIAL_RADIUS_M = 2000.0
+
+    def __init__(self, rows):
+        """rows: (id, 駅名, 路線名, 緯度, 経度) のリスト"""
+        rows = sorted(rows, key=lambda r: r[3])
+        self.ids = np.array([r[0] for r in rows], dtype=np.int64)
+        self.names = [r[1] for r in rows]
+        self.line_names = [r[2] for r in rows]
+        self.lats = np.array([r[3] for r in rows], dtype=np.float64)
+        self.lons = np.array([r[4] for r in rows], dtype=np.float64)
+
+    @classmethod
+    def from_db(cls):
+        return cls(list(Station.objects.values_list('id', 'name', 'line__name', 'latitude', 'longitude')))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nearest(self, lat, lon, k=5):
+        """(lat, lon) に近い順に k 駅の [(配列上の番号, 距離m), ...] を返す
+
+        緯度差が r 以内の駅だけを二分探索で取り出して距離を計算する。
+        k 番目の距離が r 以下なら、帯の外の駅（必ず r より遠い）を見る必要はない。
+        """
+        n = len(self)
+        k = min(k, n)
+        if k <= 0:
+            return []
+
+        radius = self.INITIAL_RADIUS_M
+        while True:
+            dlat = math.degrees(radius / EARTH_RADIUS_M)
+            lo = int(np.searchsorted(self.lats, lat - dlat, side='left'))
+            hi = int(np.searchsorted(self.lats, lat + dlat, side='right'))
+            covers_all = lo == 0 and hi == n
+            if hi - lo >= k:
+                distances = haversine(lat, lon, self.lats[lo:hi], self.lons[lo:hi])
+                top = np.argpartition(distances, k - 1)[:k]
+                top = top[np.argsort(distances[top], kind='stable')]
+                if distances[top[-1]] <= radius or covers_all:
+                    return [(lo + int(i), float(distances[i])) for i in top]
+            elif covers_all:
+                distances = haversine(lat, lon, self.lats, self.lons)
+                order = np.argsort(distances, kind='stable')[:k]
+                return [(int(i), float(distances[i])) for i in order]
+            radius *= 2
+
+    def describe(self, i, distance=None):
+        data = {
+            'id': int(self.ids[i]),
+            'name': self.names[i],
+            'line': self.line_names[i],
+            'lat': float(self.lats[i]),
+            'lon': float(self.lons[i]),
+        }
+        if distance is not None:
+            data['distance_m'] = round(distance, 1)
+        return data
+
+
+_index_lock = threading.Lock()
+_index = None
+_index_key = None
+
+
+def get_station_index():
+    """プロセス内で共有する StationIndex を返す
+
+    駅データのバージョン（import のたびに上がる）が変わったときだけ作り直す。
+    時間では作り直さないので、gunicorn のマスターで作ったものをワーカーが共有し続けられる。
+    """
+    global _index, _index_key
+    key = station_data_version()
+    if _index is None or _index_key != key:
+        with _index_lock:
+            if _index is None or _index_key != key:
+                _index = StationIndex.from_db()
+                _index_key = key
+    return _index
+
+
+def reset_station_index():
+    global _index, _index_key
+    with _index_lock:
+        _index = None
+        _index_key = None
+
+
+# ---------------------------------------------------------
+# 表示範囲（bbox）とズームによるクラスタリング
+# ---------------------------------------------------------
+
+# このズーム以上では点をそのまま返す
+CLUSTER_MAX_ZOOM = 14
+# 1クラスタにまとめる範囲（256px タイル上のピクセル数）
+CLUSTER_CELL_PX = 64
+
+
+def parse_bbox(value):
+    """'最小経度,最小緯度,最大経度,最大緯度'（minLon,minLat,maxLon,maxLat）を数値のタプルにする"""
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in value.split(','))
+    except (AttributeError, ValueError):
+        raise ValueError('bbox は minLon,minLat,maxLon,maxLat の形式で指定してください')
+    if not (-180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError('bbox の範囲が正しくありません')
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def snap_bbox(bbox, zoom):
+    """bbox をズーム zoom のタイルの境目まで外側に広げる
+
+    少し動かしただけの表示範囲が同じ bbox になるので、キャッシュのキーがパンのたびに増えない。
+    """
+    step = 360.0 / (2 ** zoom)
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return (
+        max(math.floor(min_lon / step) * step, -180.0),
+        max(math.floor(min_lat / step) * step, -90.0),
+        min(math.ceil(max_lon / step) * step, 180.0),
+        min(math.ceil(max_lat / step) * step, 90.0),
+    )
+
+
+def cluster_points(lats, lons, zoom):
+    """ズームに応じたグリッドで点をまとめる
+
+    戻り値は (各点のクラスタ番号, クラスタ中心の緯度, 経度, 点の数)。
+    ズームが CLUSTER_MAX_ZOOM 以上なら、1点1クラスタのまま返す。
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if zoom >= CLUSTER_MAX_ZOOM or len(lats) == 0:
+        return np.arange(len(lats)), lats, lons, np.ones(len(lats), dtype=np.int64)
+
+    # ズーム z ではタイル1枚が 360 / 2**z 度なので、そのうち CLUSTER_CELL_PX 分を1マスにする
+    cell = 360.0 / (2 ** zoom) * CLUSTER_CELL_PX / 256
+    cells = np.stack([np.floor(lats / cell), np.floor(lons / cell)], axis=1)
+    _, labels, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    labels = labels.ravel()
+    center_lats = np.bincount(labels, weights=lats) / counts
+    center_lons = np.bincount(labels, weights=lons) / counts
+    return labels, center_lats, center_lons, counts
@@ -0,0 +1,165 @@
+import math
+import threading
+
+from django.db import connections
+from django.db.models import BooleanField, F, FloatField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+
+from .spatial import EARTH_RADIUS_M, haversine
+
+# ---------------------------------------------------------
+# DB での空間検索（表示範囲・半径・近い順）
+#   PostgreSQL + PostGIS の場合: 駅・物件の geom 列（GiST インデックス付き）を使う。
+#     geom 列は緯度・経度の列からトリガーで自動的に作られるので、ORM からは意識しなくてよい。
+#     （作るのは migrations/0006 と setup_postgis コマンド）
+#   それ以外（SQLite など）: 緯度・経度の複合インデックスで範囲を絞ってから、距離を式で計算する。
+# ---------------------------------------------------------
+
+GEOM_TABLES = ('map_app_station', 'map_app_property')
+
+_INSTALL_SQL = """
+ALTER TABLE {table} ADD COLUMN IF NOT EXISTS geom geometry(Point, 4326);
+UPDATE {table} SET geom = ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)
+    WHERE latitude IS NOT NULL AND longitude IS NOT NULL;
+CREATE INDEX IF NOT EXISTS {table}_geom_gist ON {table} USING GIST (geom);
+DROP TRIGGER IF EXISTS {table}_set_geom ON {table};
+CREATE TRIGGER {table}_set_geom BEFORE INSERT OR UPDATE OF latitude, longitude ON {table}
+    FOR EACH ROW EXECUTE FUNCTION map_app_set_geom();
+"""
+
+_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION map_app_set_geom() RETURNS trigger AS $$
+BEGIN
+    IF NEW.latitude IS NULL OR NEW.longitude IS NULL THEN
+        NEW.geom := NULL;
+    ELSE
+        NEW.geom := ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326);
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+def install_geometry(connection):
+    """PostGIS が使えれば geom 列・GiST インデックス・同期用トリガーを作る。作ったら True"""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'postgis'")
+        if cursor.fetchone() is None:
+            return False
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+        cursor.execute(_FUNCTION_SQL)
+        for table in GEOM_TABLES:
+            cursor.execute(_INSTALL_SQL.format(table=table))
+    reset_postgis_cache()
+    return True
+
+
+def uninstall_geometry(connection):
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for table in GEOM_TABLES:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {table}_set_geom ON {table}')
+            cursor.execute(f'ALTER TABLE {table} DROP COLUMN IF EXISTS geom')
+        cursor.execute('DROP FUNCTION IF EXISTS map_app_set_geom()')
+    reset_postgis_cache()
+
+
+_postgis_lock = threading.Lock()
+_postgis = {}
+
+
+def postgis_available(using='default'):
+    """geom 列があるか（プロセスごとに1回だけ調べる）"""
+    if using not in _postgis:
+        connection = connections[using]
+        available = False
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT count(*) FROM information_schema.columns"
+                    " WHERE table_name = ANY(%s) AND column_name = 'geom'",
+                    [list(GEOM_TABLES)],
+                )
+                available = cursor.fetchone()[0] == len(GEOM_TABLES)
+        with _postgis_lock:
+            _postgis[using] = available
+    return _postgis[using]
+
+
+def reset_postgis_cache():
+    with _postgis_lock:
+        _postgis.clear()
+
+
+def _geom(queryset):
+    return f'"{queryset.model._meta.db_table}"."geom"'
+
+
+def _point_sql():
+    return 'ST_SetSRID(ST_MakePoint(%s, %s), 4326)'
+
+
+def filter_bbox(queryset, bbox):
+    """表示範囲 (minLon, minLat, maxLon, maxLat) の中だけに絞る"""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if postgis_available(queryset.db):
+        return queryset.alias(in_bbox=RawSQL(
+            f'{_geom(queryset)} && ST_MakeEnvelope(%s, %s, %s, %s, 4326)',
+            (min_lon, min_lat, max_lon, max_lat), output_field=BooleanField(),
+        )).filter(in_bbox=True)
+    return queryset.filter(latitude__range=(min_lat, max_lat), longitude__range=(min_lon, max_lon))
+
+
+def _around(lat, lon, meters):
+    """(lat, lon) から meters 以内を必ず含む bbox"""
+    dlat = math.degrees(meters / EARTH_RADIUS_M)
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    return (max(lon - dlon, -180.0), max(lat - dlat, -90.0), min(lon + dlon, 180.0), min(lat + dlat, 90.0))
+
+
+def distance_expression(lat, lon):
+    """(lat, lon) からの大円距離（m）を DB で計算する式（haversine。SQLite でも使える）"""
+    dlat = Radians(F('latitude') - lat) / 2
+    dlon = Radians(F('longitude') - lon) / 2
+    a = Power(Sin(dlat), 2) + math.cos(math.radians(lat)) * Cos(Radians(F('latitude'))) * Power(Sin(dlon), 2)
+    return 2 * EARTH_RADIUS_M * ASin(Sqrt(a))
+
+
+def filter_radius(queryset, lat, lon, meters):
+    """(lat, lon) から meters 以内に絞り、distance_m（m）を付ける"""
+    # まずインデックスで bbox に絞る
+    queryset = filter_bbox(queryset, _around(lat, lon, meters))
+    if postgis_available(queryset.db):
+        point = _point_sql()
+        return queryset.annotate(distance_m=RawSQL(
+            f'ST_Distance({_geom(queryset)}::geography, {point}::geography)', (lon, lat), output_field=FloatField(),
+        )).filter(distance_m__lte=meters)
+    return queryset.annotate(distance_m=distance_expression(lat, lon)).filter(distance_m__lte=meters)
+
+
+def nearest(queryset, lat, lon, k, fields):
+    """(lat, lon) に近い順に k 件の (fields の値..., 距離m) を返す
+
+    PostGIS ではインデックスを使う KNN（<->）で候補を取り、正確な距離で並べ直す。
+    それ以外では全件の距離を NumPy で計算する（駅の数程度なら十分速い）。
+    """
+    queryset = queryset.exclude(latitude__isnull=True).exclude(longitude__isnull=True)
+    values = list(fields) + ['latitude', 'longitude']
+    if postgis_available(queryset.db):
+        # <-> は度単位の距離なので、経度方向の歪みを見込んで多めに取る
+        rows = list(
+            queryset.alias(knn=RawSQL(f'{_geom(queryset)} <-> {_point_sql()}', (lon, lat), output_field=FloatField()))
+            .order_by('knn').values_list(*values)[:max(k * 3, k + 10)]
+        )
+    else:
+        rows = list(queryset.values_list(*values))
+    if not rows:
+        return []
+    distances = haversine(lat, lon, [r[-2] for r in rows], [r[-1] for r in rows])
+    order = sorted(range(len(rows)), key=lambda i: (float(distances[i]), i))[:k]
+    return [(*rows[i][:-2], float(distances[i])) for i in order]
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# ---------------------------------------------------------
+# SQLite の接続ごとの設定（settings.SQLITE_PRAGMAS）
+#   journal_mode=WAL はDBファイルに記録されるが、それ以外の PRAGMA は接続ごとに設定が必要
+#   （apps.MapAppConfig.ready で読み込まれる）
+# ---------------------------------------------------------
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', None)
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
@@ -0,0 +1,101 @@
+// 地図の枠（map_shell.html）の描画
+//   データは api/map/compact/ の列指向フォーマット（compact.py）で取る。
+//   ブラウザが ETag で確認するので、変わっていなければ 304 で中身は送られてこない。
+//   グループの変更は api/events/（SSE）で受け取り、少し待ってから取り直す。
+//   SSE が使えないとき（WSGI で動かしていると 501）は、data-poll-seconds ごとに確認し直す。
+(function () {
+  'use strict';
+
+  var container = document.getElementById('map');
+  var payloadUrl = container.dataset.payloadUrl;
+  var eventsUrl = container.dataset.eventsUrl;
+  var pollSeconds = parseInt(container.dataset.pollSeconds, 10) || 0;
+  var map = L.map(container);
+  L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+    maxZoom: 19,
+    attribution: '&copy; OpenStreetMap contributors',
+  }).addTo(map);
+  var layer = L.layerGroup().addTo(map);
+  var centered = false;
+  var drawnTag = null;
+
+  function escapeHtml(text) {
+    return String(text).replace(/[&<>"']/g, function (c) {
+      return { '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' }[c];
+    });
+  }
+
+  function popup(block, i, users) {
+    var liked = block.likes[i].map(function (u) { return escapeHtml(users[u]); }).join('、') || 'まだいません';
+    return '<dl class="map-popup">' +
+      '<dt>' + escapeHtml(block.name[i]) + (block.matched[i] ? ' <span class="matched">全員いいね</span>' : '') + '</dt>' +
+      '<dd>' + escapeHtml(block.rent[i]) + '</dd>' +
+      '<dd>' + escapeHtml(block.address[i]) + '</dd>' +
+      '<dd>いいね: ' + liked + '</dd></dl>';
+  }
+
+  function draw(data) {
+    layer.clearLayers();
+    var stations = data.stations;
+    for (var s = 0; s < stations.name.length; s++) {
+      L.circleMarker([stations.lat[s], stations.lon[s]], { radius: 7, color: '#1c7ed6' })
+        .bindTooltip(escapeHtml(stations.name[s]))
+        .addTo(layer);
+    }
+    data.properties.forEach(function (block) {
+      for (var i = 0; i < block.id.length; i++) {
+        L.marker([block.lat[i], block.lon[i]], { opacity: block.matched[i] ? 1.0 : 0.7 })
+          .bindPopup(popup(block, i, data.users))
+          .addTo(layer);
+      }
+    });
+    if (!centered) {
+      map.setView([data.center.lat, data.center.lon], 14);
+      centered = true;
+    }
+  }
+
+  function load() {
+    // no-cache: キャッシュがあっても必ず ETag で確認する（変わっていなければ 304）
+    return fetch(payloadUrl, { credentials: 'same-origin', cache: 'no-cache' })
+      .then(function (response) {
+        if (!response.ok) { throw new Error('地図データを取得できませんでした: ' + response.status); }
+        // 304 でもブラウザはキャッシュの中身を返すので、ETag が同じなら描き直さない
+        var tag = response.headers.get('ETag');
+        if (tag && tag === drawnTag) { return null; }
+        drawnTag = tag;
+        return response.json();
+      })
+      .then(function (data) { if (data) { draw(data); } })
+      .catch(function (error) { console.error(error); });
+  }
+
+  var timer = null;
+  function reloadSoon() {
+    // 連続したイベント（一括登録など）は1回の取り直しにまとめる
+    clearTimeout(timer);
+    timer = setTimeout(load, 300);
+  }
+
+  var polling = null;
+  function startPolling() {
+    if (polling === null && pollSeconds > 0) {
+      polling = setInterval(load, pollSeconds * 1000);
+    }
+  }
+
+  load();
+  if (eventsUrl && window.EventSource) {
+    var source = new EventSource(eventsUrl);
+    ['property.added', 'property.updated', 'property.removed', 'properties.imported',
+     'like.changed', 'stations.changed', 'members.changed', 'resync'].forEach(function (type) {
+      source.addEventListener(type, reloadSoon);
+    });
+    source.addEventListener('error', function () {
+      // 接続が切れただけならブラウザが繋ぎ直す。200 以外（501 など）で閉じられたら、確認し直す方式にする
+      if (source.readyState === EventSource.CLOSED) { startPolling(); }
+    });
+  } else {
+    startPolling();
+  }
+})();
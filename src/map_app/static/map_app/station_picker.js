@@ -0,0 +1,88 @@
+// 駅選択画面（add_station.html）
+//   路線一覧（api/lines/）を読み込み、路線を開いたときにその路線の駅（api/lines/<id>/stations/）だけを取る。
+//   保存するときは、最初の選択から変わった駅だけを add / remove として送る（views.add_station）。
+(function () {
+  'use strict';
+
+  var form = document.getElementById('station-picker');
+  var linesUrl = form.dataset.linesUrl;
+  var lineStationsUrl = form.dataset.lineStationsUrl;
+  var initial = new Set(JSON.parse(form.dataset.selected || '[]'));
+  var selected = new Set(initial);
+  var list = document.getElementById('lines');
+  var count = document.getElementById('selected-count');
+
+  function getJson(url) {
+    // no-cache: ETag で確認する（駅データが変わっていなければ 304）
+    return fetch(url, { credentials: 'same-origin', cache: 'no-cache' }).then(function (response) {
+      if (!response.ok) { throw new Error('駅データを取得できませんでした: ' + response.status); }
+      return response.json();
+    });
+  }
+
+  function updateCount() {
+    count.textContent = selected.size;
+  }
+
+  function stationItem(station) {
+    var item = document.createElement('li');
+    var label = document.createElement('label');
+    var box = document.createElement('input');
+    box.type = 'checkbox';
+    box.checked = selected.has(station.id);
+    box.addEventListener('change', function () {
+      if (box.checked) { selected.add(station.id); } else { selected.delete(station.id); }
+      updateCount();
+    });
+    label.appendChild(box);
+    label.appendChild(document.createTextNode(' ' + station.name));
+    item.appendChild(label);
+    return item;
+  }
+
+  function lineItem(line) {
+    var item = document.createElement('li');
+    var details = document.createElement('details');
+    var summary = document.createElement('summary');
+    summary.textContent = line.name + '（' + line.station_count + '駅）';
+    details.appendChild(summary);
+    var loaded = false;
+    details.addEventListener('toggle', function () {
+      if (!details.open || loaded) { return; }
+      loaded = true;
+      getJson(lineStationsUrl.replace('/0/', '/' + line.id + '/'))
+        .then(function (data) {
+          var stations = document.createElement('ul');
+          stations.className = 'picker-stations';
+          data.stations.forEach(function (station) { stations.appendChild(stationItem(station)); });
+          details.appendChild(stations);
+        })
+        .catch(function (error) { loaded = false; console.error(error); });
+    });
+    item.appendChild(details);
+    return item;
+  }
+
+  function hidden(name, value) {
+    var input = document.createElement('input');
+    input.type = 'hidden';
+    input.name = name;
+    input.value = value;
+    return input;
+  }
+
+  form.addEventListener('submit', function () {
+    var diff = document.getElementById('diff');
+    diff.textContent = '';
+    selected.forEach(function (id) { if (!initial.has(id)) { diff.appendChild(hidden('add', id)); } });
+    initial.forEach(function (id) { if (!selected.has(id)) { diff.appendChild(hidden('remove', id)); } });
+  });
+
+  updateCount();
+  getJson(linesUrl)
+    .then(function (data) {
+      list.textContent = '';
+      data.lines.forEach(function (line) { list.appendChild(lineItem(line)); });
+    })
+    .catch(function (error) { list.textContent = '路線を読み込めませんでした'; console.error(error); });
+})();
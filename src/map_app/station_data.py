@@ -0,0 +1,237 @@
+import gzip
+import json
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+from . import events
+from .caching import bump_group_version, bump_station_data_version, station_data_version
+from .models import Line, MapGroup, Station
+
+# ---------------------------------------------------------
+# 路線・駅マスターデータの一括書き込みとスナップショット
+#   import_stations（API取得）と load_stations（スナップショット）の共通処理
+# ---------------------------------------------------------
+
+SNAPSHOT_FORMAT = 'dousei-map/stations'
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def upsert_network(line_names, stations_by_line, prune=False):
+    """路線と駅をまとめて登録・更新する
+
+    line_names: 並び順どおりの路線名のリスト
+    stations_by_line: {路線名: [{'name', 'lat', 'lon'}, ...]}（リストの順が駅の並び順）
+    (路線, 駅名) が同じ駅は上書き更新するので id が変わらず、MapGroup.selected_stations も切れない。
+    戻り値は (書き込んだ駅数, prune で削除した駅数)
+    """
+    with transaction.atomic():
+        Line.objects.bulk_create(
+            [Line(name=name, sort_order=i) for i, name in enumerate(line_names)],
+            update_conflicts=True,
+            unique_fields=['name'],
+            update_fields=['sort_order'],
+        )
+        line_ids = dict(Line.objects.filter(name__in=line_names).values_list('name', 'id'))
+
+        stations = []
+        for line_name, stations_list in stations_by_line.items():
+            seen = set()
+            for j, st in enumerate(stations_list):
+                # 同じ路線に同名の駅が2回出てくる場合（環状線など）は最初のものを使う
+                if st['name'] in seen:
+                    continue
+                seen.add(st['name'])
+                stations.append(Station(
+                    line_id=line_ids[line_name],
+                    name=st['name'],
+                    latitude=st['lat'],
+                    longitude=st['lon'],
+                    sort_order=st.get('sort_order', j),
+                ))
+
+        Station.objects.bulk_create(
+            stations,
+            batch_size=500,
+            update_conflicts=True,
+            unique_fields=['line', 'name'],
+            update_fields=['latitude', 'longitude', 'sort_order'],
+        )
+
+        pruned = 0
+        if prune:
+            for line_name, stations_list in stations_by_line.items():
+                pruned += Station.objects.filter(line_id=line_ids[line_name]).exclude(
+                    name__in=[st['name'] for st in stations_list]
+                ).delete()[0]
+
+        # 書き込みが確定してから、駅データから作ったものを作り直させる
+        transaction.on_commit(bump_station_data_version)
+
+    return len(stations), pruned
+
+
+def _open(path, mode):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def build_snapshot():
+    """DBの路線・駅を列指向の辞書にする
+
+    駅名は名前表に1回だけ入れて番号で参照する（乗り換え駅は複数路線に出てくるため）。
+    並び順を固定しているので、取り込みのたびに書き出したファイル同士を diff できる。
+    """
+    lines = list(Line.objects.order_by('sort_order', 'name').values_list('id', 'name'))
+    line_index = {line_id: i for i, (line_id, _) in enumerate(lines)}
+
+    rows = sorted(
+        Station.objects.values_list('line_id', 'sort_order', 'name', 'latitude', 'longitude'),
+        key=lambda r: (line_index[r[0]], r[1], r[2]),
+    )
+    names = sorted({r[2] for r in rows})
+    name_index = {name: i for i, name in enumerate(names)}
+
+    return {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'lines': [name for _, name in lines],
+        'names': names,
+        'stations': {
+            'line': [line_index[r[0]] for r in rows],
+            'name': [name_index[r[2]] for r in rows],
+            'sort_order': [r[1] for r in rows],
+            'lat': [round(r[3], 6) for r in rows],
+            'lon': [round(r[4], 6) for r in rows],
+        },
+    }
+
+
+def export_snapshot(path):
+    snapshot = build_snapshot()
+    with _open(path, 'w') as f:
+        # indent=0 で1要素1行にする（差分が行単位で読める）
+        json.dump(snapshot, f, ensure_ascii=False, indent=0)
+        f.write('\n')
+    return len(snapshot['lines']), len(snapshot['stations']['name'])
+
+
+def read_snapshot(path):
+    """スナップショットを読む。壊れている・途中で切れているなど、中身を読めないときは SnapshotError"""
+    try:
+        with _open(path, 'r') as f:
+            snapshot = json.load(f)
+    except (ValueError, EOFError, gzip.BadGzipFile) as e:
+        # JSON・UTF-8 として読めない、gzip が途中で切れている
+        raise SnapshotError(f'ファイルを読めません: {e}') from e
+    if not isinstance(snapshot, dict) or snapshot.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError('駅データのスナップショットではありません')
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError(f"未対応のバージョンです: {snapshot.get('version')}")
+
+    try:
+        return _parse_snapshot(snapshot)
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+        raise SnapshotError(f'中身が壊れています: {e!r}') from e
+
+
+def _parse_snapshot(snapshot):
+    columns = snapshot['stations']
+    lengths = {len(values) for values in columns.values()}
+    if len(lengths) > 1:
+        raise SnapshotError('列の長さがそろっていません')
+
+    line_names = [str(name) for name in snapshot['lines']]
+    names = snapshot['names']
+    stations_by_line = {name: [] for name in line_names}
+    for line_i, name_i, sort_order, lat, lon in zip(
+        columns['line'], columns['name'], columns['sort_order'], columns['lat'], columns['lon'],
+    ):
+        if line_i < 0 or name_i < 0:
+            raise IndexError('負の番号')
+        stations_by_line[line_names[line_i]].append(
+            {'name': str(names[name_i]), 'lat': float(lat), 'lon': float(lon), 'sort_order': int(sort_order)}
+        )
+    return line_names, stations_by_line
+
+
+def load_snapshot(path, prune=False):
+    line_names, stations_by_line = read_snapshot(path)
+    count, pruned = upsert_network(line_names, stations_by_line, prune=prune)
+    return len(line_names), count, pruned
+
+
+# ---------------------------------------------------------
+# 駅選択画面（add_station）用のデータ
+#   路線一覧と路線ごとの駅一覧は全グループ共通なので、JSON にしたバイト列を
+#   駅データのバージョンごとに1回だけ作ってキャッシュする（import のたびに作り直される）
+# ---------------------------------------------------------
+
+def _dump(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def line_tree_json():
+    """路線の一覧（駅数つき）。駅そのものは路線を開いたときに line_stations_json で取る"""
+    key = f'stations:tree:v{station_data_version()}'
+    data = cache.get(key)
+    if data is None:
+        lines = Line.objects.order_by('sort_order', 'pk').annotate(station_count=Count('stations'))
+        data = _dump({'lines': [
+            {'id': pk, 'name': name, 'station_count': count}
+            for pk, name, count in lines.values_list('pk', 'name', 'station_count')
+        ]})
+        cache.set(key, data, timeout=None)
+    return data
+
+
+def line_stations_json(line_id):
+    """1路線の駅一覧（並び順どおり）。路線が無ければ None"""
+    key = f'stations:line:{line_id}:v{station_data_version()}'
+    data = cache.get(key)
+    if data is None:
+        if not Line.objects.filter(pk=line_id).exists():
+            return None
+        stations = Station.objects.filter(line_id=line_id).order_by('sort_order', 'pk')
+        data = _dump({'line_id': line_id, 'stations': [
+            {'id': pk, 'name': name}
+            for pk, name in stations.values_list('pk', 'name')
+        ]})
+        cache.set(key, data, timeout=None)
+    return data
+
+
+def update_selected_stations(group, add_ids=(), remove_ids=()):
+    """グループの選択駅を差分だけ更新する（全削除→全登録はしない）
+
+    戻り値は (追加した数, 外した数)
+    """
+    Through = MapGroup.selected_stations.through
+    add_ids = set(add_ids) - set(remove_ids)
+    with transaction.atomic():
+        added = 0
+        new_ids = set()
+        if add_ids:
+            current = set(Through.objects.filter(mapgroup_id=group.pk, station_id__in=add_ids).values_list('station_id', flat=True))
+            # 存在する駅だけを追加する
+            new_ids = set(Station.objects.filter(pk__in=add_ids - current).values_list('pk', flat=True))
+            Through.objects.bulk_create(
+                [Through(mapgroup_id=group.pk, station_id=pk) for pk in new_ids], ignore_conflicts=True,
+            )
+            added = len(new_ids)
+        removed_ids = []
+        if remove_ids:
+            rows = Through.objects.filter(mapgroup_id=group.pk, station_id__in=set(remove_ids))
+            removed_ids = list(rows.values_list('station_id', flat=True))
+            rows.delete()
+        if new_ids or removed_ids:
+            # 中間テーブルを直接書き換えたので、シグナルの代わりにここでキャッシュを更新・通知する
+            bump_group_version(group.pk)
+            events.publish_station_change(group.pk, added_ids=new_ids, removed_ids=removed_ids)
+    return added, len(removed_ids)
@@ -1,3 +1,1476 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import httpx
+import numpy as np
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from config import static_files
+
+from . import (
+    bulk_import, caching, compact, events, geocoding, http_client, isochrone, metrics, rendering, spatial,
+    spatial_db, travel_matrix,
+)
+from .benchmarks import make_group, measure
+from .fixture_api import FixtureStationAPI, synthetic_network
+from .management.commands.bench_sqlite import PROFILES as SQLITE_PROFILES
+from .matching import set_like
+from .models import (
+    GEOCODE_DONE, GEOCODE_FAILED, GEOCODE_PENDING, GeocodeCache, Line, MapGroup, Property, Station, UserProfile,
+    parse_rent,
+)
+from .station_data import update_selected_stations
+from .views import build_map_payload
+
+
+def make_member(group, username):
+    user = User.objects.create_user(username=username, password='pass')
+    UserProfile.objects.create(user=user, group=group)
+    return user
+
+
+class MapPayloadQueryCountTests(TestCase):
+    """map_view のデータ組み立てが物件数に比例してクエリを増やさないことを確認する"""
+
+    def setUp(self):
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.alice = make_member(self.group, 'alice')
+        self.bob = make_member(self.group, 'bob')
+        line = Line.objects.create(name='JR山手線')
+        self.group.selected_stations.add(
+            Station.objects.create(line=line, name='新宿', latitude=35.690921, longitude=139.700258),
+            Station.objects.create(line=line, name='渋谷', latitude=35.658034, longitude=139.701636),
+        )
+
+    def add_properties(self, count):
+        for i in range(count):
+            prop = Property.objects.create(
+                group=self.group, name=f'物件{i}', address=f'東京都新宿区{i}', rent='10万円',
+                latitude=35.69 + i * 0.001, longitude=139.70,
+            )
+            prop.likes.add(self.alice)
+            if i % 2 == 0:
+                prop.likes.add(self.bob)
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            payload = build_map_payload(self.group)
+        return len(ctx.captured_queries), payload
+
+    def test_query_count_does_not_grow_with_properties(self):
+        self.add_properties(2)
+        small, _ = self.count_queries()
+        self.add_properties(30)
+        large, payload = self.count_queries()
+        self.assertEqual(len(payload['properties']), 32)
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, 3)
+
+    def test_payload_matches_is_matched(self):
+        self.add_properties(4)
+        Property.objects.create(group=self.group, name='座標なし', address='未取得', rent='8万円')
+        _, payload = self.count_queries()
+        by_id = {p['id']: p for p in payload['properties']}
+        self.assertEqual(len(by_id), 4)
+        for prop in Property.objects.filter(pk__in=by_id):
+            self.assertEqual(by_id[prop.pk]['is_matched'], prop.likes.count() >= 2)
+            self.assertEqual(
+                sorted(by_id[prop.pk]['liked_users']),
+                sorted(u.username for u in prop.likes.all()),
+            )
+        self.assertEqual(payload['center'], {'lat': 35.690921, 'lon': 139.700258})
+
+
+class FlakyGeocoder(geocoding.BaseGeocoder):
+    """最初の数回だけ一時的なエラーを返すジオコーダー"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def geocode(self, address):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise geocoding.TransientGeocodingError('timeout')
+        return 35.0, 139.0
+
+
+class BrokenAddressGeocoder(geocoding.StubGeocoder):
+    """「壊れた住所」だけ一時的なエラーを返し続けるジオコーダー"""
+
+    def geocode(self, address):
+        if address == '壊れた住所':
+            self.calls.append(address)
+            raise geocoding.TransientGeocodingError('timeout')
+        return super().geocode(address)
+
+
+@override_settings(GEOCODER_BACKEND='map_app.geocoding.StubGeocoder', GEOCODER_MIN_INTERVAL=0)
+class GeocodingTests(TestCase):
+
+    def setUp(self):
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.geocoder = geocoding.StubGeocoder()
+
+    def test_normalize_address(self):
+        self.assertEqual(
+            geocoding.normalize_address('東京都 新宿区西新宿１ー１－１'),
+            geocoding.normalize_address('東京都新宿区西新宿1-1-1'),
+        )
+
+    def test_same_address_is_geocoded_once(self):
+        for address in ['東京都新宿区西新宿１－１', '東京都新宿区西新宿1-1', '東京都渋谷区道玄坂1-1']:
+            Property.objects.create(group=self.group, name='物件', address=address, rent='10万円')
+
+        stats = geocoding.geocode_pending(geocoder=self.geocoder, sleep=lambda s: None)
+        self.assertEqual(stats['updated'], 3)
+        self.assertEqual(len(self.geocoder.calls), 2)
+        self.assertFalse(Property.objects.filter(latitude__isnull=True).exists())
+
+        # 2回目以降はキャッシュから即座に座標が入る
+        prop = Property(group=self.group, name='別物件', address='東京都新宿区西新宿 1-1', rent='9万円')
+        self.assertTrue(geocoding.apply_cached_coordinates(prop))
+        self.assertEqual(prop.geocode_status, GEOCODE_DONE)
+        self.assertIsNotNone(prop.latitude)
+        self.assertEqual(len(self.geocoder.calls), 2)
+
+    def test_geocoding_refreshes_the_cached_payload(self):
+        cache.clear()
+        self.client.force_login(make_member(self.group, 'alice'))
+        prop = Property.objects.create(group=self.group, name='物件', address='東京都港区1-1', rent='10万円')
+        self.assertEqual(self.client.get(reverse('map_payload')).json()['properties'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with mock.patch.object(events, 'publish') as publish:
+                geocoding.geocode_pending(geocoder=self.geocoder, sleep=lambda s: None)
+        publish.assert_called_once()
+        self.assertEqual(publish.call_args.args[:2], (self.group.pk, 'property.updated'))
+        properties = self.client.get(reverse('map_payload')).json()['properties']
+        self.assertEqual([p['id'] for p in properties], [prop.pk])
+
+    def test_not_found_is_cached(self):
+        self.geocoder.results[geocoding.normalize_address('存在しない住所')] = None
+        prop = Property.objects.create(group=self.group, name='物件', address='存在しない住所', rent='10万円')
+        stats = geocoding.geocode_pending(geocoder=self.geocoder, sleep=lambda s: None)
+        self.assertEqual(stats['not_found'], 1)
+        prop.refresh_from_db()
+        self.assertEqual(prop.geocode_status, GEOCODE_FAILED)
+        self.assertFalse(GeocodeCache.objects.get().found)
+
+    def test_transient_errors_are_retried(self):
+        Property.objects.create(group=self.group, name='物件', address='東京都港区1-1', rent='10万円')
+        geocoder = FlakyGeocoder(failures=2)
+        stats = geocoding.geocode_pending(geocoder=geocoder, max_retries=3, sleep=lambda s: None)
+        self.assertEqual(geocoder.calls, 3)
+        self.assertEqual(stats['geocoded'], 1)
+
+    def test_exhausted_retries_stay_pending(self):
+        prop = Property.objects.create(group=self.group, name='物件', address='東京都港区1-1', rent='10万円')
+        stats = geocoding.geocode_pending(geocoder=FlakyGeocoder(failures=10), max_retries=1, sleep=lambda s: None)
+        self.assertEqual(stats['errors'], 1)
+        prop.refresh_from_db()
+        self.assertEqual(prop.geocode_status, GEOCODE_PENDING)
+
+    def test_failing_rows_do_not_starve_the_rest(self):
+        broken = Property.objects.create(group=self.group, name='物件', address='壊れた住所', rent='10万円')
+        other = Property.objects.create(group=self.group, name='物件', address='東京都港区1-1', rent='10万円')
+        geocoder = BrokenAddressGeocoder()
+        geocoding.geocode_pending(limit=1, geocoder=geocoder, max_retries=0, sleep=lambda s: None)
+        stats = geocoding.geocode_pending(limit=1, geocoder=geocoder, max_retries=0, sleep=lambda s: None)
+        self.assertEqual(stats['geocoded'], 1)
+        self.assertEqual(geocoder.calls, ['壊れた住所', '東京都港区1-1'])
+        broken.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((broken.geocode_status, other.geocode_status), (GEOCODE_PENDING, GEOCODE_DONE))
+
+    def test_stub_state_is_per_instance(self):
+        first = geocoding.StubGeocoder({geocoding.normalize_address('どこか'): None})
+        first.geocode('どこか')
+        second = geocoding.StubGeocoder()
+        self.assertEqual((second.calls, second.results), ([], {}))
+        self.assertIsNotNone(second.geocode('どこか'))
+
+
+class ImportStationsTests(TestCase):
+
+    def run_import(self, api, **options):
+        call_command('import_stations', base_url=api.base_url, stdout=io.StringIO(), stderr=io.StringIO(), **options)
+
+    def test_upsert_is_idempotent_and_keeps_selected_stations(self):
+        network = synthetic_network(num_lines=5, stations_per_line=6)
+        group = MapGroup.objects.create(name='テストペア', password='secret')
+
+        with FixtureStationAPI(network) as api:
+            self.run_import(api, workers=3)
+            self.assertEqual(Line.objects.count(), 5)
+            self.assertEqual(Station.objects.count(), 30)
+            station = Station.objects.get(line__name='路線0', name='駅0-3')
+            group.selected_stations.add(station)
+
+            # 座標が変わった状態で再取り込みしても、行は増えず id も変わらない
+            network['路線0'][3]['y'] = 36.0
+            self.run_import(api, workers=3)
+
+        self.assertEqual(Line.objects.count(), 5)
+        self.assertEqual(Station.objects.count(), 30)
+        self.assertEqual(list(group.selected_stations.all()), [station])
+        station.refresh_from_db()
+        self.assertEqual(station.latitude, 36.0)
+
+    def test_prune_removes_stations_missing_from_api(self):
+        network = synthetic_network(num_lines=2, stations_per_line=4)
+        with FixtureStationAPI(network) as api:
+            self.run_import(api)
+            network['路線1'].pop()
+            self.run_import(api, prune=True)
+        self.assertEqual(Station.objects.filter(line__name='路線1').count(), 3)
+
+
+class StationSnapshotTests(TestCase):
+
+    def setUp(self):
+        with FixtureStationAPI(synthetic_network(num_lines=4, stations_per_line=5)) as api:
+            call_command('import_stations', base_url=api.base_url, stdout=io.StringIO())
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def dump(self):
+        return sorted(Station.objects.values_list('line__name', 'line__sort_order', 'name', 'latitude', 'longitude', 'sort_order'))
+
+    def test_round_trip(self):
+        before = self.dump()
+        for filename in ['stations.json', 'stations.json.gz']:
+            path = os.path.join(self.tmpdir.name, filename)
+            call_command('export_stations', path, stdout=io.StringIO())
+            Line.objects.all().delete()
+            with self.assertNumQueries(5):
+                call_command('load_stations', path, stdout=io.StringIO())
+            self.assertEqual(self.dump(), before)
+
+    def test_export_is_stable_for_diffing(self):
+        first = os.path.join(self.tmpdir.name, 'a.json')
+        second = os.path.join(self.tmpdir.name, 'b.json')
+        call_command('export_stations', first, stdout=io.StringIO())
+        call_command('load_stations', first, stdout=io.StringIO())
+        call_command('export_stations', second, stdout=io.StringIO())
+        with open(first, encoding='utf-8') as a, open(second, encoding='utf-8') as b:
+            self.assertEqual(a.read(), b.read())
+
+
+    def test_broken_snapshots_are_a_command_error(self):
+        path = os.path.join(self.tmpdir.name, 'stations.json.gz')
+        call_command('export_stations', path, stdout=io.StringIO())
+        with open(path, 'rb') as f:
+            data = f.read()
+        header = {'format': 'dousei-map/stations', 'version': 1}
+        broken = {
+            # 途中で切れた gzip
+            'truncated.json.gz': data[:len(data) // 2],
+            'not_json.json': b'{"format": ',
+            'list.json': b'[1, 2]',
+            # 路線の番号が範囲外・列が文字列
+            'bad_index.json': json.dumps({**header, 'lines': ['A'], 'names': ['x'], 'stations': {
+                'line': [3], 'name': [0], 'sort_order': [0], 'lat': [35.0], 'lon': [139.0]}}).encode(),
+            'bad_columns.json': json.dumps({**header, 'lines': ['A'], 'names': ['x'], 'stations': ['oops']}).encode(),
+            'bad_value.json': json.dumps({**header, 'lines': ['A'], 'names': ['x'], 'stations': {
+                'line': [0], 'name': [0], 'sort_order': [None], 'lat': [35.0], 'lon': [139.0]}}).encode(),
+        }
+        for filename, content in broken.items():
+            broken_path = os.path.join(self.tmpdir.name, filename)
+            with open(broken_path, 'wb') as f:
+                f.write(content)
+            with self.subTest(filename), self.assertRaises(CommandError):
+                call_command('load_stations', broken_path, stdout=io.StringIO())
+
+
+class StationIndexTests(TestCase):
+
+    def test_nearest_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        lats = 35.5 + rng.random(500) * 0.4
+        lons = 139.4 + rng.random(500) * 0.5
+        index = spatial.StationIndex([(i, f'駅{i}', '路線', lat, lon) for i, (lat, lon) in enumerate(zip(lats, lons))])
+
+        for lat, lon in [(35.69, 139.70), (35.0, 139.0), (36.5, 140.5)]:
+            expected = np.argsort(spatial.haversine(lat, lon, lats, lons))[:7]
+            got = [int(index.ids[i]) for i, _ in index.nearest(lat, lon, k=7)]
+            self.assertEqual(got, expected.tolist())
+
+    def test_index_is_rebuilt_after_import(self):
+        spatial.reset_station_index()
+        network = synthetic_network(num_lines=2, stations_per_line=3)
+        with FixtureStationAPI(network) as api:
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('import_stations', base_url=api.base_url, stdout=io.StringIO())
+            index = spatial.get_station_index()
+            self.assertEqual(len(index), 6)
+            # データが変わらなければ、時間が経っても作り直さない（fork 前に作ったものを共有し続ける）
+            with mock.patch('time.monotonic', return_value=time.monotonic() + 86400):
+                self.assertIs(spatial.get_station_index(), index)
+            network['路線2'] = [{'name': '新駅', 'x': 139.7, 'y': 35.7}]
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command('import_stations', base_url=api.base_url, stdout=io.StringIO())
+        self.assertEqual(len(spatial.get_station_index()), 7)
+
+
+class NearestStationApiTests(TestCase):
+
+    def setUp(self):
+        spatial.reset_station_index()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.user = make_member(self.group, 'alice')
+        line = Line.objects.create(name='JR山手線')
+        self.shinjuku = Station.objects.create(line=line, name='新宿', latitude=35.690921, longitude=139.700258)
+        self.shibuya = Station.objects.create(line=line, name='渋谷', latitude=35.658034, longitude=139.701636)
+        Station.objects.create(line=line, name='池袋', latitude=35.728926, longitude=139.71038)
+        self.group.selected_stations.add(self.shinjuku, self.shibuya)
+        self.client.force_login(self.user)
+
+    def test_nearest_to_point(self):
+        response = self.client.get(reverse('nearest_stations'), {'lat': 35.66, 'lon': 139.70, 'k': 2})
+        names = [s['name'] for s in response.json()['stations']]
+        self.assertEqual(names, ['渋谷', '新宿'])
+
+    def test_nearest_to_property_within_selected(self):
+        prop = Property.objects.create(group=self.group, name='物件', address='池袋', rent='10万円',
+                                       latitude=35.7289, longitude=139.7104)
+        response = self.client.get(reverse('nearest_stations'), {'property': prop.pk, 'k': 1, 'scope': 'selected'})
+        self.assertEqual(response.json()['stations'][0]['name'], '新宿')
+
+    def test_bad_point(self):
+        response = self.client.get(reverse('nearest_stations'), {'lat': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_group_properties_nearest(self):
+        near_shibuya = Property.objects.create(group=self.group, name='A', address='a', rent='1万円',
+                                               latitude=35.659, longitude=139.70)
+        Property.objects.create(group=self.group, name='B', address='b', rent='1万円')
+        # セッション・ユーザー・プロフィール・グループ + 駅 + 物件（物件数によらない）
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse('property_nearest_stations'))
+        results = response.json()['properties']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['property_id'], near_shibuya.pk)
+        self.assertEqual(results[0]['station']['name'], '渋谷')
+        self.assertLess(results[0]['distance_m'], 200)
+
+    def test_radius_matches_haversine(self):
+        # 渋谷まで約1.1km、新宿まで約2.7km
+        response = self.client.get(reverse('nearest_stations'), {'lat': 35.668, 'lon': 139.702, 'radius': 2000})
+        stations = response.json()['stations']
+        self.assertEqual([s['name'] for s in stations], ['渋谷'])
+        expected = float(spatial.haversine(35.668, 139.702, 35.658034, 139.701636))
+        self.assertAlmostEqual(stations[0]['distance_m'], expected, delta=0.5)
+
+    def test_bbox_filter_uses_spatial_index(self):
+        queryset = spatial_db.filter_bbox(Station.objects.all(), (139.69, 35.65, 139.71, 35.70))
+        self.assertEqual(set(queryset.values_list('name', flat=True)), {'新宿', '渋谷'})
+        plan = queryset.explain()
+        if connection.vendor == 'postgresql' and spatial_db.postgis_available():
+            self.assertIn('geom_gist', plan)
+        else:
+            self.assertIn('station_lat_lon_idx', plan)
+
+
+class ViewportApiTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.user = make_member(self.group, 'alice')
+        # 新宿付近に10件、渋谷付近に5件、範囲外（横浜）に1件
+        for i in range(10):
+            Property.objects.create(group=self.group, name=f'新宿{i}', address='a', rent='1万円',
+                                    latitude=35.690 + i * 0.0001, longitude=139.700)
+        for i in range(5):
+            Property.objects.create(group=self.group, name=f'渋谷{i}', address='b', rent='1万円',
+                                    latitude=35.658 + i * 0.0001, longitude=139.701)
+        Property.objects.create(group=self.group, name='横浜', address='c', rent='1万円',
+                                latitude=35.4437, longitude=139.638)
+        self.client.force_login(self.user)
+        self.bbox = '139.6,35.6,139.8,35.8'
+
+    def test_only_features_in_bbox(self):
+        response = self.client.get(reverse('viewport_properties'), {'bbox': self.bbox, 'zoom': 16})
+        data = response.json()
+        self.assertFalse(data['clustered'])
+        self.assertEqual(len(data['features']), 15)
+
+    def test_low_zoom_is_clustered(self):
+        response = self.client.get(reverse('viewport_properties'), {'bbox': self.bbox, 'zoom': 11})
+        features = response.json()['features']
+        self.assertEqual(sorted(f['count'] for f in features), [5, 10])
+        self.assertTrue(all(f['cluster'] for f in features))
+
+    def test_etag_returns_304(self):
+        url = reverse('viewport_properties')
+        first = self.client.get(url, {'bbox': self.bbox, 'zoom': 11})
+        second = self.client.get(url, {'bbox': self.bbox, 'zoom': 11}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 304)
+
+        Property.objects.create(group=self.group, name='新物件', address='d', rent='1万円',
+                                latitude=35.70, longitude=139.75)
+        third = self.client.get(url, {'bbox': self.bbox, 'zoom': 11}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(third.status_code, 200)
+
+    def test_nearby_bboxes_share_a_cache_entry(self):
+        url = reverse('viewport_properties')
+        first = self.client.get(url, {'bbox': '139.6001,35.6001,139.7999,35.7999', 'zoom': 11}).json()
+        # 少しずらしただけなら同じタイル範囲になり、キャッシュから返る（セッション・ユーザー・プロフィール・グループだけ）
+        with self.assertNumQueries(4):
+            second = self.client.get(url, {'bbox': '139.6002,35.6002,139.7998,35.7998', 'zoom': 11}).json()
+        self.assertEqual(first, second)
+        self.assertEqual(first['bbox'], list(spatial.snap_bbox((139.6001, 35.6001, 139.7999, 35.7999), 11)))
+
+    def test_invalid_bbox(self):
+        response = self.client.get(reverse('viewport_stations'), {'bbox': '1,2,3'})
+        self.assertEqual(response.status_code, 400)
+
+
+class GroupPayloadCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        caching.reset_cache_stats()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.user = make_member(self.group, 'alice')
+        line = Line.objects.create(name='JR山手線')
+        self.station = Station.objects.create(line=line, name='新宿', latitude=35.690921, longitude=139.700258)
+        self.prop = Property.objects.create(group=self.group, name='物件', address='a', rent='1万円',
+                                            latitude=35.69, longitude=139.70)
+        self.client.force_login(self.user)
+
+    def assert_bumps(self, change):
+        before = caching.group_version(self.group.pk)
+        change()
+        self.assertNotEqual(caching.group_version(self.group.pk), before)
+
+    def test_changes_bump_group_version(self):
+        other_group = MapGroup.objects.create(name='別ペア', password='secret')
+        bob = User.objects.create_user(username='bob', password='pass')
+        self.assert_bumps(lambda: Property.objects.create(group=self.group, name='新', address='b', rent='1万円'))
+        self.assert_bumps(lambda: self.prop.likes.add(self.user))
+        self.assert_bumps(lambda: self.user.liked_properties.clear())
+        self.assert_bumps(lambda: self.group.selected_stations.add(self.station))
+        self.assert_bumps(lambda: self.station.selected_by_groups.remove(self.group))
+        self.assert_bumps(lambda: UserProfile.objects.create(user=bob, group=self.group))
+
+        def leave():
+            profile = bob.profile
+            profile.group = other_group
+            profile.save()
+        self.assert_bumps(leave)
+        self.assert_bumps(self.prop.delete)
+
+    def test_payload_is_served_from_cache_until_changed(self):
+        url = reverse('map_payload')
+        first = self.client.get(url)
+        second = self.client.get(url)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(caching.cache_stats()['hits'], 1)
+        self.assertEqual(caching.cache_stats()['misses'], 1)
+
+        self.prop.likes.add(self.user)
+        third = self.client.get(url)
+        self.assertEqual(caching.cache_stats()['misses'], 2)
+        self.assertEqual(third.json()['properties'][0]['liked_users'], ['alice'])
+
+    def test_unchanged_payload_returns_304_without_building(self):
+        url = reverse('map_payload')
+        etag = self.client.get(url)['ETag']
+        # セッション・ユーザー・プロフィール（グループと結合）だけ（物件や駅は読まない）
+        with self.assertNumQueries(3):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_cache_stats_is_staff_only(self):
+        self.assertEqual(self.client.get(reverse('cache_stats')).status_code, 302)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertIn('hits', self.client.get(reverse('cache_stats')).json())
+
+
+class MatchStateTests(TestCase):
+
+    def setUp(self):
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.alice = make_member(self.group, 'alice')
+        self.bob = make_member(self.group, 'bob')
+        self.prop = Property.objects.create(group=self.group, name='物件', address='a', rent='1万円')
+
+    def state(self):
+        self.prop.refresh_from_db()
+        return self.prop.like_count, self.prop.is_matched
+
+    def test_likes_update_count_and_match(self):
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 2)
+        self.prop.likes.add(self.alice)
+        self.assertEqual(self.state(), (1, False))
+        self.bob.liked_properties.add(self.prop)
+        self.assertEqual(self.state(), (2, True))
+        # いいねしていない人を remove しても数は変わらない
+        self.prop.likes.remove(User.objects.create_user(username='carol', password='pass'))
+        self.assertEqual(self.state(), (2, True))
+        self.alice.liked_properties.clear()
+        self.assertEqual(self.state(), (1, False))
+
+    def test_members_joining_and_leaving_update_match(self):
+        self.prop.likes.add(self.alice, self.bob)
+        self.assertEqual(self.state(), (2, True))
+
+        carol = make_member(self.group, 'carol')
+        self.assertEqual(self.state(), (2, False))
+
+        profile = carol.profile
+        profile.group = None
+        profile.save()
+        self.assertEqual(self.state(), (2, True))
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 2)
+
+    def test_deleting_a_user_recounts_their_likes(self):
+        carol = make_member(self.group, 'carol')
+        self.prop.likes.add(self.alice, carol)
+        self.assertEqual(self.state(), (2, False))
+        # いいねの行は CASCADE で消える（m2m_changed は出ない）
+        carol.delete()
+        self.assertEqual(self.state(), (1, False))
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 2)
+
+    def test_matched_filter_uses_stored_state(self):
+        self.prop.likes.add(self.alice, self.bob)
+        Property.objects.create(group=self.group, name='未マッチ', address='b', rent='1万円')
+        self.assertEqual(list(Property.objects.filter(is_matched=True)), [self.prop])
+
+    def test_rebuild_command(self):
+        self.prop.likes.add(self.alice, self.bob)
+        Property.objects.update(like_count=0, is_matched=False)
+        MapGroup.objects.update(member_count=5)
+        tag = caching.payload_tag(self.group.pk, 'map')
+        call_command('rebuild_match_state', stdout=io.StringIO())
+        self.assertEqual(self.state(), (2, True))
+        # 数え直した結果がキャッシュ済みの地図データにも反映される
+        self.assertNotEqual(caching.payload_tag(self.group.pk, 'map'), tag)
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 2)
+
+
+class ToggleLikeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.alice = make_member(self.group, 'alice')
+        self.bob = make_member(self.group, 'bob')
+        self.prop = Property.objects.create(group=self.group, name='物件', address='a', rent='1万円')
+        self.url = reverse('toggle_like', args=[self.prop.pk])
+        self.client.force_login(self.alice)
+
+    def test_toggle_returns_new_state(self):
+        data = self.client.post(self.url).json()
+        self.assertEqual((data['liked'], data['like_count'], data['is_matched']), (True, 1, False))
+        self.prop.likes.add(self.bob)
+        data = self.client.post(self.url).json()
+        self.assertEqual((data['liked'], data['like_count']), (False, 1))
+        data = self.client.post(self.url).json()
+        self.assertEqual((data['liked'], data['like_count'], data['is_matched']), (True, 2, True))
+
+    def test_explicit_state_is_idempotent(self):
+        for _ in range(3):
+            data = self.client.post(self.url, {'liked': '1'}).json()
+        self.assertEqual((data['liked'], data['changed'], data['like_count']), (True, False, 1))
+        self.assertEqual(self.prop.likes.count(), 1)
+        data = self.client.post(self.url, {'liked': '0'}).json()
+        data = self.client.post(self.url, {'liked': '0'}).json()
+        self.assertEqual((data['liked'], data['changed'], data['like_count']), (False, False, 0))
+
+    def test_bumps_group_version(self):
+        before = caching.group_version(self.group.pk)
+        self.client.post(self.url)
+        self.assertNotEqual(caching.group_version(self.group.pk), before)
+
+    def test_post_only_and_own_group_only(self):
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+        other = MapGroup.objects.create(name='別ペア', password='secret')
+        other_prop = Property.objects.create(group=other, name='物件', address='a', rent='1万円')
+        self.assertEqual(self.client.post(reverse('toggle_like', args=[other_prop.pk])).status_code, 404)
+
+
+class StationPickerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.user = make_member(self.group, 'alice')
+        self.line = Line.objects.create(name='JR山手線')
+        self.stations = [
+            Station.objects.create(line=self.line, name=f'駅{i}', latitude=35.6, longitude=139.7, sort_order=i)
+            for i in range(5)
+        ]
+        self.client.force_login(self.user)
+
+    def test_tree_is_cached_until_import(self):
+        url = reverse('station_lines')
+        self.assertEqual(self.client.get(url).json()['lines'][0]['station_count'], 5)
+        # セッション・ユーザーだけ（路線・駅は読まない）
+        with self.assertNumQueries(2):
+            self.client.get(url)
+
+        Line.objects.create(name='東京メトロ銀座線')
+        self.assertEqual(len(self.client.get(url).json()['lines']), 1)
+        caching.bump_station_data_version()
+        self.assertEqual(len(self.client.get(url).json()['lines']), 2)
+
+    def test_line_stations(self):
+        data = self.client.get(reverse('line_stations', args=[self.line.pk])).json()
+        self.assertEqual([s['name'] for s in data['stations']], [f'駅{i}' for i in range(5)])
+        self.assertEqual(self.client.get(reverse('line_stations', args=[9999])).status_code, 404)
+
+    @override_settings(STORAGES={
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    })
+    def test_page_loads_lines_lazily(self):
+        self.group.selected_stations.add(self.stations[1])
+        response = self.client.get(reverse('add_station'))
+        self.assertContains(response, f'data-lines-url="{reverse("station_lines")}"')
+        self.assertContains(response, f'data-selected="[{self.stations[1].pk}]"')
+        # 駅は埋め込まない
+        self.assertNotContains(response, '駅0')
+
+    def test_post_applies_only_the_diff(self):
+        url = reverse('add_station')
+        self.group.selected_stations.add(self.stations[0], self.stations[1])
+        before = caching.group_version(self.group.pk)
+        response = self.client.post(
+            url, {'add': [self.stations[2].pk, 9999], 'remove': [self.stations[0].pk]},
+            HTTP_ACCEPT='application/json',
+        )
+        self.assertEqual(response.json(), {'added': 1, 'removed': 1})
+        self.assertEqual(
+            set(self.group.selected_stations.values_list('pk', flat=True)),
+            {self.stations[1].pk, self.stations[2].pk},
+        )
+        self.assertNotEqual(caching.group_version(self.group.pk), before)
+
+    def test_legacy_full_selection_post(self):
+        self.group.selected_stations.add(self.stations[0])
+        response = self.client.post(reverse('add_station'), {'selected_stations': [self.stations[3].pk]})
+        self.assertRedirects(response, reverse('index'), fetch_redirect_response=False)
+        self.assertEqual(list(self.group.selected_stations.all()), [self.stations[3]])
+
+
+class IsochroneTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        isochrone.reset_station_graph()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.user = make_member(self.group, 'alice')
+        yamanote = Line.objects.create(name='JR山手線')
+        chuo = Line.objects.create(name='JR中央線')
+        self.shibuya = Station.objects.create(line=yamanote, name='渋谷', latitude=35.658, longitude=139.7016, sort_order=0)
+        Station.objects.create(line=yamanote, name='新宿', latitude=35.6909, longitude=139.7003, sort_order=1)
+        Station.objects.create(line=chuo, name='新宿', latitude=35.6909, longitude=139.7003, sort_order=0)
+        self.nakano = Station.objects.create(line=chuo, name='中野', latitude=35.7056, longitude=139.6657, sort_order=1)
+        self.client.force_login(self.user)
+
+    def test_travel_times_include_transfer(self):
+        graph = isochrone.StationGraph.from_db()
+        times = graph.travel_times([graph.position[self.shibuya.pk]])
+        nakano = times[graph.position[self.nakano.pk]]
+        # 渋谷→新宿（約3.7km）→ 乗り換え → 中野（約3.5km）
+        self.assertGreater(nakano, isochrone.TRANSFER_MIN + 2 * isochrone.STOP_PENALTY_MIN)
+        self.assertLess(nakano, 25)
+
+    def test_endpoint_returns_bands_and_grid(self):
+        self.group.selected_stations.add(self.shibuya)
+        data = self.client.get(reverse('isochrone'), {'budget': 20, 'bands': '10,20'}).json()
+        self.assertEqual(data['bands'], [10, 20])
+        self.assertEqual(data['stations'][0], {'id': self.shibuya.pk, 'name': '渋谷', 'minutes': 0.0})
+        self.assertEqual({run[3] for run in data['grid']['cells']}, {0, 1})
+
+    def test_budget_is_always_the_last_band(self):
+        self.group.selected_stations.add(self.shibuya)
+        data = self.client.get(reverse('isochrone'), {'budget': 30, 'bands': '10,20'}).json()
+        self.assertEqual(data['bands'], [10, 20, 30])
+        self.assertEqual({run[3] for run in data['grid']['cells']}, {0, 1, 2})
+
+    def test_result_is_cached_per_station_set(self):
+        with self.assertNumQueries(1):
+            isochrone.get_isochrone([self.shibuya.pk], 20, [10, 20])
+        with self.assertNumQueries(0):
+            isochrone.get_isochrone([self.shibuya.pk], 20, [10, 20])
+
+    def test_invalid_budget(self):
+        self.assertEqual(self.client.get(reverse('isochrone'), {'budget': 500}).status_code, 400)
+
+
+class TravelMatrixTests(TestCase):
+
+    def setUp(self):
+        yamanote = Line.objects.create(name='JR山手線')
+        chuo = Line.objects.create(name='JR中央線')
+        self.shibuya = Station.objects.create(line=yamanote, name='渋谷', latitude=35.658, longitude=139.7016, sort_order=0)
+        self.shinjuku = Station.objects.create(line=yamanote, name='新宿', latitude=35.6909, longitude=139.7003, sort_order=1)
+        self.shinjuku_chuo = Station.objects.create(line=chuo, name='新宿', latitude=35.6909, longitude=139.7003, sort_order=0)
+        self.nakano = Station.objects.create(line=chuo, name='中野', latitude=35.7056, longitude=139.6657, sort_order=1)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'matrix.npy')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_command_writes_memory_mapped_matrix(self):
+        call_command('build_travel_matrix', path=self.path, weight='hops', stdout=io.StringIO())
+        with override_settings(TRAVEL_MATRIX_PATH=self.path):
+            matrix = travel_matrix.get_travel_matrix()
+        self.assertIsInstance(matrix.matrix, np.memmap)
+        self.assertEqual(matrix.matrix.dtype, np.uint16)
+        # 同名駅は1つの頂点になる（渋谷・新宿・中野）
+        self.assertEqual(matrix.matrix.shape, (3, 3))
+        self.assertEqual(matrix.between(self.shibuya.pk, self.nakano.pk), 2)
+        self.assertEqual(matrix.between(self.shinjuku.pk, self.shinjuku_chuo.pk), 0)
+        # 駅の対応も同じファイルに入っていて、.npy としてもそのまま読める
+        self.assertEqual(os.listdir(self.tmp.name), ['matrix.npy'])
+        self.assertEqual(np.load(self.path).tolist(), matrix.matrix.tolist())
+
+    def test_time_weight_and_table(self):
+        travel_matrix.build_matrix_from_db(self.path)
+        matrix = travel_matrix.TravelMatrix(self.path)
+        seconds = matrix.between(self.shibuya.pk, self.nakano.pk)
+        self.assertGreater(seconds, 5 * 60)
+        table = matrix.table([self.shibuya.pk, 999999], [self.nakano.pk, self.shibuya.pk])
+        self.assertEqual(table[0].tolist(), [seconds, 0])
+        self.assertTrue(np.isinf(table[1]).all())
+
+
+class PropertyRankingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.alice = make_member(self.group, 'alice')
+        self.bob = make_member(self.group, 'bob')
+        line = Line.objects.create(name='JR山手線')
+        self.group.selected_stations.add(
+            Station.objects.create(line=line, name='新宿', latitude=35.6909, longitude=139.7003, sort_order=0)
+        )
+        self.near = Property.objects.create(group=self.group, name='駅前', address='a', rent='15万円', latitude=35.6912, longitude=139.7005)
+        self.cheap = Property.objects.create(group=self.group, name='郊外', address='b', rent='８.５万円', latitude=35.72, longitude=139.74)
+        self.unknown = Property.objects.create(group=self.group, name='未定', address='c', rent='20万円')
+        self.client.force_login(self.alice)
+
+    def test_parse_rent(self):
+        self.assertEqual(parse_rent('12万円'), 120000)
+        self.assertEqual(parse_rent('12.5万'), 125000)
+        self.assertEqual(parse_rent('12万5000円'), 125000)
+        self.assertEqual(parse_rent('120,000円'), 120000)
+        self.assertEqual(parse_rent('12'), 120000)
+        self.assertIsNone(parse_rent('相談'))
+        self.assertEqual(self.cheap.rent_yen, 85000)
+
+    def test_sorted_by_score_and_rent(self):
+        url = reverse('property_ranking')
+        ids = [r['id'] for r in self.client.get(url).json()['results']]
+        self.assertEqual(ids, [self.near.pk, self.cheap.pk, self.unknown.pk])
+
+        results = self.client.get(url, {'sort': 'rent'}).json()['results']
+        self.assertIsNone(results[2]['nearest_station'])
+        self.assertEqual([r['rent_yen'] for r in results], [85000, 150000, 200000])
+        self.assertEqual(results[1]['nearest_station']['name'], '新宿')
+
+    def test_likes_and_filters(self):
+        set_like(self.cheap, self.alice, True)
+        set_like(self.cheap, self.bob, True)
+        url = reverse('property_ranking')
+        data = self.client.get(url, {'w_rent': 0, 'w_distance': 0, 'w_likes': 1}).json()
+        self.assertEqual(data['results'][0]['id'], self.cheap.pk)
+        self.assertEqual(data['results'][0]['score'], 1.0)
+
+        data = self.client.get(url, {'max_rent': 100000, 'per_page': 1}).json()
+        self.assertEqual((data['count'], data['num_pages']), (1, 1))
+        self.assertEqual(self.client.get(url, {'sort': 'cheap'}).status_code, 400)
+        for value in ('nan', 'inf', '-inf'):
+            self.assertEqual(self.client.get(url, {'w_rent': value}).status_code, 400)
+
+
+    def test_commute_uses_the_travel_matrix(self):
+        # 郊外の物件の最寄り駅は、選んだ駅（新宿）とつながっていない
+        isolated = Line.objects.create(name='孤立線')
+        Station.objects.create(line=isolated, name='離れ駅', latitude=35.7201, longitude=139.7401, sort_order=0)
+        spatial.reset_station_index()
+        self.addCleanup(spatial.reset_station_index)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'matrix.npy')
+            travel_matrix.build_matrix_from_db(path)
+            with override_settings(TRAVEL_MATRIX_PATH=path):
+                results = self.client.get(reverse('property_ranking'), {'sort': 'distance'}).json()['results']
+        self.assertEqual([r['id'] for r in results], [self.near.pk, self.cheap.pk, self.unknown.pk])
+        # 駅前は徒歩だけ（1分未満）、郊外は新宿まで行けないので不明
+        self.assertLess(results[0]['commute_minutes'], 1)
+        self.assertIsNone(results[1]['commute_minutes'])
+
+        # 行列が無ければ直線距離で測る
+        results = self.client.get(reverse('property_ranking')).json()['results']
+        self.assertIsNone(results[0]['commute_minutes'])
+
+
+class ServerRenderedMapTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MAP_RENDER_DIR=self.tmp.name)
+        self.settings_override.enable()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.user = make_member(self.group, 'alice')
+        Property.objects.create(group=self.group, name='駅前', address='a', rent='10万円', latitude=35.69, longitude=139.70)
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.tmp.cleanup()
+
+    def test_renders_in_worker_then_serves_from_disk(self):
+        url = reverse('index') + '?mode=server'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 202)
+
+        rendering.wait_for_render(self._digest(), timeout=30)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('駅前', b''.join(response.streaming_content).decode())
+
+        # 同じデータなら同じファイル（304 も返せる）
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+
+        # データが変わると別のハッシュになり、作り直す
+        Property.objects.create(group=self.group, name='郊外', address='b', rent='8万円', latitude=35.72, longitude=139.74)
+        self.assertEqual(self.client.get(url).status_code, 202)
+        rendering.wait_for_render(self._digest(), timeout=30)
+        self.assertEqual(len(os.listdir(self.tmp.name)), 2)
+
+    @override_settings(MAP_RENDER_KEEP=1)
+    def test_old_files_are_pruned(self):
+        url = reverse('index') + '?mode=server'
+        self.client.get(url)
+        rendering.wait_for_render(self._digest(), timeout=30)
+        Property.objects.create(group=self.group, name='郊外', address='b', rent='8万円', latitude=35.72, longitude=139.74)
+        self.client.get(url)
+        rendering.wait_for_render(self._digest(), timeout=30)
+        self.assertEqual(os.listdir(self.tmp.name), [f'{self._digest()}.html'])
+
+    def test_failed_render_is_logged_and_not_retried(self):
+        self.addCleanup(rendering._failed.clear)
+        url = reverse('index') + '?mode=server'
+        with mock.patch.object(rendering, 'render_map_html', side_effect=ValueError('broken')) as render:
+            with self.assertLogs('map_app.rendering', 'ERROR'):
+                self.assertEqual(self.client.get(url).status_code, 202)
+                with self.assertRaises(rendering.RenderError):
+                    rendering.wait_for_render(self._digest(), timeout=30)
+            # 再読み込みのたびに作り直すのではなく、エラーを返す
+            for _ in range(3):
+                self.assertEqual(self.client.get(url).status_code, 503)
+        self.assertEqual(render.call_count, 1)
+
+    def test_user_input_is_escaped(self):
+        html = rendering.render_map_html({
+            'center': {'lat': 35.69, 'lon': 139.70},
+            'stations': [{'name': '<b onmouseover=alert(1)>新宿</b>', 'lat': 35.69, 'lon': 139.70}],
+            'properties': [{
+                'name': '<script>alert(1)</script>', 'rent': '10万円', 'address': '<img src=x onerror=alert(2)>',
+                'lat': 35.69, 'lon': 139.70, 'is_matched': False, 'liked_users': ['<i>bob</i>'],
+            }],
+        })
+        for raw in ('<script>alert(1)</script>', '<img src=x', '<b onmouseover', '<i>bob</i>'):
+            self.assertNotIn(raw, html)
+        self.assertIn('&lt;script&gt;alert(1)&lt;/script&gt;', html)
+
+    def _digest(self):
+        payload = caching.get_group_payload(self.group.pk, 'map', lambda: None)
+        return rendering.content_hash(payload)
+
+
+class RecordingBroker(events.InProcessBroker):
+    """送られたイベントを記録するだけのブローカー（テスト用）"""
+
+    def __init__(self):
+        super().__init__()
+        self.published = []
+
+    def publish(self, group_id, event):
+        self.published.append((group_id, event['type'], event['data']))
+        return super().publish(group_id, event)
+
+
+@override_settings(EVENT_BROKER='map_app.tests.RecordingBroker')
+class GroupEventTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        events.reset_broker()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.user = make_member(self.group, 'alice')
+        line = Line.objects.create(name='JR山手線')
+        self.station = Station.objects.create(line=line, name='新宿', latitude=35.6909, longitude=139.7003, sort_order=0)
+        self.prop = Property.objects.create(group=self.group, name='駅前', address='a', rent='10万円')
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        events.reset_broker()
+
+    def published(self):
+        return [(t, d) for g, t, d in events.get_broker().published if g == self.group.pk]
+
+    def test_changes_publish_deltas_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('toggle_like', args=[self.prop.pk]))
+        with self.captureOnCommitCallbacks(execute=True):
+            update_selected_stations(self.group, add_ids=[self.station.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            new = Property.objects.create(group=self.group, name='郊外', address='b', rent='8万円')
+
+        self.assertEqual(self.published(), [
+            ('like.changed', {'property_id': self.prop.pk, 'like_count': 1, 'is_matched': True, 'user': 'alice', 'liked': True}),
+            ('stations.changed', {'added': [{'id': self.station.pk, 'name': '新宿', 'lat': 35.6909, 'lon': 139.7003}], 'removed': []}),
+            ('property.added', events.property_event_data(new)),
+        ])
+
+    def test_stream_is_refused_under_wsgi(self):
+        response = self.client.get(reverse('group_events'))
+        self.assertEqual(response.status_code, 501)
+        self.assertEqual(events.get_broker().subscriber_count(self.group.pk), 0)
+
+    async def test_stream_delivers_published_events(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('group_events'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream; charset=utf-8')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+        self.assertIn(b'event: hello', await anext(stream))
+
+        broker = events.get_broker()
+        self.assertEqual(broker.subscriber_count(self.group.pk), 1)
+        broker.publish(self.group.pk, events.make_event(self.group.pk, 'property.removed', {'id': 1}))
+        chunk = await anext(stream)
+        self.assertIn(b'event: property.removed\ndata: {"id":1}', chunk)
+
+        # 接続が切れると Django が response.close() を呼ぶ
+        await stream.aclose()
+        response.close()
+        self.assertEqual(broker.subscriber_count(self.group.pk), 0)
+
+
+class StopListening(BaseException):
+    """FakeRedis の受信を終わらせる（テスト用）"""
+
+
+class FakeRedis:
+    """pubsub().listen() が、渡した順にメッセージか例外を返す Redis（テスト用）"""
+
+    def __init__(self, *sessions):
+        self.sessions = list(sessions)
+
+    def pubsub(self, **kwargs):
+        return self
+
+    def subscribe(self, channel):
+        pass
+
+    def close(self):
+        pass
+
+    def listen(self):
+        for item in self.sessions.pop(0):
+            if isinstance(item, BaseException):
+                raise item
+            yield {'data': item}
+
+
+class RedisBrokerTests(TestCase):
+
+    def make_broker(self, *sessions):
+        broker = events.RedisBroker.__new__(events.RedisBroker)
+        events.InProcessBroker.__init__(broker)
+        broker._redis = FakeRedis(*sessions)
+        broker._listener = 'thread'
+        return broker
+
+    def test_listener_skips_bad_messages_and_reconnects(self):
+        good = json.dumps(events.make_event(1, 'property.removed', {'id': 5}))
+        broker = self.make_broker(
+            ['not json', json.dumps({'no': 'group'}), ConnectionError('dropped')],
+            [good, StopListening()],
+        )
+        delivered = []
+        with mock.patch.object(events.InProcessBroker, 'publish', lambda self, group_id, event: delivered.append(event['type'])), \
+                mock.patch.object(events, 'time') as fake_time, \
+                mock.patch.object(broker, '_resync_all') as resync_all, \
+                self.assertLogs('map_app.events', 'WARNING') as logs:
+            with self.assertRaises(StopListening):
+                broker._listen()
+        self.assertEqual(delivered, ['property.removed'])
+        # つなぎ直したら、切れていた間の分を取り直してもらう
+        resync_all.assert_called_once()
+        fake_time.sleep.assert_called_once_with(broker.RECONNECT_DELAY)
+        self.assertEqual(sum('読み飛ばしました' in line for line in logs.output), 2)
+        self.assertTrue(any('つなぎ直します' in line for line in logs.output))
+        # スレッドが終わったら、次の subscribe で作り直せる
+        self.assertIsNone(broker._listener)
+
+
+class DownGeocoder(geocoding.BaseGeocoder):
+    def geocode(self, address):
+        raise geocoding.TransientGeocodingError('timeout')
+
+
+@override_settings(GEOCODER_BACKEND='map_app.geocoding.StubGeocoder', GEOCODER_MIN_INTERVAL=0)
+class GeocodeLookupTests(TestCase):
+
+    def setUp(self):
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.user = make_member(self.group, 'alice')
+
+    async def test_lookup_uses_cache_after_first_call(self):
+        await self.async_client.aforce_login(self.user)
+        url = reverse('geocode_lookup')
+        # リクエストごとに作られるジオコーダーを、呼び出しを数えられるよう1つにまとめる
+        geocoder = geocoding.StubGeocoder()
+        with mock.patch.object(geocoding, 'get_geocoder', return_value=geocoder):
+            first = (await self.async_client.get(url, {'address': '東京都新宿区西新宿２－８－１'})).json()
+            second = (await self.async_client.get(url, {'address': '東京都新宿区西新宿2-8-1'})).json()
+        self.assertTrue(first['found'])
+        self.assertEqual((first['cached'], second['cached']), (False, True))
+        self.assertEqual((first['lat'], first['lon']), (second['lat'], second['lon']))
+        self.assertEqual(len(geocoder.calls), 1)
+
+    async def test_call_slots_are_shared_through_the_cache(self):
+        cache.clear()
+        # 別のプロセスでも、同じ1秒の枠は1回しか取れない
+        self.assertEqual(geocoding.reserve_slot(1.0, clock=lambda: 100.25), 0)
+        self.assertAlmostEqual(await geocoding.areserve_slot(1.0, clock=lambda: 100.5), 0.5)
+        self.assertEqual(await geocoding.areserve_slot(1.0, clock=lambda: 101.0), 0)
+        with self.assertRaises(geocoding.TransientGeocodingError):
+            await geocoding.await_slot(1.0, max_wait=0, clock=lambda: 101.5)
+
+    async def test_per_call_loops_use_the_shared_sync_client(self):
+        def reply(request):
+            return httpx.Response(200, json=[{'lat': '35.5', 'lon': '139.5'}])
+
+        sync_client = httpx.Client(transport=httpx.MockTransport(reply))
+        async_client = httpx.AsyncClient(transport=httpx.MockTransport(reply))
+        geocoder = geocoding.NominatimGeocoder()
+        with mock.patch.object(http_client, 'get_client', return_value=sync_client), \
+                mock.patch.object(http_client, 'get_async_client', return_value=async_client) as get_async_client:
+            # WSGI の async_to_sync のようにリクエストごとに作られるループでは、AsyncClient を作らない
+            self.assertEqual(await geocoder.ageocode('東京都'), (35.5, 139.5))
+            get_async_client.assert_not_called()
+
+            # ASGI サーバーのループでは AsyncClient を共有する
+            http_client.keep_clients_on_loop()
+            self.addCleanup(http_client._server_loops.discard, asyncio.get_running_loop())
+            self.assertEqual(await geocoder.ageocode('東京都'), (35.5, 139.5))
+            get_async_client.assert_called_once()
+        await async_client.aclose()
+
+    async def test_malformed_response_is_a_geocoding_error(self):
+        geocoder = geocoding.NominatimGeocoder()
+        for response in (httpx.Response(200, text='<html>error</html>'), httpx.Response(200, json=[{'lat': '35'}]),
+                         httpx.Response(200, json={'error': 'x'})):
+            client = httpx.Client(transport=httpx.MockTransport(lambda request: response))
+            with mock.patch.object(http_client, 'get_client', return_value=client):
+                with self.assertRaises(geocoding.GeocodingError):
+                    await geocoder.ageocode('東京都')
+
+    @override_settings(GEOCODER_BACKEND='map_app.tests.DownGeocoder')
+    async def test_transient_error_is_503(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('geocode_lookup'), {'address': 'どこか'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(await GeocodeCache.objects.acount(), 0)
+
+
+@skipUnless(connection.vendor == 'sqlite' and settings.SQLITE_PRAGMAS, 'SQLITE_PROFILE=tuned のときのみ')
+class SqliteProfileTests(TestCase):
+
+    def test_pragmas_applied_on_connect(self):
+        # テスト用の接続も connection_created で設定されている
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+            cursor.execute('PRAGMA synchronous')
+            # 1 = NORMAL
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_writes_use_immediate_transactions(self):
+        self.assertEqual(connection.settings_dict['OPTIONS'].get('transaction_mode'), 'IMMEDIATE')
+
+    def test_benchmark_uses_the_same_settings(self):
+        self.assertEqual(SQLITE_PROFILES['tuned']['pragmas'], settings.SQLITE_PRAGMAS)
+        for name, value in SQLITE_PROFILES['tuned']['options'].items():
+            self.assertEqual(connection.settings_dict['OPTIONS'][name], value)
+
+
+class HotQueryIndexTests(TestCase):
+    """よく使うクエリが、全件走査ではなくインデックスを使うことを EXPLAIN で確かめる"""
+
+    def setUp(self):
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        make_member(self.group, 'alice')
+        self.line = Line.objects.create(name='JR山手線')
+        Station.objects.create(line=self.line, name='新宿', latitude=35.69, longitude=139.70, sort_order=0)
+        Property.objects.create(group=self.group, name='駅前', address='a', rent='10万円')
+        if connection.vendor == 'postgresql':
+            # 行数が少ないと PostgreSQL は全件走査を選ぶので、インデックスが使えるかだけを見る
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index_name=None):
+        plan = queryset.explain()
+        if connection.vendor == 'sqlite':
+            self.assertRegex(plan, r'USING (COVERING )?INDEX|USING INTEGER PRIMARY KEY', plan)
+            self.assertNotIn('USE TEMP B-TREE', plan)
+        else:
+            self.assertIn('Index', plan)
+            self.assertNotIn('Seq Scan', plan)
+            self.assertNotIn('Sort', plan)
+        if index_name:
+            self.assertIn(index_name, plan)
+
+    def test_group_properties_newest_first(self):
+        self.assertUsesIndex(Property.objects.filter(group=self.group).order_by('-created_at'), 'property_group_created_idx')
+
+    def test_group_member_count(self):
+        self.assertUsesIndex(UserProfile.objects.filter(group=self.group).values('pk'))
+
+    def test_group_by_name(self):
+        self.assertUsesIndex(MapGroup.objects.filter(name='テストペア'))
+
+    def test_line_stations_in_order(self):
+        self.assertUsesIndex(Station.objects.filter(line=self.line).order_by('sort_order'), 'station_line_order_idx')
+
+    def test_station_by_name(self):
+        self.assertUsesIndex(Station.objects.filter(name='新宿'), 'station_name_idx')
+
+    def test_station_by_line_and_name(self):
+        # 一意制約のインデックス（SQLite では sqlite_autoindex_... という名前になる）
+        self.assertUsesIndex(Station.objects.filter(line=self.line, name='新宿'))
+
+
+class BulkImportTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.alice = make_member(self.group, 'alice')
+        Property.objects.create(group=self.group, name='登録済み', address='東京都新宿区西新宿1-1', rent='12万円')
+        GeocodeCache.objects.create(address_key=geocoding.normalize_address('東京都渋谷区道玄坂1-2'), latitude=35.658, longitude=139.698)
+        self.client.force_login(self.alice)
+
+    def test_upload_csv(self):
+        body = (
+            '名前,住所,家賃\n'
+            '駅前,東京都渋谷区道玄坂１−２,15万円\n'
+            '郊外,東京都中野区中野5-1,8.5万円\n'
+            '重複,東京都新宿区 西新宿1-1,10万円\n'
+            '住所なし,,9万円\n'
+            '同じファイル内の重複,東京都中野区中野５−１,9万円\n'
+        ).encode('utf-8-sig')
+        version = caching.group_version(self.group.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('import_properties'), {'file': SimpleUploadedFile('list.csv', body)})
+        self.assertEqual(response.status_code, 200)
+        report = response.json()
+        self.assertEqual((report['rows'], report['created'], report['duplicates'], report['invalid']), (5, 2, 2, 1))
+        self.assertEqual(report['errors'][0]['row'], 5)
+        self.assertIn('address', report['errors'][0]['errors'])
+        self.assertEqual((report['geocoded_from_cache'], report['queued_for_geocoding']), (1, 1))
+
+        near = Property.objects.get(name='駅前')
+        self.assertEqual((near.rent_yen, near.geocode_status, near.latitude), (150000, GEOCODE_DONE, 35.658))
+        self.assertEqual(Property.objects.get(name='郊外').geocode_status, GEOCODE_PENDING)
+        # bulk_create でもキャッシュは古くならない
+        self.assertNotEqual(caching.group_version(self.group.pk), version)
+
+    def test_command_jsonl_in_batches(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', encoding='utf-8', delete=False) as f:
+            for i in range(7):
+                f.write(f'{{"name": "物件{i}", "address": "東京都杉並区{i}", "rent": "{i + 5}万円"}}\n')
+            f.write('not json\n')
+        self.addCleanup(os.unlink, f.name)
+        out, err = io.StringIO(), io.StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('import_properties', f.name, '--group', 'テストペア', '--batch-size', '3', stdout=out, stderr=err)
+        self.assertEqual(Property.objects.filter(group=self.group).count(), 8)
+        self.assertIn('8 行目', err.getvalue())
+        # 既存住所の1クエリ + バッチごとに（キャッシュ参照・INSERT・トランザクション）
+        self.assertLess(len(queries), 20)
+
+    def test_unreadable_row_keeps_earlier_batches_and_bumps_version(self):
+        # 読み込みは数KB ずつなので、壊れた行より前に何バッチか書き込まれるだけの行数にする
+        body = '名前,住所,家賃\n' + ''.join(f'物件{i},東京都杉並区{i},{i % 20 + 5}万円\n' for i in range(600))
+        stream = io.BytesIO(body.encode('utf-8') + b'\xff\xfe,bad,1\n')
+        version = caching.group_version(self.group.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            report = bulk_import.import_properties(self.group, bulk_import.iter_rows(stream, 'csv'), batch_size=50)
+        self.assertIn('UTF-8', report['error'])
+        self.assertGreater(report['created'], 0)
+        self.assertEqual(Property.objects.filter(group=self.group).count(), report['created'] + 1)
+        self.assertNotEqual(caching.group_version(self.group.pk), version)
+
+    def test_dry_run_creates_nothing(self):
+        rows = bulk_import.iter_rows(io.BytesIO('name,address,rent\nA,東京都港区1,10万円\n'.encode()), 'csv')
+        report = bulk_import.import_properties(self.group, rows, dry_run=True)
+        self.assertEqual((report['valid'], report['created']), (1, 0))
+        self.assertFalse(Property.objects.filter(name='A').exists())
+
+    def test_rejects_unknown_header(self):
+        with self.assertRaises(bulk_import.ImportFormatError):
+            list(bulk_import.iter_rows(io.BytesIO(b'a,b,c\n1,2,3\n'), 'csv'))
+
+
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        metrics.reset_metrics()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.alice = make_member(self.group, 'alice')
+        Property.objects.create(group=self.group, name='駅前', address='a', rent='15万円', latitude=35.69, longitude=139.70)
+        self.client.force_login(self.alice)
+
+    def test_records_view_latency_queries_and_cache(self):
+        self.client.get(reverse('map_payload'))
+        self.client.get(reverse('map_payload'))
+        self.alice.is_staff = True
+        self.alice.save()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('dousei_request_duration_seconds_count{view="map_payload",method="GET"} 2', text)
+        self.assertIn('dousei_requests_total{view="map_payload",method="GET",status="200"} 2', text)
+        self.assertIn('dousei_payload_cache_lookups_total{view="map_payload",result="hit"} 1', text)
+        self.assertIn('dousei_payload_cache_lookups_total{view="map_payload",result="miss"} 1', text)
+        # 非同期ビューの sync_to_async 内の SQL も数える
+        self.assertRegex(text, r'dousei_db_queries_per_request_sum\{view="map_payload"\} [1-9]')
+        self.assertIn('dousei_response_bytes_count{view="map_payload"} 2', text)
+
+    def test_metrics_and_profiler_are_staff_only(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('property_ranking'), HTTP_X_PROFILE='cumulative')
+        self.assertNotIn('X-Profiled-Status', response)
+
+        self.alice.is_staff = True
+        self.alice.save()
+        response = self.client.get(reverse('property_ranking'), HTTP_X_PROFILE='tottime')
+        self.assertEqual(response['X-Profiled-Status'], '200')
+        self.assertIn('view: property_ranking', response.content.decode())
+        self.assertIn('function calls', response.content.decode())
+
+    @override_settings(METRICS_TOKEN='scrape')
+    def test_metrics_token(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+        self.client.logout()
+        for header in ('Bearer scrap', 'Bearer scrapé', ''):
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION=header)
+            self.assertEqual(response.status_code, 403)
+
+
+class BenchmarkHarnessTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_query_count_does_not_grow_with_group_size(self):
+        line = Line.objects.create(name='JR山手線')
+        for i, name in enumerate(['新宿', '代々木', '原宿']):
+            Station.objects.create(line=line, name=name, latitude=35.69 - i * 0.01, longitude=139.70, sort_order=i)
+        rng = random.Random(0)
+        counts = {}
+        for size in (5, 50):
+            group, users = make_group(size, members=4, rng=rng)
+            self.assertEqual(Property.objects.filter(group=group).count(), size)
+            self.client.force_login(users[0])
+            report, statuses = measure(lambda: self.client.get(reverse('map_payload')).status_code, repeat=2, setup=cache.clear, memory=False)
+            self.assertEqual(statuses, [200, 200])
+            counts[size] = report['queries']['max']
+        self.assertEqual(counts[5], counts[50])
+
+
+class CompactPayloadTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.alice = make_member(self.group, 'alice')
+        self.bob = make_member(self.group, 'bob')
+        line = Line.objects.create(name='JR山手線')
+        self.group.selected_stations.add(
+            Station.objects.create(line=line, name='新宿', latitude=35.6909, longitude=139.7003, sort_order=0)
+        )
+        for i in range(5):
+            prop = Property.objects.create(group=self.group, name=f'物件{i}', address=f'住所{i}', rent='10万円',
+                                           latitude=round(35.69 + i / 1000, 6), longitude=139.70)
+            if i % 2 == 0:
+                set_like(prop, self.bob)
+        Property.objects.create(group=self.group, name='座標なし', address='x', rent='9万円')
+        self.client.force_login(self.alice)
+
+    def fetch(self, **headers):
+        response = self.client.get(reverse('map_payload_compact'), **headers)
+        return response, b''.join(response.streaming_content)
+
+    def test_same_data_as_map_payload(self):
+        chunks = list(compact.iter_columnar_payload(self.group, block_size=2))
+        data = json.loads(b''.join(chunks))
+        self.assertEqual(len(data['properties']), 3)
+        self.assertEqual(data['count'], 5)
+        self.assertEqual(compact.decode_columnar(data), build_map_payload(self.group))
+
+    def test_likes_added_while_streaming(self):
+        chunks = compact.iter_columnar_payload(self.group, block_size=2)
+        head = next(chunks)
+        carol = make_member(self.group, 'carol')
+        set_like(Property.objects.get(name='物件1'), carol)
+        data = json.loads(head + b''.join(chunks))
+        self.assertEqual(compact.decode_columnar(data), build_map_payload(self.group))
+
+    def test_gzip_and_conditional_request(self):
+        response, body = self.fetch(HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(json.loads(gzip.decompress(body))['count'], 5)
+
+        response = self.client.get(reverse('map_payload_compact'), HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        # 圧縮しない場合は別の ETag
+        response, body = self.fetch(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(json.loads(body)['count'], 5)
+
+    def test_negotiate_encoding(self):
+        self.assertEqual(compact.negotiate_encoding('gzip;q=0, identity'), None)
+        self.assertEqual(compact.negotiate_encoding('br;q=1.0, gzip;q=0.5'), 'br' if compact.brotli else 'gzip')
+
+
+async def asgi_get(app, path):
+    """ASGI のアプリに GET を1回送り、(ステータス, ヘッダー, 本文) を返す"""
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'', 'headers': [],
+        'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+    }
+    communicator = ApplicationCommunicator(app, scope)
+    await communicator.send_input({'type': 'http.request', 'body': b''})
+    start = await communicator.receive_output()
+    body = b''
+    while True:
+        message = await communicator.receive_output()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return start['status'], {k.decode().lower(): v.decode() for k, v in start['headers']}, body
+
+
+class StaticFilesTests(TestCase):
+
+    def test_whitenoise_is_not_a_middleware(self):
+        # 同期専用のミドルウェアがあると、ASGI で全リクエストがスレッドを経由する
+        self.assertFalse([m for m in settings.MIDDLEWARE if m.startswith('whitenoise.')])
+
+    async def test_asgi_sends_only_static_paths_to_whitenoise(self):
+        seen = []
+
+        async def django_app(scope, receive, send):
+            seen.append(scope['path'])
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b'django'})
+
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'app.0123456789ab.js'), 'w') as f:
+                f.write('console.log(1)')
+            with override_settings(STATIC_ROOT=root, WHITENOISE_AUTOREFRESH=False, DEBUG=False):
+                app = static_files.asgi_with_static_files(django_app)
+
+            status, headers, body = await asgi_get(app, '/static/app.0123456789ab.js')
+            self.assertEqual((status, body), (200, b'console.log(1)'))
+            # ハッシュ付きのファイルは長期間キャッシュさせる
+            self.assertIn('immutable', headers['cache-control'])
+            self.assertEqual((await asgi_get(app, '/static/missing.js'))[0], 404)
+            self.assertEqual(await asgi_get(app, '/api/map/'), (200, {}, b'django'))
+        self.assertEqual(seen, ['/api/map/'])
+
+
+@override_settings(STORAGES={
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+})
+class PageCachingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.group = MapGroup.objects.create(name='テストペア', password='secret')
+        self.alice = make_member(self.group, 'alice')
+        self.client.force_login(self.alice)
+
+    def test_map_shell_has_no_data_and_revalidates(self):
+        response = self.client.get(reverse('index'), {'mode': 'shell'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'map_app/map_shell.js')
+        self.assertContains(response, reverse('map_payload_compact'))
+        # SSE が使えない（WSGI）ときは、この間隔で確認し直す
+        self.assertContains(response, f'data-poll-seconds="{settings.MAP_POLL_SECONDS}"')
+        # データが変わっても枠は変わらない
+        Property.objects.create(group=self.group, name='駅前', address='a', rent='15万円', latitude=35.69, longitude=139.70)
+        response = self.client.get(reverse('index'), {'mode': 'shell'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_last_modified_follows_group_changes(self):
+        base = int(time.time()) + 100
+
+        def at(seconds):
+            return mock.patch('time.time', return_value=base + seconds)
+
+        with at(0.2):
+            Property.objects.create(group=self.group, name='駅前', address='a', rent='15万円', latitude=35.69, longitude=139.70)
+        # 変わったのと同じ秒のうちは、またすぐ変わりうるので Last-Modified を送らない
+        with at(0.6):
+            response = self.client.get(reverse('map_payload'))
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        with at(1.5):
+            response = self.client.get(reverse('map_payload'))
+            last_modified = response['Last-Modified']
+            with self.assertNumQueries(3):  # セッション・ユーザー・グループだけ
+                response = self.client.get(reverse('map_payload'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # Last-Modified と同じ秒に見える変更でも 304 にはならない
+        with at(1.7):
+            Property.objects.create(group=self.group, name='駅裏', address='b', rent='12万円', latitude=35.70, longitude=139.71)
+            response = self.client.get(reverse('map_payload'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['properties']), 2)
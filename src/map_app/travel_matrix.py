@@ -0,0 +1,199 @@
+import heapq
+import json
+import math
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .isochrone import STOP_PENALTY_MIN, TRAIN_SPEED_M_PER_MIN
+from .models import Station
+from .spatial import haversine
+
+# ---------------------------------------------------------
+# 駅間の所要時間の行列（全駅×全駅）
+#   build_travel_matrix コマンドで作り、uint16 の .npy ファイルとして保存する。
+#   読むときは np.load(mmap_mode='r') でメモリマップするので、
+#   gunicorn の各ワーカーは同じファイルのページ（OSのページキャッシュ）を共有し、
+#   プロセスごとにコピーを持たない。引くのは行列の1要素なので O(1)。
+#   同名駅（乗り換え駅）は1つの頂点にまとめる。
+#
+#   駅 → 行・列の番号の対応（index）は、同じファイルの行列の後ろに JSON で付け足す
+#   （[.npy の行列][index の JSON][JSON のバイト数（8バイト）]）。
+#   np.load は行列の部分しか見ないので .npy としてそのまま読め、
+#   行列と index が1つのファイルなので、作り直しの途中でも古い行列と新しい index が混ざらない。
+# ---------------------------------------------------------
+
+MATRIX_FORMAT = 'dousei-map/travel-matrix'
+MATRIX_VERSION = 2
+# uint16 の最大値は「到達できない」を表す
+UNREACHABLE = np.iinfo(np.uint16).max
+# ファイル末尾の、index の JSON のバイト数
+_TRAILER = np.dtype('<u8')
+
+
+def _read_index(f):
+    f.seek(-_TRAILER.itemsize, os.SEEK_END)
+    size = int(np.frombuffer(f.read(_TRAILER.itemsize), dtype=_TRAILER)[0])
+    f.seek(-_TRAILER.itemsize - size, os.SEEK_END)
+    return json.loads(f.read(size).decode('utf-8'))
+
+
+class NameGraph:
+    """同名駅を1つにまとめた駅のグラフ"""
+
+    def __init__(self, rows, weight='time'):
+        """rows: (id, 路線id, 並び順, 駅名, 緯度, 経度) のリスト。weight は 'time'（秒）か 'hops'（駅数）"""
+        rows = sorted(rows, key=lambda r: (r[1], r[2], r[0]))
+        self.names = sorted({r[3] for r in rows})
+        node_of = {name: i for i, name in enumerate(self.names)}
+        self.station_nodes = {r[0]: node_of[r[3]] for r in rows}
+        self.weight = weight
+
+        best = {}
+        for prev, cur in zip(rows, rows[1:]):
+            if prev[1] != cur[1]:
+                continue
+            a, b = node_of[prev[3]], node_of[cur[3]]
+            if a == b:
+                continue
+            if weight == 'hops':
+                cost = 1
+            else:
+                minutes = float(haversine(prev[4], prev[5], cur[4], cur[5])) / TRAIN_SPEED_M_PER_MIN + STOP_PENALTY_MIN
+                cost = max(int(round(minutes * 60)), 1)
+            # 複数の路線が同じ2駅を結ぶ場合は速い方を使う
+            for edge in ((a, b), (b, a)):
+                best[edge] = min(best.get(edge, cost), cost)
+
+        self.adjacency = [[] for _ in self.names]
+        for (a, b), cost in best.items():
+            self.adjacency[a].append((b, cost))
+
+    def __len__(self):
+        return len(self.names)
+
+    def distances_from(self, source):
+        n = len(self)
+        dist = [math.inf] * n
+        dist[source] = 0
+        heap = [(0, source)]
+        adjacency = self.adjacency
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for v, cost in adjacency[u]:
+                nd = d + cost
+                if nd < dist[v]:
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return dist
+
+
+def build_matrix(path, rows, weight='time'):
+    """行列を path（.npy）に書き出す。途中で読まれても壊れないよう、一時ファイルから置き換える"""
+    graph = NameGraph(rows, weight=weight)
+    n = len(graph)
+    tmp_path = f'{path}.tmp.npy'
+    matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint16, shape=(n, n))
+    for i in range(n):
+        # 1行ずつ計算してファイルに書く（全体をメモリに持たない）
+        row = np.array(graph.distances_from(i), dtype=np.float64)
+        row[~np.isfinite(row)] = UNREACHABLE
+        matrix[i] = np.minimum(row, UNREACHABLE).astype(np.uint16)
+    matrix.flush()
+    del matrix
+
+    index = {
+        'format': MATRIX_FORMAT,
+        'version': MATRIX_VERSION,
+        'weight': weight,
+        'unit': 'hops' if weight == 'hops' else 'seconds',
+        'names': graph.names,
+        'stations': {str(station_id): node for station_id, node in graph.station_nodes.items()},
+    }
+    data = json.dumps(index, ensure_ascii=False).encode('utf-8')
+    with open(tmp_path, 'ab') as f:
+        f.write(data)
+        f.write(np.array([len(data)], dtype=_TRAILER).tobytes())
+    os.replace(tmp_path, path)
+    return n
+
+
+def build_matrix_from_db(path, weight='time'):
+    rows = list(Station.objects.values_list('id', 'line_id', 'sort_order', 'name', 'latitude', 'longitude'))
+    return build_matrix(path, rows, weight=weight)
+
+
+class TravelMatrix:
+    def __init__(self, path):
+        self.path = str(path)
+        # index と行列は同じ開いたファイルから読む（途中で置き換えられても組み合わせがずれない）
+        with open(self.path, 'rb') as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime_ns
+            try:
+                index = _read_index(f)
+            except (OSError, ValueError):
+                index = {}
+            if index.get('format') != MATRIX_FORMAT or index.get('version') != MATRIX_VERSION:
+                raise ValueError('駅間所要時間の行列ファイルではありません')
+            # 読み取り専用でメモリマップする（ページは全プロセスで共有される）。
+            # np.load(mmap_mode=) はファイル名しか受け取らないので、.npy のヘッダーを読んで自分でマップする
+            f.seek(0)
+            major, _ = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if major == 1 else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(f)
+            self.matrix = np.memmap(f, dtype=dtype, mode='r', shape=shape, offset=f.tell(), order='F' if fortran_order else 'C')
+        self.weight = index['weight']
+        self.unit = index['unit']
+        self.names = index['names']
+        self.station_nodes = {int(k): v for k, v in index['stations'].items()}
+
+    def node(self, station_id):
+        return self.station_nodes.get(station_id)
+
+    def between(self, from_station_id, to_station_id):
+        """2駅間の値（秒または駅数）。どちらかが不明・到達不能なら None"""
+        a, b = self.node(from_station_id), self.node(to_station_id)
+        if a is None or b is None:
+            return None
+        value = int(self.matrix[a, b])
+        return None if value == UNREACHABLE else value
+
+    def table(self, from_station_ids, to_station_ids):
+        """(len(from), len(to)) の行列（float、到達不能・不明は inf）をまとめて引く"""
+        rows = np.array([self.station_nodes.get(i, -1) for i in from_station_ids], dtype=np.int64)
+        cols = np.array([self.station_nodes.get(i, -1) for i in to_station_ids], dtype=np.int64)
+        result = np.full((len(rows), len(cols)), np.inf)
+        ok_rows, ok_cols = rows >= 0, cols >= 0
+        if ok_rows.any() and ok_cols.any():
+            values = self.matrix[np.ix_(rows[ok_rows], cols[ok_cols])].astype(np.float64)
+            values[values == UNREACHABLE] = np.inf
+            result[np.ix_(ok_rows, ok_cols)] = values
+        return result
+
+
+_matrix_lock = threading.Lock()
+_matrix = None
+
+
+def get_travel_matrix():
+    """設定のパスの行列を読み込んで返す。まだ作られていなければ None
+
+    ファイルが作り直されたら（更新時刻が変わったら）読み直す。
+    """
+    global _matrix
+    path = getattr(settings, 'TRAVEL_MATRIX_PATH', None)
+    if not path:
+        return None
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _matrix is None or _matrix.mtime != mtime or _matrix.path != str(path):
+        with _matrix_lock:
+            if _matrix is None or _matrix.mtime != mtime or _matrix.path != str(path):
+                _matrix = TravelMatrix(path)
+    return _matrix
@@ -6,6 +6,21 @@ urlpatterns = [
     path('leave/', views.leave_group, name='leave_group'),
     path('', views.map_view, name='index'),
     path('add/', views.add_property, name='add_property'),
+    path('import/', views.import_properties, name='import_properties'),
     path('like/<int:property_id>/', views.toggle_like, name='toggle_like'),
     path('add_station/', views.add_station, name='add_station'),
+    path('api/stations/nearest/', views.nearest_stations, name='nearest_stations'),
+    path('api/properties/nearest-stations/', views.property_nearest_stations, name='property_nearest_stations'),
+    path('api/properties/ranking/', views.property_ranking, name='property_ranking'),
+    path('api/map/stations/', views.viewport_stations, name='viewport_stations'),
+    path('api/map/properties/', views.viewport_properties, name='viewport_properties'),
+    path('api/map/compact/', views.map_payload_compact, name='map_payload_compact'),
+    path('api/map/', views.map_payload, name='map_payload'),
+    path('api/geocode/', views.geocode_lookup, name='geocode_lookup'),
+    path('api/isochrone/', views.isochrone, name='isochrone'),
+    path('api/events/', views.group_events, name='group_events'),
+    path('api/lines/', views.station_lines, name='station_lines'),
+    path('api/lines/<int:line_id>/stations/', views.line_stations, name='line_stations'),
+    path('api/cache-stats/', views.cache_stats_view, name='cache_stats'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
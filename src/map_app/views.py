@@ -1,15 +1,40 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse
+from django.urls import reverse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.core.handlers.wsgi import WSGIRequest
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.templatetags.static import static
+from django.conf import settings
 from django.core.cache import cache
-from .models import Property, Station, MapGroup, UserProfile, Line
-from .forms import PropertyForm, MapGroupForm, StationSelectionForm
+from django.contrib.auth.models import User
+from django.db.models import Prefetch
+from .models import Property, Station, MapGroup, UserProfile
+from .forms import PropertyForm, MapGroupForm
+from . import bulk_import, compact, events, metrics, spatial_db
+from .caching import (
+    aget_group_payload, apayload_last_modified, apayload_tag, cache_stats, get_group_payload,
+    payload_last_modified, payload_tag, station_data_version, station_last_modified,
+)
+from .geocoding import GeocodingError, TransientGeocodingError, alookup, apply_cached_coordinates
+from .isochrone import get_isochrone
+from .matching import set_like
+from .ranking import DEFAULT_WEIGHTS, SORT_KEYS, rank_properties
+from .rendering import RenderError, request_render
+from .travel_matrix import get_travel_matrix
+from .station_data import line_stations_json, line_tree_json, update_selected_stations
+from .spatial import CLUSTER_MAX_ZOOM, StationIndex, cluster_points, get_station_index, nearest_of, parse_bbox, snap_bbox
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-import folium
-from geopy.geocoders import Nominatim
+from django.core.paginator import Paginator
+import math
 import time
 import requests
+import hashlib
+import hmac
 import json
 from django.views.decorators.http import require_POST
+from asgiref.sync import sync_to_async
 
 # ---------------------------------------------------------
 # グループ選択（玄関）
@@ -58,45 +83,38 @@ def group_setup(request):
     })
 
 # ---------------------------------------------------------
-# メイン画面：地図と到達圏の表示
+# 地図に渡すデータの組み立て
 # ---------------------------------------------------------
-@login_required
-def map_view(request):
-    my_group = request.user.profile.group
-    
-    if not my_group:
-        return redirect('group_setup')
+def _in_bbox(queryset, bbox):
+    if bbox is None:
+        return queryset
+    # PostGIS があれば GiST インデックス、無ければ緯度・経度のインデックスで絞る
+    return spatial_db.filter_bbox(queryset, bbox)
 
-    # 1. 駅データをリストにする
-    stations_data = []
-    all_stations = my_group.selected_stations.all()
-    
-    # 地図の中心用（データがなければ新宿）
-    center = {'lat': 35.690921, 'lon': 139.700258}
-    
-    if all_stations.exists():
-        center['lat'] = all_stations.first().latitude
-        center['lon'] = all_stations.first().longitude
-
-    for station in all_stations:
-        stations_data.append({
-            'name': station.name,
-            'lat': station.latitude,
-            'lon': station.longitude,
-        })
+def station_features(group, bbox=None):
+    """グループが選んだ駅のリスト（1クエリ）。bbox を渡すとその範囲内だけ"""
+    stations = _in_bbox(group.selected_stations.order_by('pk'), bbox)
+    return [
+        {'name': name, 'lat': lat, 'lon': lon}
+        for name, lat, lon in stations.values_list('name', 'latitude', 'longitude')
+    ]
+
+def property_features(group, bbox=None, matched_only=False):
+    """座標のある物件のリスト。物件数によらず2クエリ。bbox を渡すとその範囲内だけ"""
+    # マッチ状態は保存値を使い、いいねした人の名前は prefetch でまとめて取得する
+    # （物件ごとに数え直したり likes.all() を呼ぶと 3N 回以上のクエリになるため）
+    properties = (
+        _in_bbox(Property.objects.filter(group=group), bbox)
+        .exclude(latitude__isnull=True)
+        .exclude(longitude__isnull=True)
+        .prefetch_related(Prefetch('likes', queryset=User.objects.only('username')))
+    )
+    if matched_only:
+        properties = properties.filter(is_matched=True)
 
-    # 2. 物件データをリストにする
     properties_data = []
-    properties = Property.objects.filter(group=my_group)
-    
     for prop in properties:
         if prop.latitude and prop.longitude:
-            # マッチ度判定などのロジックもここで計算して渡す
-            is_matched = prop.is_matched()
-            
-            # いいねした人の名前リスト
-            liked_users = [u.username for u in prop.likes.all()]
-            
             properties_data.append({
                 'id': prop.id,
                 'name': prop.name,
@@ -104,21 +122,124 @@ def map_view(request):
                 'address': prop.address,
                 'lat': prop.latitude,
                 'lon': prop.longitude,
-                'is_matched': is_matched,
-                'liked_users': liked_users,
+                'is_matched': prop.is_matched,
+                'liked_users': [u.username for u in prop.likes.all()],
             })
+    return properties_data
 
-    # 3. HTMLには「地図」ではなく「データ」を渡す
-    context = {
-        'group_name': my_group.name,
-        'center_lat': center['lat'],
-        'center_lon': center['lon'],
-        # json.dumpsでJavaScriptが読める形式に変換
-        'stations_json': json.dumps(stations_data, ensure_ascii=False),
-        'properties_json': json.dumps(properties_data, ensure_ascii=False),
+def build_map_payload(group):
+    """グループの駅・物件データを、物件数によらず一定回数のクエリで組み立てる"""
+    # 1. 駅データをリストにする
+    stations_data = station_features(group)
+
+    # 地図の中心用（データがなければ新宿）
+    center = {'lat': 35.690921, 'lon': 139.700258}
+    if stations_data:
+        center['lat'] = stations_data[0]['lat']
+        center['lon'] = stations_data[0]['lon']
+
+    # 2. 物件データをリストにする
+    return {
+        'center': center,
+        'stations': stations_data,
+        'properties': property_features(group),
     }
+
+# ---------------------------------------------------------
+# メイン画面：地図と到達圏の表示
+# ---------------------------------------------------------
+@login_required
+def map_view(request):
+    my_group = request.user.profile.group
+    
+    if not my_group:
+        return redirect('group_setup')
+
+    # ?mode=server なら、サーバーで作った地図HTMLを返す
+    if request.GET.get('mode') == 'server':
+        return _server_rendered_map(request, my_group)
+    # ?mode=shell なら、データを埋め込まない地図の枠だけを返す（データは画面側で取りに行く）
+    if request.GET.get('mode') == 'shell':
+        return _map_shell(request, my_group)
+
+    def build():
+        payload = build_map_payload(my_group)
+        return {
+            'center_lat': payload['center']['lat'],
+            'center_lon': payload['center']['lon'],
+            # json.dumpsでJavaScriptが読める形式に変換
+            'stations_json': json.dumps(payload['stations'], ensure_ascii=False),
+            'properties_json': json.dumps(payload['properties'], ensure_ascii=False),
+        }
+
+    # グループのデータが変わっていなければ、シリアライズ済みのデータをキャッシュから使う。
+    # このページは物件をすべてテンプレートに埋め込むので、メモリは物件数に比例する。
+    # 物件の多いグループは ?mode=shell（列指向のデータを少しずつ流す）を使う
+    data = get_group_payload(my_group.pk, 'map:page', build)
+
+    # 3. HTMLには「地図」ではなく「データ」を渡す
+    # payload_url: 物件の多いグループ向けに、列指向の地図データを画面側で取りに行くときのURL
+    context = {'group_name': my_group.name, 'payload_url': reverse('map_payload_compact'), **data}
     return render(request, 'map_app/index.html', context)
 
+def _server_rendered_map(request, group):
+    """folium で作った地図HTML。まだ無ければ作成を頼んで 202（数秒後に自動で再読み込み）"""
+    payload = get_group_payload(group.pk, 'map', lambda: _dump_json(build_map_payload(group)))
+    try:
+        digest, path = request_render(payload)
+    except RenderError:
+        # 失敗したものを再読み込みのたびに作り直さない（ログは rendering に出ている）
+        response = HttpResponse('<!doctype html><meta charset="utf-8"><p>地図を作成できませんでした。</p>', status=503)
+        response['Retry-After'] = str(getattr(settings, 'MAP_RENDER_RETRY_SECONDS', 300))
+        patch_cache_control(response, no_store=True)
+        return response
+    etag = quote_etag(digest)
+
+    response = get_conditional_response(request, etag=etag) if path is not None else None
+    if path is not None and response is None:
+        try:
+            response = FileResponse(open(path, 'rb'), content_type='text/html; charset=utf-8')
+        except FileNotFoundError:
+            # 古いファイルとして消された直後。もう一度作ってもらう
+            request_render(payload)
+            path = None
+
+    if path is None:
+        response = HttpResponse(
+            '<!doctype html><meta charset="utf-8"><meta http-equiv="refresh" content="2">'
+            '<p>地図を作成しています…</p>',
+            status=202,
+        )
+        response['Retry-After'] = '2'
+        patch_cache_control(response, no_store=True)
+        return response
+
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def _map_shell(request, group):
+    """地図の枠（HTML）。描画は静的ファイルの map_shell.js が行い、データは payload_url から取る
+
+    中身はグループ名と静的ファイルのURL（ハッシュ付き）だけで決まるので、
+    グループのデータが変わっても ETag は変わらず、再訪時は 304 で済む。
+    """
+    assets = [static('map_app/map_shell.js'), static('map_app/map_shell.css')]
+    poll_seconds = getattr(settings, 'MAP_POLL_SECONDS', 30)
+    etag = quote_etag(hashlib.md5(json.dumps([group.pk, group.name, poll_seconds, *assets]).encode('utf-8')).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render(request, 'map_app/map_shell.html', {
+            'group_name': group.name,
+            'payload_url': reverse('map_payload_compact'),
+            'events_url': reverse('group_events'),
+            # SSE が使えないときに取り直す間隔
+            'poll_seconds': poll_seconds,
+        })
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
 # ---------------------------------------------------------
 # 物件登録ページ
 # ---------------------------------------------------------
@@ -137,6 +258,8 @@ def add_property(request):
             property_obj = form.save(commit=False)
             # ログインユーザーのグループを自動でセット
             property_obj.group = request.user.profile.group
+            # 座標はキャッシュにあればすぐ入れる。無ければワーカー(geocode_properties)が後で変換する
+            apply_cached_coordinates(property_obj)
             # 最後に保存
             property_obj.save()
             
@@ -147,6 +270,31 @@ def add_property(request):
 
     return render(request, 'map_app/add_property.html', {'form': form})
 # ---------------------------------------------------------
+# 物件の一括登録（CSV / JSONL のアップロード）
+#   multipart の file を1行ずつ読んで登録し、行ごとのエラーと件数をJSONで返す。
+#   住所が座標キャッシュに無い物件は pending のまま残り、geocode_properties が変換する。
+# ---------------------------------------------------------
+@login_required
+@require_POST
+def import_properties(request):
+    group = request.user.profile.group
+    if not group:
+        return _json_error('グループに参加していません', status=403)
+    upload = request.FILES.get('file')
+    if upload is None:
+        return _json_error('file を指定してください')
+    try:
+        fmt = request.POST.get('format') or bulk_import.guess_format(upload.name)
+        if fmt not in bulk_import.FORMATS:
+            return _json_error(f"format は {', '.join(bulk_import.FORMATS)} のどれかを指定してください")
+        report = bulk_import.import_properties(group, bulk_import.iter_rows(upload.file, fmt))
+    except bulk_import.ImportFormatError as e:
+        return _json_error(str(e))
+    # 途中で読めなくなったときも、登録済みの件数が分かるようにレポートごと返す
+    status = 400 if 'error' in report else 200
+    return JsonResponse(report, status=status, json_dumps_params={'ensure_ascii': False})
+
+# ---------------------------------------------------------
 # 駅の追加（＆APIデータの先読み保存）
 # ---------------------------------------------------------
 @login_required
@@ -158,36 +306,100 @@ def add_station(request):
         return redirect('group_setup')
 
     if request.method == 'POST':
-        # フォーム送信時の処理（チェックされた駅を保存）
-        form = StationSelectionForm(request.POST, instance=group)
-        if form.is_valid():
-            form.save()
-            return redirect('index')
-    else:
-        # 初期表示（現在の選択状態を反映）
-        form = StationSelectionForm(instance=group)
+        # 送られてきた差分（add / remove）だけを保存する
+        # 旧フォームと同じ selected_stations（チェックされた全駅）が来た場合は、現在の選択との差分を取る
+        try:
+            add_ids = {int(v) for v in request.POST.getlist('add')}
+            remove_ids = {int(v) for v in request.POST.getlist('remove')}
+            if 'selected_stations' in request.POST:
+                checked = {int(v) for v in request.POST.getlist('selected_stations')}
+                current = set(group.selected_stations.values_list('pk', flat=True))
+                add_ids |= checked - current
+                remove_ids |= current - checked
+        except ValueError:
+            return _json_error('駅IDが正しくありません')
 
-    # 路線ごとに駅データを取得（テンプレートでツリー表示するために必要）
-    # prefetch_related を使うと、SQLの回数を減らして高速に駅を取得できます
-    lines = Line.objects.prefetch_related('stations').all().order_by('sort_order')
+        added, removed = update_selected_stations(group, add_ids, remove_ids)
+        if request.accepts('application/json') and not request.accepts('text/html'):
+            return JsonResponse({'added': added, 'removed': removed})
+        return redirect('index')
 
+    # 路線・駅のツリーはページに埋め込まず、キャッシュ済みの JSON を画面側で取りに行く
+    # （路線一覧 → 開いた路線の駅だけ、の順に読み込む）
     context = {
-        'form': form,
-        'lines': lines, # これがVSCode風表示のデータ源になります
+        'lines_url': reverse('station_lines'),
+        # 路線ごとの駅一覧のURL（画面側で 0 を路線IDに置き換える）
+        'line_stations_url': reverse('line_stations', args=[0]),
+        'selected_station_ids': json.dumps(list(group.selected_stations.values_list('pk', flat=True))),
     }
     return render(request, 'map_app/add_station.html', context)
 
+# ---------------------------------------------------------
+# 駅選択用のツリーAPI（全グループ共通・駅データのバージョンごとにキャッシュ）
+# ---------------------------------------------------------
+def _last_modified(timestamp):
+    """Last-Modified に使う秒。HTTP の日時は秒単位なので、
+    今の1秒の間の変更は（同じ秒にまた変わりうるので）None にして送らない。
+    If-Modified-Since だけのクライアントに誤って 304 を返さないため"""
+    seconds = int(timestamp)
+    return seconds if seconds < int(time.time()) else None
+
+def _station_tree_response(request, body):
+    etag = quote_etag(f'stations-{station_data_version()}-{hashlib.md5(body).hexdigest()[:16]}')
+    last_modified = _last_modified(station_last_modified())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(body, content_type='application/json; charset=utf-8')
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+@login_required
+def station_lines(request):
+    """路線の一覧（駅数つき）"""
+    return _station_tree_response(request, line_tree_json())
+
+@login_required
+def line_stations(request, line_id):
+    """1路線の駅一覧（路線を開いたときに読み込む）"""
+    body = line_stations_json(line_id)
+    if body is None:
+        return _json_error('路線が見つかりません', status=404)
+    return _station_tree_response(request, body)
+
 # ---------------------------------------------------------
 # いいね機能
 # ---------------------------------------------------------
-def toggle_like(request, property_id):
-    prop = get_object_or_404(Property, pk=property_id)
-    if request.user.is_authenticated:
-        if request.user in prop.likes.all():
-            prop.likes.remove(request.user)
-        else:
-            prop.likes.add(request.user)
-    return HttpResponse("OK")
+@login_required
+@require_POST
+async def toggle_like(request, property_id):
+    """いいねを反転して、新しいいいね数とマッチ状態を JSON で返す
+
+    POST に liked=1 / liked=0 を付けると「付ける / 外す」を指定できる（再送しても同じ結果）。
+    """
+    user = await request.auser()
+    group = await _agroup(user)
+    prop = await Property.objects.only('id', 'group_id').filter(pk=property_id, group=group).afirst()
+    if group is None or prop is None:
+        raise Http404('物件が見つかりません')
+
+    desired = request.POST.get('liked')
+    if desired not in (None, '', '0', '1', 'true', 'false'):
+        return _json_error('liked は 1 か 0 で指定してください')
+    liked = None if desired in (None, '') else desired in ('1', 'true')
+
+    # トランザクションは非同期に対応していないので、書き込みだけ同期で行う
+    liked, changed = await sync_to_async(set_like)(prop, user, liked)
+    like_count, is_matched = await Property.objects.filter(pk=prop.pk).values_list('like_count', 'is_matched').aget()
+    return JsonResponse({
+        'property_id': prop.pk,
+        'liked': liked,
+        'changed': changed,
+        'like_count': like_count,
+        'is_matched': is_matched,
+    })
 
 @login_required
 @require_POST
@@ -197,4 +409,410 @@ def leave_group(request):
     if profile.group:
         profile.group = None
         profile.save()
-    return redirect('group_setup')
\ No newline at end of file
+    return redirect('group_setup')
+
+# ---------------------------------------------------------
+# 最寄り駅API
+# ---------------------------------------------------------
+def _json_error(message, status=400):
+    return JsonResponse({'error': message}, status=status, json_dumps_params={'ensure_ascii': False})
+
+def _parse_point(request, group):
+    """?property=<id> または ?lat=..&lon=.. から基準点を取り出す"""
+    if request.GET.get('property'):
+        prop = get_object_or_404(Property, pk=request.GET['property'], group=group)
+        if prop.latitude is None or prop.longitude is None:
+            raise ValueError('この物件はまだ座標がありません')
+        return prop.latitude, prop.longitude
+    try:
+        lat, lon = float(request.GET['lat']), float(request.GET['lon'])
+    except (KeyError, ValueError):
+        raise ValueError('lat と lon（または property）を指定してください')
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('座標が範囲外です')
+    return lat, lon
+
+@login_required
+def nearest_stations(request):
+    """指定した地点（または物件）から近い順に k 駅と距離を返す
+
+    ?scope=selected を付けると、グループが選んだ駅の中だけから探す。
+    ?radius=1000 を付けると、その距離（m）以内の駅だけを返す。
+    """
+    group = request.user.profile.group
+    if not group:
+        return _json_error('グループに参加していません', status=403)
+
+    try:
+        lat, lon = _parse_point(request, group)
+        k = min(max(int(request.GET.get('k', 5)), 1), 50)
+        radius = float(request.GET['radius']) if request.GET.get('radius') else None
+        if radius is not None and not 0 < radius <= 50000:
+            raise ValueError('radius は 50000（m）以下で指定してください')
+    except ValueError as e:
+        return _json_error(str(e))
+
+    selected = request.GET.get('scope') == 'selected'
+    queryset = group.selected_stations.all() if selected else Station.objects.all()
+    if radius is not None:
+        stations = [
+            {'id': pk, 'name': name, 'line': line, 'lat': s_lat, 'lon': s_lon, 'distance_m': round(distance, 1)}
+            for pk, name, line, s_lat, s_lon, distance in spatial_db.filter_radius(queryset, lat, lon, radius)
+            .order_by('distance_m', 'pk')
+            .values_list('id', 'name', 'line__name', 'latitude', 'longitude', 'distance_m')[:k]
+        ]
+    elif spatial_db.postgis_available():
+        # GiST インデックスの KNN 検索
+        stations = [
+            {'id': pk, 'name': name, 'line': line, 'lat': s_lat, 'lon': s_lon, 'distance_m': round(distance, 1)}
+            for pk, name, line, s_lat, s_lon, distance in spatial_db.nearest(
+                queryset, lat, lon, k, ['id', 'name', 'line__name', 'latitude', 'longitude'],
+            )
+        ]
+    else:
+        if selected:
+            index = StationIndex(list(queryset.values_list('id', 'name', 'line__name', 'latitude', 'longitude')))
+        else:
+            index = get_station_index()
+        stations = [index.describe(i, distance) for i, distance in index.nearest(lat, lon, k)]
+
+    return JsonResponse(
+        {'origin': {'lat': lat, 'lon': lon}, 'stations': stations},
+        json_dumps_params={'ensure_ascii': False},
+    )
+
+@login_required
+def property_nearest_stations(request):
+    """グループの全物件について、選んだ駅の中で一番近い駅と距離を返す（NumPyで一括計算）"""
+    group = request.user.profile.group
+    if not group:
+        return _json_error('グループに参加していません', status=403)
+
+    stations = list(group.selected_stations.order_by('pk').values_list('id', 'name', 'latitude', 'longitude'))
+    properties = list(
+        Property.objects.filter(group=group, latitude__isnull=False, longitude__isnull=False)
+        .order_by('pk')
+        .values_list('id', 'latitude', 'longitude')
+    )
+
+    nearest, distances = nearest_of(
+        [p[1] for p in properties], [p[2] for p in properties],
+        [s[2] for s in stations], [s[3] for s in stations],
+    )
+    results = [
+        {
+            'property_id': prop[0],
+            'station': {'id': stations[i][0], 'name': stations[i][1]},
+            'distance_m': round(float(distance), 1),
+        }
+        for prop, i, distance in zip(properties, nearest, distances)
+    ]
+    return JsonResponse({'properties': results}, json_dumps_params={'ensure_ascii': False})
+
+
+# ---------------------------------------------------------
+# 表示範囲（bbox）で絞り込んだ地図データAPI
+#   ?bbox=minLon,minLat,maxLon,maxLat&zoom=12
+#   ズームが小さいときはサーバー側でクラスタにまとめて返す。
+#   ETag を付けるので、同じ範囲を見直したときは 304 だけで済む。
+# ---------------------------------------------------------
+def _dump_json(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _cached_json_response(request, group, kind, builder):
+    """グループのバージョンから ETag を作り、キャッシュ済みのバイト列を返す
+
+    ETag はデータを組み立てる前に決まるので、変わっていなければ DB を見ずに 304 を返せる。
+    Last-Modified はグループ（と駅データ）が最後に変わった時刻。両方来たときは ETag を優先する。
+    """
+    tag = payload_tag(group.pk, kind)
+    etag = quote_etag(tag)
+    last_modified = _last_modified(payload_last_modified(group.pk))
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        body = get_group_payload(group.pk, kind, lambda: _dump_json(builder()), tag=tag)
+        response = HttpResponse(body, content_type='application/json; charset=utf-8')
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # ブラウザに保存はさせるが、使う前に必ず ETag で確認させる
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+async def _agroup(user):
+    """ログインユーザーの所属グループ（非同期ORM、1クエリ）"""
+    profile = await UserProfile.objects.select_related('group').filter(user_id=user.pk).afirst()
+    return profile.group if profile else None
+
+async def _acached_json_response(request, group, kind, builder):
+    """_cached_json_response の非同期版。builder は同期関数（キャッシュに無いときだけ別スレッドで呼ぶ）"""
+    tag = await apayload_tag(group.pk, kind)
+    etag = quote_etag(tag)
+    last_modified = _last_modified(await apayload_last_modified(group.pk))
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        build = sync_to_async(lambda: _dump_json(builder()))
+        body = await aget_group_payload(group.pk, kind, build, tag=tag)
+        response = HttpResponse(body, content_type='application/json; charset=utf-8')
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def _viewport(request):
+    bbox = parse_bbox(request.GET.get('bbox'))
+    try:
+        zoom = int(request.GET.get('zoom', CLUSTER_MAX_ZOOM))
+    except ValueError:
+        raise ValueError('zoom は整数で指定してください')
+    zoom = min(max(zoom, 0), 22)
+    # タイルの境目にそろえる（キャッシュのキーを表示範囲ごとに増やさない）
+    return snap_bbox(bbox, zoom), zoom
+
+def _clustered(features, zoom):
+    """近い点をまとめる。1点だけのマスはそのまま、2点以上は {cluster, count, lat, lon, ids}"""
+    labels, lats, lons, counts = cluster_points(
+        [f['lat'] for f in features], [f['lon'] for f in features], zoom,
+    )
+    members = {}
+    for feature, label in zip(features, labels):
+        members.setdefault(int(label), []).append(feature)
+
+    result = []
+    for label, items in members.items():
+        if counts[label] == 1:
+            result.append(items[0])
+        else:
+            cluster = {
+                'cluster': True,
+                'count': int(counts[label]),
+                'lat': float(lats[label]),
+                'lon': float(lons[label]),
+            }
+            if 'id' in items[0]:
+                cluster['ids'] = [item['id'] for item in items]
+            result.append(cluster)
+    return result
+
+def _viewport_response(request, name, features_func, **filters):
+    group = request.user.profile.group
+    if not group:
+        return _json_error('グループに参加していません', status=403)
+    try:
+        bbox, zoom = _viewport(request)
+    except ValueError as e:
+        return _json_error(str(e))
+
+    def build():
+        return {
+            'zoom': zoom,
+            # 実際に返した範囲（要求より少し広い）
+            'bbox': list(bbox),
+            'clustered': zoom < CLUSTER_MAX_ZOOM,
+            'features': _clustered(features_func(group, bbox, **filters), zoom),
+        }
+    kind = f'viewport:{name}:{bbox}:{zoom}:{sorted(filters.items())}'
+    return _cached_json_response(request, group, kind, build)
+
+@login_required
+def viewport_stations(request):
+    """表示範囲内の、グループが選んだ駅"""
+    return _viewport_response(request, 'stations', station_features)
+
+@login_required
+def viewport_properties(request):
+    """表示範囲内の物件（いいね・マッチ状態つき）。?matched=1 でマッチした物件だけ"""
+    matched_only = request.GET.get('matched') in ('1', 'true')
+    return _viewport_response(request, 'properties', property_features, matched_only=matched_only)
+
+@login_required
+async def map_payload(request):
+    """map_view と同じ地図データ一式（キャッシュ済み）"""
+    group = await _agroup(await request.auser())
+    if not group:
+        return _json_error('グループに参加していません', status=403)
+    return await _acached_json_response(request, group, 'map', lambda: build_map_payload(group))
+
+# ---------------------------------------------------------
+# 地図データの列指向版（compact.py）。キャッシュせず DB から直接流す
+#   物件が多くてもメモリに載るのは1ブロック分だけ。Accept-Encoding に合わせて br / gzip で圧縮する
+# ---------------------------------------------------------
+@login_required
+async def map_payload_compact(request):
+    group = await _agroup(await request.auser())
+    if not group:
+        return _json_error('グループに参加していません', status=403)
+    encoding = compact.negotiate_encoding(request.headers.get('Accept-Encoding'))
+    # 圧縮形式ごとにバイト列が違うので、ETag も分ける
+    etag = quote_etag(f"{await apayload_tag(group.pk, 'compact')}-{encoding or 'identity'}")
+    last_modified = _last_modified(await apayload_last_modified(group.pk))
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        chunks = compact.compress_stream(compact.iter_columnar_payload(group), encoding)
+        # WSGI ではそのまま、ASGI では1チャンクずつ別スレッドで読みながら送る
+        stream = chunks if isinstance(request, WSGIRequest) else compact.ThreadedStream(chunks)
+        response = StreamingHttpResponse(stream, content_type='application/json; charset=utf-8')
+        if encoding:
+            response['Content-Encoding'] = encoding
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+# ---------------------------------------------------------
+# 住所の検索（物件登録フォームでのプレビュー用）
+#   ?address=東京都新宿区西新宿2-8-1
+#   キャッシュに無い住所だけ外部APIに問い合わせる。待っている間もワーカーを塞がない
+# ---------------------------------------------------------
+@login_required
+async def geocode_lookup(request):
+    address = request.GET.get('address', '').strip()
+    if not address:
+        return _json_error('address を指定してください')
+    try:
+        entry, cached = await alookup(address)
+    except TransientGeocodingError:
+        response = _json_error('住所検索サービスが混み合っています。しばらくしてからお試しください', status=503)
+        response['Retry-After'] = '5'
+        return response
+    except GeocodingError:
+        return _json_error('住所検索サービスでエラーが発生しました', status=502)
+    return JsonResponse({
+        'address': address,
+        'found': entry.found,
+        'lat': entry.latitude,
+        'lon': entry.longitude,
+        'cached': cached,
+    }, json_dumps_params={'ensure_ascii': False})
+
+# ---------------------------------------------------------
+# 到達圏（選んだ駅から○分で行ける範囲）
+#   ?budget=30&bands=10,20,30
+# ---------------------------------------------------------
+@login_required
+def isochrone(request):
+    group = request.user.profile.group
+    if not group:
+        return _json_error('グループに参加していません', status=403)
+    try:
+        budget = int(request.GET.get('budget', 30))
+        if not 1 <= budget <= 120:
+            raise ValueError
+        if request.GET.get('bands'):
+            bands = sorted({int(v) for v in request.GET['bands'].split(',')})
+        else:
+            bands = list(range(10, budget, 10)) + [budget]
+        if not all(0 < b <= budget for b in bands):
+            raise ValueError
+        # 最後の帯は budget まで（無いと bands[-1] 〜 budget のマスに対応する帯が無くなる）
+        if bands[-1] != budget:
+            bands.append(budget)
+    except ValueError:
+        return _json_error('budget は1〜120分、bands は budget 以下の分数をカンマ区切りで指定してください')
+
+    def build():
+        station_ids = list(group.selected_stations.values_list('pk', flat=True))
+        return get_isochrone(station_ids, budget, bands)
+    return _cached_json_response(request, group, f'isochrone:{budget}:{bands}', build)
+
+# ---------------------------------------------------------
+# 物件ランキング（家賃・駅への近さ・いいねの点数順）
+#   ?sort=score|rent|distance|likes&page=1&per_page=20
+#   &max_rent=120000&matched=1&w_rent=0.4&w_distance=0.4&w_likes=0.2
+# ---------------------------------------------------------
+@login_required
+def property_ranking(request):
+    group = request.user.profile.group
+    if not group:
+        return _json_error('グループに参加していません', status=403)
+
+    sort = request.GET.get('sort', 'score')
+    if sort not in SORT_KEYS:
+        return _json_error(f"sort は {', '.join(SORT_KEYS)} のどれかを指定してください")
+    try:
+        page = int(request.GET.get('page', 1))
+        per_page = min(max(int(request.GET.get('per_page', 20)), 1), 100)
+        max_rent = int(request.GET['max_rent']) if request.GET.get('max_rent') else None
+        weights = {
+            key: float(request.GET[f'w_{key}'])
+            for key in DEFAULT_WEIGHTS if request.GET.get(f'w_{key}')
+        }
+        if not all(math.isfinite(w) for w in weights.values()):
+            raise ValueError
+    except ValueError:
+        return _json_error('page・per_page・max_rent・w_* は数値で指定してください')
+    matched_only = request.GET.get('matched') in ('1', 'true')
+
+    def build():
+        ranked = rank_properties(group, weights, sort=sort, max_rent=max_rent, matched_only=matched_only)
+        paginator = Paginator(ranked, per_page)
+        current = paginator.get_page(page)
+        return {
+            'count': paginator.count,
+            'num_pages': paginator.num_pages,
+            'page': current.number,
+            'per_page': per_page,
+            'sort': sort,
+            'weights': {**DEFAULT_WEIGHTS, **weights},
+            'results': list(current.object_list),
+        }
+    # 駅間の所要時間の行列を作り直したら、グループのデータが同じでも順位が変わる
+    matrix = get_travel_matrix()
+    matrix_version = matrix.mtime if matrix is not None else 0
+    kind = f'ranking:{sort}:{page}:{per_page}:{max_rent}:{matched_only}:{sorted(weights.items())}:{matrix_version}'
+    return _cached_json_response(request, group, kind, build)
+
+# ---------------------------------------------------------
+# グループのリアルタイム通知（Server-Sent Events）
+#   物件の追加・いいね・選択駅の変更を差分で受け取る。
+#   接続を張り続けるので ASGI（uvicorn）で動かすこと（WSGI の同期ワーカーでは1接続で1ワーカーを占有する）
+# ---------------------------------------------------------
+@login_required
+async def group_events(request):
+    if isinstance(request, WSGIRequest):
+        # WSGI では接続を張り続けるとスレッドを1つ塞いだままになる（終わらないのでバッファもされる）
+        return _json_error('リアルタイム通知は ASGI で動かしたときだけ使えます（GUNICORN_WORKER_CLASS=uvicorn）', status=501)
+    user = await request.auser()
+    group_id = await UserProfile.objects.filter(user_id=user.pk).values_list('group_id', flat=True).afirst()
+    if group_id is None:
+        return _json_error('グループに参加していません', status=403)
+
+    subscription = await events.get_broker().subscribe(group_id)
+    response = StreamingHttpResponse(
+        events.EventStream(
+            subscription,
+            heartbeat=getattr(settings, 'EVENT_HEARTBEAT_SECONDS', 15),
+            resync='HTTP_LAST_EVENT_ID' in request.META,
+        ),
+        content_type='text/event-stream; charset=utf-8',
+    )
+    patch_cache_control(response, no_cache=True)
+    # nginx などにバッファさせない
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+# ---------------------------------------------------------
+# キャッシュの状況（管理者用）
+# ---------------------------------------------------------
+@staff_member_required
+def cache_stats_view(request):
+    return JsonResponse(cache_stats())
+
+
+# ---------------------------------------------------------
+# 計測値（Prometheus のテキスト形式）。値はこのプロセスの分だけ
+# ---------------------------------------------------------
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    # 時間差で一致した文字数を推測されないように、比較は定数時間で行う
+    authorized = bool(token) and hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()
+    )
+    if not authorized and not (request.user.is_authenticated and request.user.is_staff):
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    response = HttpResponse(metrics.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    response['Cache-Control'] = 'no-store'
+    return response